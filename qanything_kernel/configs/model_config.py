@@ -120,18 +120,49 @@ VECTOR_SEARCH_TOP_K = 30
 
 VECTOR_SEARCH_SCORE_THRESHOLD = 0.3
 
+# 检索结果(检索+rerank)缓存条数和过期秒数，条数为0表示关闭缓存
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", 1000))
+RETRIEVAL_CACHE_TTL = float(os.getenv("RETRIEVAL_CACHE_TTL", 3600))
+
+# 文件解析结果缓存（按文件内容sha256寻址）的目录和总大小上限(字节)，上限为0表示关闭缓存；解析逻辑变化时需要修改解析器版本号使旧缓存失效
+PARSE_CACHE_ROOT_PATH = os.getenv("PARSE_CACHE_ROOT_PATH", os.path.join(root_path, "QANY_DB", "parse_cache"))
+PARSE_CACHE_MAX_BYTES = int(os.getenv("PARSE_CACHE_MAX_BYTES", 10 * 1024 ** 3))
+PARSE_CACHE_PARSER_VERSION = os.getenv("PARSE_CACHE_PARSER_VERSION", "1")
+
 KB_SUFFIX = '_240625'
 # MILVUS_HOST_LOCAL = 'milvus-standalone-local'
 # MILVUS_PORT = 19530
 MILVUS_HOST_LOCAL = GATEWAY_IP
 MILVUS_PORT = 19540
 MILVUS_COLLECTION_NAME = 'qanything_collection' + KB_SUFFIX
+# milvus flush合并：未flush的行数达到阈值立即flush，否则在插入后等待窗口秒数再flush；入库完成置green之前是否先等待flush完成（读己之写）
+MILVUS_FLUSH_ROWS = int(os.getenv("MILVUS_FLUSH_ROWS", 10000))
+MILVUS_FLUSH_INTERVAL = float(os.getenv("MILVUS_FLUSH_INTERVAL", 60))
+MILVUS_FLUSH_BEFORE_GREEN = int(os.getenv("MILVUS_FLUSH_BEFORE_GREEN", 0))
 
 # ES_URL = 'http://es-container-local:9200/'
 ES_URL = f'http://{GATEWAY_IP}:9210/'
 ES_USER = None
 ES_PASSWORD = None
 ES_TOP_K = 30
+# 混合检索时milvus和es并发检索，各自的超时秒数；es超时则只使用向量检索结果
+MILVUS_SEARCH_TIMEOUT = float(os.getenv("MILVUS_SEARCH_TIMEOUT", 30))
+ES_SEARCH_TIMEOUT = float(os.getenv("ES_SEARCH_TIMEOUT", 3))
+# 混合检索结果的融合方式：rrf（按排名融合）、weighted（归一化分数加权）、none（直接拼接）
+HYBRID_FUSION_METHOD = os.getenv("HYBRID_FUSION_METHOD", "rrf")
+# 向量检索一路的权重，es一路为 1 - HYBRID_VECTOR_WEIGHT
+HYBRID_VECTOR_WEIGHT = float(os.getenv("HYBRID_VECTOR_WEIGHT", 0.5))
+RRF_K = int(os.getenv("RRF_K", 60))
+# 送入rerank的最大候选数，0表示不限制；请求里的rerank_top_n可以覆盖
+RERANK_MAX_CANDIDATES = int(os.getenv("RERANK_MAX_CANDIDATES", 0))
+# 文本token数缓存的条目数（按内容hash），用于prompt拼装时的token预算
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", 50000))
+# 每个worker对同一个LLM api_base的最大并发请求数
+LLM_MAX_CONCURRENCY_PER_BACKEND = int(os.getenv("LLM_MAX_CONCURRENCY_PER_BACKEND", 64))
+# 每个worker缓存的LLM客户端数（按api_base、api_key区分，二者来自请求参数），超过时按LRU淘汰并关闭连接池
+LLM_CLIENT_CACHE_SIZE = int(os.getenv("LLM_CLIENT_CACHE_SIZE", 16))
+# 流式调用时是否请求服务端在最后返回usage（stream_options.include_usage），部分OpenAI兼容服务不支持
+LLM_STREAM_INCLUDE_USAGE = os.getenv("LLM_STREAM_INCLUDE_USAGE", "false").lower() == "true"
 ES_INDEX_NAME = 'qanything_es_index' + KB_SUFFIX
 
 # MYSQL_HOST_LOCAL = 'mysql-container-local'
@@ -141,26 +172,75 @@ MYSQL_PORT_LOCAL = 3316
 MYSQL_USER_LOCAL = 'root'
 MYSQL_PASSWORD_LOCAL = '123456'
 MYSQL_DATABASE_LOCAL = 'qanything'
+# 父文档批量写入mysql时每次executemany的行数，整个文件在同一个事务中提交
+MYSQL_INSERT_DOCS_BATCH_SIZE = 200
 
 LOCAL_OCR_SERVICE_URL = "localhost:7001"
 
 LOCAL_PDF_PARSER_SERVICE_URL = "localhost:9009"
+# 页数不少于PDF_LAYOUT_SHARD_MIN_PAGES的pdf，版面检测按每PDF_LAYOUT_PAGES_PER_SHARD页一个分片分发给pdf解析服务的
+# 各个worker进程并发计算（仅在多worker时生效，0表示不分片）
+PDF_LAYOUT_SHARD_MIN_PAGES = int(os.getenv("PDF_LAYOUT_SHARD_MIN_PAGES", 32))
+PDF_LAYOUT_PAGES_PER_SHARD = int(os.getenv("PDF_LAYOUT_PAGES_PER_SHARD", 16))
+PDF_LAYOUT_SHARD_TIMEOUT = float(os.getenv("PDF_LAYOUT_SHARD_TIMEOUT", 600))
+# 页数不少于PDF_STREAM_MIN_PAGES的pdf使用流式解析：每PDF_STREAM_WINDOW_PAGES页一个窗口渲染、检测版面并截取表格/图片，
+# 窗口处理完即丢弃整页位图，只保留文本框等轻量信息用于跨页合并，内存峰值不再随页数增长（0表示关闭流式解析）
+PDF_STREAM_WINDOW_PAGES = int(os.getenv("PDF_STREAM_WINDOW_PAGES", 8))
+PDF_STREAM_MIN_PAGES = int(os.getenv("PDF_STREAM_MIN_PAGES", 16))
+# 版面检测模型每次推理的图片数，以及CPU推理时onnxruntime的算子内/算子间线程数（0表示使用onnxruntime默认值）
+PDF_LAYOUT_BATCH_SIZE = int(os.getenv("PDF_LAYOUT_BATCH_SIZE", 8))
+PDF_LAYOUT_INTRA_OP_THREADS = int(os.getenv("PDF_LAYOUT_INTRA_OP_THREADS", 0))
+PDF_LAYOUT_INTER_OP_THREADS = int(os.getenv("PDF_LAYOUT_INTER_OP_THREADS", 0))
+# pdf中文字层不可用的页面（扫描件）才走OCR：文字层有效字符少于PDF_OCR_MIN_TEXT_CHARS，且图片覆盖页面面积的比例
+# 不低于PDF_OCR_MIN_IMAGE_COVERAGE；这些页面以PDF_OCR_CONCURRENCY的并发发给OCR服务（0表示不做OCR）
+PDF_OCR_MIN_TEXT_CHARS = int(os.getenv("PDF_OCR_MIN_TEXT_CHARS", 10))
+PDF_OCR_MIN_IMAGE_COVERAGE = float(os.getenv("PDF_OCR_MIN_IMAGE_COVERAGE", 0.3))
+PDF_OCR_CONCURRENCY = int(os.getenv("PDF_OCR_CONCURRENCY", 4))
+PDF_OCR_TIMEOUT = float(os.getenv("PDF_OCR_TIMEOUT", 120))
+# 扫描页每PDF_OCR_BATCH_PAGES页合成一个/ocr/batch请求，同一请求内各页的文本行共享识别batch
+PDF_OCR_BATCH_PAGES = int(os.getenv("PDF_OCR_BATCH_PAGES", 4))
+# OCR服务每个worker中执行模型推理的线程数，/ocr/batch单次请求最多接收的图片数
+OCR_EXECUTOR_WORKERS = int(os.getenv("OCR_EXECUTOR_WORKERS", 1))
+OCR_BATCH_MAX_IMAGES = int(os.getenv("OCR_BATCH_MAX_IMAGES", 64))
+
+# embedding/rerank客户端共享的aiohttp连接池：总连接数上限，单host连接数上限，keep-alive秒数
+HTTP_CLIENT_LIMIT = int(os.getenv("HTTP_CLIENT_LIMIT", 100))
+HTTP_CLIENT_LIMIT_PER_HOST = int(os.getenv("HTTP_CLIENT_LIMIT_PER_HOST", 32))
+HTTP_CLIENT_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_CLIENT_KEEPALIVE_TIMEOUT", 60))
 
 LOCAL_RERANK_SERVICE_URL = "localhost:8001"
+LOCAL_RERANK_REQUEST_TIMEOUT = float(os.getenv("LOCAL_RERANK_REQUEST_TIMEOUT", 30))
 LOCAL_RERANK_MODEL_NAME = 'rerank'
 LOCAL_RERANK_MAX_LENGTH = 512
 LOCAL_RERANK_BATCH = 1
 LOCAL_RERANK_THREADS = 1
+# 推理时padding到该值的整数倍（不超过max_length），减少输入形状种类，0表示不做对齐
+LOCAL_RERANK_PAD_TO_MULTIPLE_OF = int(os.getenv("LOCAL_RERANK_PAD_TO_MULTIPLE_OF", 32))
 LOCAL_RERANK_PATH = os.path.join(root_path, 'qanything_kernel/dependent_server/rerank_server', 'rerank_model_configs_v0.0.1')
 LOCAL_RERANK_MODEL_PATH = os.path.join(LOCAL_RERANK_PATH, "rerank.onnx")
 
 LOCAL_EMBED_SERVICE_URL = "localhost:9001"
+LOCAL_EMBED_REQUEST_TIMEOUT = float(os.getenv("LOCAL_EMBED_REQUEST_TIMEOUT", 60))
 LOCAL_EMBED_MODEL_NAME = 'embed'
 LOCAL_EMBED_MAX_LENGTH = 512
 LOCAL_EMBED_BATCH = 1
 LOCAL_EMBED_THREADS = 1
+LOCAL_EMBED_PAD_TO_MULTIPLE_OF = int(os.getenv("LOCAL_EMBED_PAD_TO_MULTIPLE_OF", 32))
+# embedding服务端动态batch：单batch最多条数，单batch padding后最多token数，攒batch最长等待毫秒数
+LOCAL_EMBED_MAX_BATCH_SIZE = int(os.getenv("LOCAL_EMBED_MAX_BATCH_SIZE", 32))
+LOCAL_EMBED_MAX_BATCH_TOKENS = int(os.getenv("LOCAL_EMBED_MAX_BATCH_TOKENS", 8192))
+LOCAL_EMBED_MAX_WAIT_MS = float(os.getenv("LOCAL_EMBED_MAX_WAIT_MS", 5))
 LOCAL_EMBED_PATH = os.path.join(root_path, 'qanything_kernel/dependent_server/embedding_server', 'embedding_model_configs_v0.0.1')
 LOCAL_EMBED_MODEL_PATH = os.path.join(LOCAL_EMBED_PATH, "embed.onnx")
+# 客户端向量缓存：最大条数（每个进程一份，1024维约4KB一条），过期秒数(<=0表示不过期)，落盘路径(为空则只缓存在内存)
+# 入库流水线只读缓存不写入，避免大量文档chunk把重复查询的向量挤出去
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", 20000))
+EMBED_CACHE_TTL = float(os.getenv("EMBED_CACHE_TTL", 7 * 24 * 3600))
+EMBED_CACHE_PERSIST_PATH = os.getenv("EMBED_CACHE_PERSIST_PATH", "")
+# 入库向量去重：本地向量缓存未命中时是否按(模型版本, 归一化文本)的hash复用milvus中已入库的向量，单次查询的key数，查询超时秒数
+EMBED_DEDUPE_MILVUS = int(os.getenv("EMBED_DEDUPE_MILVUS", 1))
+EMBED_DEDUPE_LOOKUP_BATCH = int(os.getenv("EMBED_DEDUPE_LOOKUP_BATCH", 256))
+EMBED_DEDUPE_LOOKUP_TIMEOUT = float(os.getenv("EMBED_DEDUPE_LOOKUP_TIMEOUT", 5))
 
 TOKENIZER_PATH = os.path.join(root_path, 'qanything_kernel/connector/llm/tokenizer_files')
 
@@ -169,6 +249,29 @@ DEFAULT_PARENT_CHUNK_SIZE = 800
 SEPARATORS = ["\n\n", "\n", "。", "，", ",", ".", ""]
 MAX_CHARS = 1000000  # 单个文件最大字符数，超过此字符数将上传失败，改大可能会导致解析超时
 
+# 入库任务队列：每个insert worker同时在流水线中处理的文件数
+INSERT_CONCURRENCY_PER_WORKER = int(os.getenv("INSERT_CONCURRENCY_PER_WORKER", 6))
+# 入库流水线各阶段（解析、切分、向量化、写入）的并发数，以及阶段之间队列的长度（队列满时上游阻塞，形成背压）
+INSERT_PARSE_CONCURRENCY = int(os.getenv("INSERT_PARSE_CONCURRENCY", 2))
+INSERT_SPLIT_CONCURRENCY = int(os.getenv("INSERT_SPLIT_CONCURRENCY", 1))
+INSERT_EMBED_CONCURRENCY = int(os.getenv("INSERT_EMBED_CONCURRENCY", 2))
+INSERT_STORE_CONCURRENCY = int(os.getenv("INSERT_STORE_CONCURRENCY", 2))
+INSERT_STAGE_QUEUE_SIZE = int(os.getenv("INSERT_STAGE_QUEUE_SIZE", 2))
+# 领取文件后的租约秒数，处理期间每INSERT_HEARTBEAT_SECONDS续约一次，租约过期的yellow文件会被重新入队
+INSERT_LEASE_SECONDS = int(os.getenv("INSERT_LEASE_SECONDS", 120))
+INSERT_HEARTBEAT_SECONDS = int(os.getenv("INSERT_HEARTBEAT_SECONDS", 30))
+# 同一个文件最多被领取的次数，超过后置为red
+INSERT_MAX_ATTEMPTS = int(os.getenv("INSERT_MAX_ATTEMPTS", 3))
+# 是否优先处理小文件
+INSERT_SMALL_FILE_FIRST = os.getenv("INSERT_SMALL_FILE_FIRST", "false").lower() == "true"
+# 队列为空时轮询间隔逐步退避的上限（秒）
+INSERT_POLL_MAX_INTERVAL = float(os.getenv("INSERT_POLL_MAX_INTERVAL", 5))
+# 后台删除服务：单批最多合并处理的删除任务数，租约秒数，最大尝试次数，队列为空时轮询间隔退避上限（秒）
+DELETE_BATCH_SIZE = int(os.getenv("DELETE_BATCH_SIZE", 500))
+DELETE_LEASE_SECONDS = int(os.getenv("DELETE_LEASE_SECONDS", 600))
+DELETE_MAX_ATTEMPTS = int(os.getenv("DELETE_MAX_ATTEMPTS", 5))
+DELETE_POLL_MAX_INTERVAL = float(os.getenv("DELETE_POLL_MAX_INTERVAL", 5))
+
 # llm_config = {
 #     # 回答的最大token数，一般来说对于国内模型一个中文不到1个token，国外模型一个中文1.5-2个token
 #     "max_token": 512,
@@ -126,7 +126,8 @@ class KnowledgeBaseManager:
                 kb_name VARCHAR(255),
                 deleted BOOL DEFAULT 0,
                 latest_qa_time TIMESTAMP,
-                latest_insert_time TIMESTAMP
+                latest_insert_time TIMESTAMP,
+                version INT DEFAULT 0
             );
 
         """
@@ -233,6 +234,36 @@ class KnowledgeBaseManager:
         """
         self.execute_query_(query, (), commit=True)
 
+        # 后台删除任务：file_id为空表示删除整个知识库，stage记录已完成的步骤（milvus、es、mysql、磁盘），重启后接着做
+        query = """
+            CREATE TABLE IF NOT EXISTS DeleteTasks (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                user_id VARCHAR(255) NOT NULL,
+                kb_id VARCHAR(255) NOT NULL,
+                file_id VARCHAR(255) DEFAULT NULL,
+                status VARCHAR(16) DEFAULT 'pending',
+                stage INT DEFAULT 0,
+                attempts INT DEFAULT 0,
+                lease_owner VARCHAR(255) DEFAULT NULL,
+                lease_expire DATETIME DEFAULT NULL,
+                msg VARCHAR(1024) DEFAULT '',
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                INDEX idx_status (status)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """
+        self.execute_query_(query, (), commit=True)
+
+        # 多个入库worker协调milvus flush：flush租约，最近一次完成的flush的开始时间（unix时间戳）
+        query = """
+            CREATE TABLE IF NOT EXISTS MilvusFlush (
+                collection_name VARCHAR(255) PRIMARY KEY,
+                lease_owner VARCHAR(255) DEFAULT NULL,
+                lease_expire DATETIME DEFAULT NULL,
+                last_flush_start DOUBLE DEFAULT 0
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """
+        self.execute_query_(query, (), commit=True)
+
         query = """
             CREATE TABLE IF NOT EXISTS QanythingBot (
                 id INT AUTO_INCREMENT PRIMARY KEY,
@@ -262,6 +293,13 @@ class KnowledgeBaseManager:
             # 如果没有的话，给QanythingBot添加一列：llm_setting VARCHAR(512)
             "ALTER TABLE QanythingBot ADD COLUMN llm_setting VARCHAR(512) DEFAULT '{}'",
             "ALTER TABLE QanythingBot DROP COLUMN model",
+            # 知识库版本号，文件入库/删除时递增，用于检索结果缓存失效
+            "ALTER TABLE KnowledgeBase ADD COLUMN version INT DEFAULT 0",
+            # 入库任务队列：领取文件的worker、租约过期时间、尝试次数
+            "ALTER TABLE File ADD COLUMN lease_owner VARCHAR(255) DEFAULT NULL",
+            "ALTER TABLE File ADD COLUMN lease_expire DATETIME DEFAULT NULL",
+            "ALTER TABLE File ADD COLUMN attempts INT DEFAULT 0",
+            "CREATE INDEX idx_status_deleted ON File (status, deleted)",
         ]
 
         for query in index_queries:
@@ -428,6 +466,23 @@ class KnowledgeBaseManager:
         query = """UPDATE File SET deleted = 1 WHERE kb_id IN ({}) AND kb_id IN (SELECT kb_id FROM KnowledgeBase WHERE user_id = %s)""".format(
             kb_ids_str)
         self.execute_query_(query, (user_id,), commit=True)
+        self.bump_kb_version(kb_ids)
+
+    # [知识库] 知识库内容发生变化（文件入库完成、删除文件等）时递增版本号
+    def bump_kb_version(self, kb_ids):
+        if not kb_ids:
+            return
+        placeholders = ','.join(['%s'] * len(kb_ids))
+        query = "UPDATE KnowledgeBase SET version = version + 1 WHERE kb_id IN ({})".format(placeholders)
+        self.execute_query_(query, list(kb_ids), commit=True)
+
+    def get_kb_versions(self, kb_ids) -> Dict[str, int]:
+        if not kb_ids:
+            return {}
+        placeholders = ','.join(['%s'] * len(kb_ids))
+        query = "SELECT kb_id, version FROM KnowledgeBase WHERE kb_id IN ({})".format(placeholders)
+        result = self.execute_query_(query, list(kb_ids), fetch=True)
+        return {kb_id: version for kb_id, version in result} if result else {}
 
     # [知识库] 重命名知识库
     def rename_knowledge_base(self, user_id, kb_id, kb_name):
@@ -563,6 +618,78 @@ class KnowledgeBaseManager:
         query = "UPDATE File SET deleted = 1 WHERE kb_id = %s AND file_id IN ({})".format(file_ids_str)
         debug_logger.info("delete_files: {}".format(file_ids))
         self.execute_query_(query, (kb_id,), commit=True)
+        self.bump_kb_version([kb_id])
+
+    # [milvus flush] 领取集合的flush租约，成功返回True，被其他worker持有返回False，数据库异常返回None
+    def acquire_milvus_flush(self, collection_name, owner, lease_seconds):
+        self.execute_query_("INSERT IGNORE INTO MilvusFlush (collection_name) VALUES (%s)", (collection_name,),
+                            commit=True)
+        query = """UPDATE MilvusFlush SET lease_owner = %s, lease_expire = DATE_ADD(NOW(), INTERVAL %s SECOND)
+                   WHERE collection_name = %s AND (lease_owner IS NULL OR lease_expire < NOW())"""
+        res = self.execute_query_(query, (owner, lease_seconds, collection_name), commit=True, check=True)
+        return None if res is None else res == 1
+
+    # [milvus flush] 释放租约，flush成功时记录这次flush的开始时间
+    def release_milvus_flush(self, collection_name, owner, flush_start=None):
+        if flush_start is None:
+            query = """UPDATE MilvusFlush SET lease_owner = NULL, lease_expire = NULL
+                       WHERE collection_name = %s AND lease_owner = %s"""
+            self.execute_query_(query, (collection_name, owner), commit=True)
+        else:
+            query = """UPDATE MilvusFlush SET lease_owner = NULL, lease_expire = NULL,
+                       last_flush_start = GREATEST(last_flush_start, %s)
+                       WHERE collection_name = %s AND lease_owner = %s"""
+            self.execute_query_(query, (flush_start, collection_name, owner), commit=True)
+
+    # [milvus flush] 最近一次完成的flush的开始时间，没有记录或数据库异常时返回0
+    def get_milvus_last_flush(self, collection_name):
+        query = "SELECT last_flush_start FROM MilvusFlush WHERE collection_name = %s"
+        result = self.execute_query_(query, (collection_name,), fetch=True)
+        return float(result[0][0]) if result else 0.0
+
+    # [删除任务] 登记删除意图，由入库服务中的后台删除服务合并批量执行；file_ids为None表示删除整个知识库
+    def add_delete_tasks(self, user_id, kb_id, file_ids=None, batch_size=500):
+        """登记删除任务，返回是否全部写入成功；失败时调用方需要报错，否则删除请求会丢失"""
+        query = "INSERT INTO DeleteTasks (user_id, kb_id, file_id) VALUES (%s, %s, %s)"
+        if file_ids is None:
+            return self.execute_query_(query, (user_id, kb_id, None), commit=True, check=True) is not None
+        for i in range(0, len(file_ids), batch_size):
+            rows = [(user_id, kb_id, file_id) for file_id in file_ids[i:i + batch_size]]
+            values = ','.join(['(%s, %s, %s)'] * len(rows))
+            params = [v for row in rows for v in row]
+            res = self.execute_query_(
+                "INSERT INTO DeleteTasks (user_id, kb_id, file_id) VALUES {}".format(values), params, commit=True,
+                check=True)
+            if res is None:
+                debug_logger.error(f"add_delete_tasks failed: {kb_id}, files: {len(file_ids)}")
+                return False
+        debug_logger.info(f"add_delete_tasks: {kb_id}, files: {len(file_ids)}")
+        return True
+
+    # [删除任务] 知识库下的全部文件id（包括已经逻辑删除的）
+    def get_kb_file_ids(self, kb_id):
+        query = "SELECT file_id FROM File WHERE kb_id = %s"
+        result = self.execute_query_(query, (kb_id,), fetch=True)
+        if result is None:
+            raise RuntimeError(f"get kb file ids failed: {kb_id}")
+        return [row[0] for row in result]
+
+    # [删除任务] 批量删除文件的父文档，doc_id形如file_id_i
+    def delete_documents_batch(self, file_ids, batch_size=100):
+        total_deleted = 0
+        for i in range(0, len(file_ids), batch_size):
+            batch_file_ids = file_ids[i:i + batch_size]
+            conditions = ' OR '.join(['doc_id LIKE %s'] * len(batch_file_ids))
+            query = "DELETE FROM Documents WHERE {}".format(conditions)
+            # LIKE中的_是单字符通配符，需要转义，否则会误删doc_id形如file_idX...的父文档
+            patterns = [file_id.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '\\_%'
+                        for file_id in batch_file_ids]
+            res = self.execute_query_(query, patterns, commit=True, check=True)
+            if res is None:
+                raise RuntimeError(f"delete documents failed: {batch_file_ids[0]}...")
+            total_deleted += res
+        debug_logger.info(f"delete_documents_batch files: {len(file_ids)}, documents: {total_deleted}")
+        return total_deleted
 
     def add_document(self, doc_id, json_data):
         json_data = json.dumps(json_data, ensure_ascii=False)
@@ -570,6 +697,40 @@ class KnowledgeBaseManager:
         query = "INSERT IGNORE INTO Documents (doc_id, json_data) VALUES (%s, %s)"
         self.execute_query_(query, (doc_id, json_data), commit=True, check=True)
 
+    def add_documents(self, doc_id_jsons, batch_size=200):
+        # 批量写入父文档：一个连接、一个事务内分批executemany，最后只提交一次
+        if not doc_id_jsons:
+            return 0
+        rows = [(doc_id, json.dumps(json_data, ensure_ascii=False)) for doc_id, json_data in doc_id_jsons]
+        query = "INSERT IGNORE INTO Documents (doc_id, json_data) VALUES (%s, %s)"
+        try:
+            conn = self.cnxpool.get_connection()
+        except MySQLError as err:
+            debug_logger.error("从连接池获取连接失败：{}".format(err))
+            raise
+        self.used_cnx += 1
+        self.free_cnx -= 1
+        total_inserted = 0
+        cursor = None
+        try:
+            cursor = conn.cursor()
+            for i in range(0, len(rows), batch_size):
+                cursor.executemany(query, rows[i:i + batch_size])
+                total_inserted += cursor.rowcount
+            conn.commit()
+        except MySQLError as err:
+            insert_logger.error("批量写入Documents失败，回滚：{}".format(err))
+            conn.rollback()
+            raise
+        finally:
+            if cursor is not None:
+                cursor.close()
+            conn.close()
+            self.used_cnx -= 1
+            self.free_cnx += 1
+        insert_logger.info(f"add_documents: {len(rows)}, inserted: {total_inserted}, batch_size: {batch_size}")
+        return total_inserted
+
     def update_document(self, doc_id, update_content):
         ori_doc_json = self.get_document_by_doc_id(doc_id)
         ori_doc_json['kwargs']['page_content'] = update_content
@@ -628,6 +789,32 @@ class KnowledgeBaseManager:
             debug_logger.error(f"get_document: doc_id: {doc_id} not found")
             return None
 
+    def get_documents_by_doc_ids(self, doc_ids, batch_size=100) -> List[Optional[Dict]]:
+        # 一次IN查询批量获取，返回结果与doc_ids顺序一致，不存在的doc_id对应None
+        if not doc_ids:
+            return []
+        unique_doc_ids = list(dict.fromkeys(doc_ids))
+        json_data_map = {}
+        for i in range(0, len(unique_doc_ids), batch_size):
+            batch_doc_ids = unique_doc_ids[i:i + batch_size]
+            placeholders = ','.join(['%s'] * len(batch_doc_ids))
+            query = "SELECT doc_id, json_data FROM Documents WHERE doc_id IN ({})".format(placeholders)
+            doc_all = self.execute_query_(query, batch_doc_ids, fetch=True)
+            if not doc_all:
+                continue
+            for doc_id, json_data in doc_all:
+                json_data_map[doc_id] = json_data
+
+        docs = []
+        for doc_id in doc_ids:
+            json_data = json_data_map.get(doc_id)
+            if json_data is None:
+                debug_logger.error(f"get_documents: doc_id: {doc_id} not found")
+                docs.append(None)
+            else:
+                docs.append(json.loads(json_data))
+        return docs
+
     def get_faq(self, faq_id) -> tuple:
         query = "SELECT user_id, kb_id, question, answer, nos_keys FROM Faqs WHERE faq_id = %s"
         faq_all = self.execute_query_(query, (faq_id,), fetch=True)
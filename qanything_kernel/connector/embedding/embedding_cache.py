@@ -0,0 +1,132 @@
+from collections import OrderedDict
+from typing import List, Optional, Dict
+from qanything_kernel.utils.custom_log import debug_logger
+from array import array
+import unicodedata
+import threading
+import hashlib
+import sqlite3
+import time
+import os
+
+
+def normalize_text(text: str) -> str:
+    # 只做不影响语义的归一化：unicode NFC + 去掉首尾空白
+    return unicodedata.normalize('NFC', text).strip()
+
+
+def embedding_cache_key(model_version: str, text: str) -> str:
+    return hashlib.sha256(f"{model_version}\x00{normalize_text(text)}".encode('utf-8')).hexdigest()
+
+
+class EmbeddingLRUCache:
+    """
+    进程内的向量缓存，key为(模型版本, 归一化文本)的sha256，LRU淘汰 + TTL过期，可选落盘到sqlite。
+    内存中的向量存成array('f')（每维4字节，list[float]每维要30字节左右），取出时再转回list
+    """
+
+    def __init__(self, capacity: int, ttl: Optional[float] = None, persist_path: Optional[str] = None):
+        self.capacity = capacity
+        self.ttl = ttl if ttl and ttl > 0 else None
+        self.cache = OrderedDict()  # key -> (timestamp, array('f'))
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.persist_path = persist_path
+        self.db = None
+        if persist_path:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(persist_path)), exist_ok=True)
+                self.db = sqlite3.connect(persist_path, check_same_thread=False)
+                self.db.execute("PRAGMA journal_mode=WAL")
+                self.db.execute("PRAGMA synchronous=OFF")
+                self.db.execute("CREATE TABLE IF NOT EXISTS embeddings "
+                                "(key TEXT PRIMARY KEY, ts REAL, dim INTEGER, vec BLOB)")
+                self.db.commit()
+                debug_logger.info(f"embedding cache persist to: {persist_path}")
+            except sqlite3.Error as e:
+                debug_logger.error(f"open embedding cache db {persist_path} failed, fallback to memory only: {e}")
+                self.db = None
+
+    @property
+    def persistent(self) -> bool:
+        return self.db is not None
+
+    def _expired(self, ts: float) -> bool:
+        return self.ttl is not None and time.time() - ts > self.ttl
+
+    def _get_from_db(self, key: str) -> Optional[array]:
+        row = self.db.execute("SELECT ts, vec FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        ts, vec = row
+        if self._expired(ts):
+            self.db.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+            return None
+        embedding = array('f')
+        embedding.frombytes(vec)
+        return embedding
+
+    def _put_memory(self, key: str, embedding: array, ts: float):
+        self.cache[key] = (ts, embedding)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+
+    def get_many(self, keys: List[str]) -> List[Optional[List[float]]]:
+        results = []
+        with self.lock:
+            for key in keys:
+                item = self.cache.get(key)
+                embedding = None
+                if item is not None:
+                    ts, embedding = item
+                    if self._expired(ts):
+                        self.cache.pop(key)
+                        embedding = None
+                    else:
+                        # 移动到最末尾表示最近使用
+                        self.cache.move_to_end(key)
+                if embedding is None and self.db is not None:
+                    try:
+                        embedding = self._get_from_db(key)
+                    except sqlite3.Error as e:
+                        debug_logger.error(f"read embedding cache db failed: {e}")
+                    if embedding is not None:
+                        self._put_memory(key, embedding, time.time())
+                if embedding is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    embedding = embedding.tolist()
+                results.append(embedding)
+        return results
+
+    def put_many(self, keys: List[str], embeddings: List[List[float]]):
+        now = time.time()
+        vecs = [array('f', embedding) for embedding in embeddings]
+        with self.lock:
+            for key, vec in zip(keys, vecs):
+                self._put_memory(key, vec, now)
+            if self.db is not None:
+                try:
+                    rows = [(key, now, len(vec), vec.tobytes()) for key, vec in zip(keys, vecs)]
+                    self.db.executemany("INSERT OR REPLACE INTO embeddings (key, ts, dim, vec) VALUES (?, ?, ?, ?)",
+                                        rows)
+                    self.db.commit()
+                except sqlite3.Error as e:
+                    debug_logger.error(f"write embedding cache db failed: {e}")
+
+    def stats(self) -> Dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': round(self.hits / total, 4) if total else 0.0,
+                    'size': len(self.cache), 'capacity': self.capacity}
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            if self.db is not None:
+                self.db.execute("DELETE FROM embeddings")
+                self.db.commit()
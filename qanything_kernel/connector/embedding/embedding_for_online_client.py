@@ -1,15 +1,30 @@
 """Wrapper around YouDao embedding models."""
-from typing import List
+from typing import List, Optional, Dict, Callable, Awaitable
 from qanything_kernel.utils.custom_log import debug_logger, embed_logger
 from qanything_kernel.utils.general_utils import get_time_async, get_time
 from langchain_core.embeddings import Embeddings
-from qanything_kernel.configs.model_config import LOCAL_EMBED_SERVICE_URL, LOCAL_RERANK_BATCH
+from qanything_kernel.connector.embedding.embedding_cache import EmbeddingLRUCache, embedding_cache_key
+from qanything_kernel.connector.http_session import get_client_session
+from qanything_kernel.configs.model_config import LOCAL_EMBED_SERVICE_URL, LOCAL_RERANK_BATCH, EMBED_CACHE_SIZE, \
+    EMBED_CACHE_TTL, EMBED_CACHE_PERSIST_PATH, LOCAL_EMBED_REQUEST_TIMEOUT
 import traceback
 import aiohttp
 import asyncio
 import requests
 
 
+# 同一进程内所有YouDaoEmbeddings实例共享一份向量缓存
+_embedding_cache = None
+
+
+def get_embedding_cache():
+    global _embedding_cache
+    if _embedding_cache is None and EMBED_CACHE_SIZE > 0:
+        _embedding_cache = EmbeddingLRUCache(EMBED_CACHE_SIZE, ttl=EMBED_CACHE_TTL,
+                                             persist_path=EMBED_CACHE_PERSIST_PATH or None)
+    return _embedding_cache
+
+
 def _process_query(query):
     return '\n'.join([line for line in query.split('\n') if
                       not line.strip().startswith('![figure]') and
@@ -21,28 +36,99 @@ class YouDaoEmbeddings(Embeddings):
         self.model_version = 'local_v20240725'
         self.url = f"http://{LOCAL_EMBED_SERVICE_URL}/embedding"
         self.session = requests.Session()
+        self.timeout = aiohttp.ClientTimeout(total=LOCAL_EMBED_REQUEST_TIMEOUT)
         super().__init__()
 
     async def _get_embedding_async(self, session, queries):
         data = {'texts': queries}
-        async with session.post(self.url, json=data) as response:
+        async with session.post(self.url, json=data, timeout=self.timeout) as response:
             return await response.json()
 
-    @get_time_async
-    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+    def _lookup_cache(self, texts: List[str]):
+        """返回(缓存命中结果, 需要请求的去重文本, 每条文本的key)"""
+        cache = get_embedding_cache()
+        keys = [embedding_cache_key(self.model_version, text) for text in texts]
+        cached = cache.get_many(keys) if cache is not None else [None] * len(texts)
+        miss_texts = {}
+        for key, text, embedding in zip(keys, texts, cached):
+            if embedding is None and key not in miss_texts:
+                miss_texts[key] = text
+        return cached, miss_texts, keys
+
+    def _merge_cache(self, cached, miss_texts, keys, miss_embeddings, reused=None, write_cache=True):
+        if len(miss_embeddings) != len(miss_texts):
+            raise ValueError(f'embedding server returned {len(miss_embeddings)} embeddings for '
+                             f'{len(miss_texts)} texts')
+        miss_map = dict(zip(miss_texts.keys(), miss_embeddings))
+        if reused:
+            miss_map.update(reused)
+        cache = get_embedding_cache()
+        if cache is not None and miss_map and write_cache:
+            cache.put_many(list(miss_map.keys()), list(miss_map.values()))
+        return [embedding if embedding is not None else miss_map[key] for key, embedding in zip(keys, cached)]
+
+    @staticmethod
+    async def _run_cache_io(func, *args):
+        """缓存落盘到sqlite时读写会访问磁盘，放到线程池执行，避免阻塞事件循环；只有内存缓存时直接执行"""
+        cache = get_embedding_cache()
+        if cache is not None and cache.persistent:
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
+
+    async def _aembed_uncached(self, texts: List[str]) -> List[List[float]]:
         batch_size = LOCAL_RERANK_BATCH  # 增大客户端批处理大小
         # 向上取整
         embed_logger.info(f'embedding texts number: {len(texts) / batch_size}')
         all_embeddings = []
-        async with aiohttp.ClientSession() as session:
-            tasks = [self._get_embedding_async(session, texts[i:i + batch_size])
-                     for i in range(0, len(texts), batch_size)]
-            results = await asyncio.gather(*tasks)
-            for result in results:
-                all_embeddings.extend(result)
+        session = get_client_session()
+        tasks = [self._get_embedding_async(session, texts[i:i + batch_size])
+                 for i in range(0, len(texts), batch_size)]
+        results = await asyncio.gather(*tasks)
+        for i, result in enumerate(results):
+            # 服务出错时可能返回错误信息而不是向量列表
+            expected = len(texts[i * batch_size:(i + 1) * batch_size])
+            if not isinstance(result, list) or len(result) != expected:
+                raise ValueError(f'invalid embedding response for batch {i}, expected {expected} embeddings: '
+                                 f'{str(result)[:200]}')
+            all_embeddings.extend(result)
         debug_logger.info(f'success embedding number: {len(all_embeddings)}')
         return all_embeddings
 
+    @get_time_async
+    async def aembed_documents(self, texts: List[str], stats: Optional[Dict] = None,
+                               lookup: Optional[Callable[[List[str]], Awaitable[Dict[str, List[float]]]]] = None,
+                               write_cache: bool = True) -> List[List[float]]:
+        """
+        stats: 传入dict时填充去重统计（本地缓存命中、批内重复、外部复用、实际计算的条数）
+        lookup: 本地缓存未命中的key先交给lookup查找已有向量（如milvus中已入库的向量），返回key -> 向量
+        write_cache: 是否把新算出的向量写入缓存，入库时传False，避免文档chunk把重复查询的向量挤出缓存
+        """
+        cached, miss_texts, keys = await self._run_cache_io(self._lookup_cache, texts)
+        cache_hits = len(texts) - sum(1 for e in cached if e is None)
+        reused = {}
+        if miss_texts and lookup is not None:
+            try:
+                reused = await lookup(list(miss_texts.keys()))
+            except Exception as e:
+                embed_logger.warning(f'embedding lookup error, fallback to embedding server: {traceback.format_exc()}')
+                reused = {}
+        compute_texts = {key: text for key, text in miss_texts.items() if key not in reused}
+        if compute_texts:
+            miss_embeddings = await self._aembed_uncached(list(compute_texts.values()))
+        else:
+            miss_embeddings = []
+        embed_logger.info(f'embedding cache hit: {cache_hits}/{len(texts)}, reused: {len(reused)}, '
+                          f'computed: {len(compute_texts)}')
+        if stats is not None:
+            stats['embed_chunks'] = len(texts)
+            stats['embed_cache_hits'] = cache_hits
+            stats['embed_batch_duplicates'] = len(texts) - cache_hits - len(miss_texts)
+            stats['embed_reused'] = len(reused)
+            stats['embed_computed'] = len(compute_texts)
+            stats['embed_dedupe_hit_rate'] = round(1 - len(compute_texts) / len(texts), 4) if texts else 0.0
+        return await self._run_cache_io(self._merge_cache, cached, compute_texts, keys, miss_embeddings, reused,
+                                        write_cache)
+
     async def aembed_query(self, text: str) -> List[float]:
         return (await self.aembed_documents([text]))[0]
 
@@ -59,18 +145,34 @@ class YouDaoEmbeddings(Embeddings):
 
     # @get_time
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        return self._get_embedding_sync(texts)
+        texts = [_process_query(text) for text in texts]
+        cached, miss_texts, keys = self._lookup_cache(texts)
+        miss_embeddings = []
+        if miss_texts:
+            miss_embeddings = self._get_embedding_sync(list(miss_texts.values()))
+            if miss_embeddings is None:
+                return None
+            if len(miss_embeddings) != len(miss_texts):
+                debug_logger.error(f'sync embedding returned {len(miss_embeddings)} embeddings for '
+                                   f'{len(miss_texts)} texts')
+                return None
+        return self._merge_cache(cached, miss_texts, keys, miss_embeddings)
 
     @get_time
     def embed_query(self, text: str) -> List[float]:
         """Embed query text."""
         # return self._get_embedding([text])['embeddings'][0]
-        return self._get_embedding_sync([text])[0]
+        return self.embed_documents([text])[0]
 
     @property
     def embed_version(self):
         return self.model_version
 
+    @property
+    def cache_stats(self):
+        cache = get_embedding_cache()
+        return cache.stats() if cache is not None else {}
+
 # 使用示例
 # async def main():
 #     embedder = YouDaoEmbeddings()
@@ -0,0 +1,34 @@
+"""Long-lived aiohttp sessions shared by the embedding / rerank clients."""
+from qanything_kernel.utils.custom_log import debug_logger
+from qanything_kernel.configs.model_config import HTTP_CLIENT_LIMIT, HTTP_CLIENT_LIMIT_PER_HOST, \
+    HTTP_CLIENT_KEEPALIVE_TIMEOUT
+from typing import Optional
+import weakref
+import asyncio
+import aiohttp
+
+# 每个event loop一个session，aiohttp的session不能跨loop使用
+_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]" = weakref.WeakKeyDictionary()
+
+
+def get_client_session() -> aiohttp.ClientSession:
+    """获取当前event loop上的共享session，不存在或已关闭时惰性创建（keep-alive连接池）"""
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_CLIENT_LIMIT, limit_per_host=HTTP_CLIENT_LIMIT_PER_HOST,
+                                         keepalive_timeout=HTTP_CLIENT_KEEPALIVE_TIMEOUT, ttl_dns_cache=300)
+        session = aiohttp.ClientSession(connector=connector)
+        _sessions[loop] = session
+        debug_logger.info(f"create shared aiohttp session, limit: {HTTP_CLIENT_LIMIT}, "
+                          f"limit_per_host: {HTTP_CLIENT_LIMIT_PER_HOST}")
+    return session
+
+
+async def close_client_session(loop: Optional[asyncio.AbstractEventLoop] = None):
+    """关闭指定loop（默认当前loop）上的共享session，在server stop时调用"""
+    loop = loop or asyncio.get_running_loop()
+    session = _sessions.pop(loop, None)
+    if session is not None and not session.closed:
+        await session.close()
+        debug_logger.info("shared aiohttp session closed")
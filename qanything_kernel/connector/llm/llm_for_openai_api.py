@@ -1,15 +1,160 @@
 import traceback
-from openai import OpenAI
-from typing import List, Optional
+from openai import AsyncOpenAI
+from typing import List, Optional, Dict, Tuple
+from contextlib import asynccontextmanager
+import asyncio
+import weakref
 import json
 from qanything_kernel.connector.llm.base import AnswerResult
 from qanything_kernel.utils.custom_log import debug_logger
+from qanything_kernel.configs.model_config import TOKEN_COUNT_CACHE_SIZE, LLM_MAX_CONCURRENCY_PER_BACKEND, \
+    LLM_STREAM_INCLUDE_USAGE, LLM_CLIENT_CACHE_SIZE
+from collections import OrderedDict
+from functools import lru_cache
+import threading
+import hashlib
 import tiktoken
 
 
+@lru_cache(maxsize=64)
+def get_tokenizer(model):
+    """同一个模型的tiktoken编码只查找、加载一次，返回(tokenizer, 是否回退到cl100k_base)"""
+    try:
+        return tiktoken.encoding_for_model(model), False
+    except Exception as e:
+        debug_logger.warning(f"{model} not found in tiktoken, using cl100k_base!")
+        return tiktoken.get_encoding("cl100k_base"), True
+
+
+# 文本token数缓存，key为(编码名, 文本md5)，同一个chunk在不同请求、不同阶段只需编码一次
+_token_count_cache = OrderedDict()
+_token_count_lock = threading.Lock()
+
+
+def text_hash(text: str) -> str:
+    return hashlib.md5(text.encode('utf-8', errors='ignore')).hexdigest()
+
+
+def count_tokens(tokenizer, text: str, content_hash: Optional[str] = None) -> int:
+    key = (tokenizer.name, content_hash or text_hash(text))
+    with _token_count_lock:
+        num = _token_count_cache.get(key)
+        if num is not None:
+            _token_count_cache.move_to_end(key)
+            return num
+    num = len(tokenizer.encode(text, disallowed_special=()))
+    with _token_count_lock:
+        _token_count_cache[key] = num
+        while len(_token_count_cache) > TOKEN_COUNT_CACHE_SIZE:
+            _token_count_cache.popitem(last=False)
+    return num
+
+
+class LLMBackendCache:
+    """
+    单个event loop上按(api_base, api_key)缓存的AsyncOpenAI客户端，复用底层httpx连接池；
+    api_base和api_key来自请求参数，最多保留capacity个客户端，按LRU淘汰并关闭，
+    淘汰时仍有请求在用的客户端等这些请求结束后再关闭。
+    同一个api_base上的并发请求数用信号量限制，没有客户端、也没有请求占用的信号量一并清理。
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = max(capacity, 1)
+        self.clients: "OrderedDict[Tuple[str, str], AsyncOpenAI]" = OrderedDict()
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.client_users: Dict[AsyncOpenAI, int] = {}  # 客户端 -> 正在使用的请求数
+        self.base_users: Dict[str, int] = {}  # api_base -> 正在使用的请求数
+        self.retired = set()  # 已经淘汰、等待请求结束后关闭的客户端
+
+    async def acquire(self, api_base: str, api_key: str) -> AsyncOpenAI:
+        key = (api_base, api_key)
+        client = self.clients.get(key)
+        if client is None:
+            client = AsyncOpenAI(base_url=api_base, api_key=api_key)
+            self.clients[key] = client
+            debug_logger.info(f"create AsyncOpenAI client for {api_base}, cached clients: {len(self.clients)}")
+        self.clients.move_to_end(key)
+        self.client_users[client] = self.client_users.get(client, 0) + 1
+        self.base_users[api_base] = self.base_users.get(api_base, 0) + 1
+        while len(self.clients) > self.capacity:
+            (old_base, _), old_client = self.clients.popitem(last=False)
+            debug_logger.info(f"evict AsyncOpenAI client for {old_base}")
+            if old_client in self.client_users:
+                self.retired.add(old_client)
+            else:
+                await old_client.close()
+        self._drop_idle_semaphores()
+        return client
+
+    async def release(self, client: AsyncOpenAI, api_base: str):
+        self.client_users[client] -= 1
+        if self.client_users[client] == 0:
+            del self.client_users[client]
+            if client in self.retired:
+                self.retired.discard(client)
+                await client.close()
+        self.base_users[api_base] -= 1
+        if self.base_users[api_base] == 0:
+            del self.base_users[api_base]
+        self._drop_idle_semaphores()
+
+    def semaphore(self, api_base: str) -> asyncio.Semaphore:
+        if api_base not in self.semaphores:
+            self.semaphores[api_base] = asyncio.Semaphore(LLM_MAX_CONCURRENCY_PER_BACKEND)
+        return self.semaphores[api_base]
+
+    def _drop_idle_semaphores(self):
+        cached_bases = {api_base for api_base, _ in self.clients}
+        for api_base in list(self.semaphores):
+            if api_base not in cached_bases and api_base not in self.base_users:
+                del self.semaphores[api_base]
+
+    async def close(self):
+        clients = list(self.clients.values()) + list(self.retired)
+        self.clients.clear()
+        self.retired.clear()
+        self.semaphores.clear()
+        for client in clients:
+            await client.close()
+        return len(clients)
+
+
+_backends: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, LLMBackendCache]" = weakref.WeakKeyDictionary()
+
+
+def get_backend_cache() -> LLMBackendCache:
+    loop = asyncio.get_running_loop()
+    cache = _backends.get(loop)
+    if cache is None:
+        cache = _backends[loop] = LLMBackendCache(LLM_CLIENT_CACHE_SIZE)
+    return cache
+
+
+@asynccontextmanager
+async def llm_backend(api_base: str, api_key: str):
+    """获取缓存的客户端并占用api_base上的一个并发名额，退出时释放"""
+    cache = get_backend_cache()
+    client = await cache.acquire(api_base, api_key)
+    try:
+        async with cache.semaphore(api_base):
+            yield client
+    finally:
+        await cache.release(client, api_base)
+
+
+async def close_llm_clients(loop: Optional[asyncio.AbstractEventLoop] = None):
+    """关闭指定loop（默认当前loop）上缓存的所有LLM客户端，在server stop时调用"""
+    loop = loop or asyncio.get_running_loop()
+    cache = _backends.pop(loop, None)
+    closed = await cache.close() if cache is not None else 0
+    if closed:
+        debug_logger.info(f"closed {closed} AsyncOpenAI clients")
+
+
 class OpenAILLM:
     offcut_token: int = 50
     stop_words: Optional[List[str]] = None
+    usage: Optional[dict] = None  # 服务端返回的token用量，没有返回时为None
 
     def __init__(self, model, max_token, api_base, api_key, api_context_length, top_p, temperature):
         base_url = api_base
@@ -25,16 +170,11 @@ class OpenAILLM:
             self.top_p = top_p
         if temperature is not None:
             self.temperature = temperature
-        self.use_cl100k_base = False
-        try:
-            self.tokenizer = tiktoken.encoding_for_model(model)
-        except Exception as e:
-            debug_logger.warning(f"{model} not found in tiktoken, using cl100k_base!")
-            self.tokenizer = tiktoken.get_encoding("cl100k_base")
-            self.use_cl100k_base = True
+        self.tokenizer, self.use_cl100k_base = get_tokenizer(model)
 
-
-        self.client = OpenAI(base_url=base_url, api_key=api_key)
+        # 客户端在_call时按(api_base, api_key)从缓存中获取，不再每个请求新建
+        self.api_base = base_url
+        self.api_key = api_key
         debug_logger.info(f"OPENAI_API_KEY = {api_key}")
         debug_logger.info(f"OPENAI_API_BASE = {base_url}")
         debug_logger.info(f"OPENAI_API_MODEL_NAME = {self.model}")
@@ -47,6 +187,13 @@ class OpenAILLM:
     def _llm_type(self) -> str:
         return "using OpenAI API serve as LLM backend"
 
+    def _with_margin(self, total_tokens):
+        if self.use_cl100k_base:
+            total_tokens *= 1.2
+        else:
+            total_tokens *= 1.1  # 保留一定余量，由于metadata信息的嵌入导致token比计算的会多一些
+        return int(total_tokens)
+
     # 定义函数 num_tokens_from_messages，该函数返回由一组消息所使用的token数
     def num_tokens_from_messages(self, messages):
         total_tokens = 0
@@ -56,67 +203,96 @@ class OpenAILLM:
                 for key, value in message.items():
                     total_tokens += 3  # role的开销(key的开销)
                     if isinstance(value, str):
-                        tokens = self.tokenizer.encode(value, disallowed_special=())
-                        total_tokens += len(tokens)
+                        total_tokens += count_tokens(self.tokenizer, value)
             elif isinstance(message, str):
                 # 对于字符串类型的消息，直接编码
-                tokens = self.tokenizer.encode(message, disallowed_special=())
-                total_tokens += len(tokens)
+                total_tokens += count_tokens(self.tokenizer, message)
             else:
                 raise ValueError(f"Unsupported message type: {type(message)}")
-        if self.use_cl100k_base:
-            total_tokens *= 1.2
-        else:
-            total_tokens *= 1.1  # 保留一定余量，由于metadata信息的嵌入导致token比计算的会多一些
-        return int(total_tokens)
+        return self._with_margin(total_tokens)
+
+    def num_tokens_from_doc(self, doc):
+        """单个文档的原始token数（不含余量），连同内容hash记录在metadata['token_nums']里，
+        page_content被改写过（hash不一致）时重新计算"""
+        content_hash = text_hash(doc.page_content)
+        token_nums = doc.metadata.get('token_nums')
+        if not isinstance(token_nums, dict) or token_nums.get('content_hash') != content_hash:
+            token_nums = {'content_hash': content_hash}
+        num = token_nums.get(self.tokenizer.name)
+        if num is None:
+            num = count_tokens(self.tokenizer, doc.page_content, content_hash)
+            token_nums[self.tokenizer.name] = num
+            doc.metadata['token_nums'] = token_nums
+        return num
 
     def num_tokens_from_docs(self, docs):
-        total_tokens = 0
-        for doc in docs:
-            # 对每个文本进行分词
-            tokens = self.tokenizer.encode(doc.page_content, disallowed_special=())
-            # 累加tokens数量
-            total_tokens += len(tokens)
-        if self.use_cl100k_base:
-            total_tokens *= 1.2
-        else:
-            total_tokens *= 1.1  # 保留一定余量，由于metadata信息的嵌入导致token比计算的会多一些
-        return int(total_tokens)
+        total_tokens = sum(self.num_tokens_from_doc(doc) for doc in docs)
+        return self._with_margin(total_tokens)
 
-    async def _call(self, messages: List[dict], streaming: bool = False) -> str:
+    async def _pump_stream(self, messages: List[dict], queue: asyncio.Queue):
+        """在后台任务中读取上游的流式响应放入队列，读完即释放并发名额，下游消费慢时不会一直占用"""
         try:
-
-            if streaming:
-                response = self.client.chat.completions.create(
+            async with llm_backend(self.api_base, self.api_key) as client:
+                extra_kwargs = {}
+                if LLM_STREAM_INCLUDE_USAGE:
+                    # 需要服务端支持stream_options，最后一个chunk的choices为空，只带usage
+                    extra_kwargs['stream_options'] = {"include_usage": True}
+                response = await client.chat.completions.create(
                     model=self.model,
                     messages=messages,
                     stream=True,
                     max_tokens=self.max_token,
                     temperature=self.temperature,
                     top_p=self.top_p,
-                    stop=self.stop_words
+                    stop=self.stop_words,
+                    **extra_kwargs
                 )
-                for event in response:
-                    if not isinstance(event, dict):
-                        event = event.model_dump()
+                async for event in response:
+                    queue.put_nowait(event)
+            queue.put_nowait(None)
+        except Exception as e:
+            queue.put_nowait(e)
 
-                    if isinstance(event['choices'], List) and len(event['choices']) > 0:
-                        event_text = event["choices"][0]['delta']['content']
-                        if isinstance(event_text, str) and event_text != "":
-                            delta = {'answer': event_text}
-                            yield "data: " + json.dumps(delta, ensure_ascii=False)
+    async def _call(self, messages: List[dict], streaming: bool = False) -> str:
+        try:
+            if streaming:
+                queue = asyncio.Queue()
+                pump = asyncio.create_task(self._pump_stream(messages, queue))
+                try:
+                    while True:
+                        event = await queue.get()
+                        if event is None:
+                            break
+                        if isinstance(event, Exception):
+                            raise event
+                        if not isinstance(event, dict):
+                            event = event.model_dump()
+
+                        if event.get('usage'):
+                            self.usage = event['usage']
+                        if isinstance(event['choices'], List) and len(event['choices']) > 0:
+                            event_text = event["choices"][0]['delta']['content']
+                            if isinstance(event_text, str) and event_text != "":
+                                delta = {'answer': event_text}
+                                yield "data: " + json.dumps(delta, ensure_ascii=False)
+                finally:
+                    # 下游提前断开时停止读取上游
+                    pump.cancel()
 
             else:
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    stream=False,
-                    max_tokens=self.max_token,
-                    temperature=self.temperature,
-                    top_p=self.top_p,
-                    stop=self.stop_words
-                )
+                async with llm_backend(self.api_base, self.api_key) as client:
+                    response = await client.chat.completions.create(
+                        model=self.model,
+                        messages=messages,
+                        stream=False,
+                        max_tokens=self.max_token,
+                        temperature=self.temperature,
+                        top_p=self.top_p,
+                        stop=self.stop_words
+                    )
 
+                if response.usage is not None:
+                    self.usage = response.usage.model_dump()
                 event_text = response.choices[0].message.content if response.choices else ""
                 delta = {'answer': event_text}
                 yield "data: " + json.dumps(delta, ensure_ascii=False)
@@ -152,15 +328,26 @@ class OpenAILLM:
         total_tokens = 0
         completion_tokens = 0
 
+        self.usage = None
         response = self._call(messages, streaming)
         complete_answer = ""
+        raw_completion_tokens = 0
         async for response_text in response:
             if response_text:
                 chunk_str = response_text[6:]
                 if not chunk_str.startswith("[DONE]"):
                     chunk_js = json.loads(chunk_str)
                     complete_answer += chunk_js["answer"]
-                completion_tokens = self.num_tokens_from_messages([complete_answer])
+                    # 只对新增的delta分词累加，避免每个chunk都重新编码整段回答
+                    raw_completion_tokens += len(self.tokenizer.encode(chunk_js["answer"], disallowed_special=()))
+                    completion_tokens = self._with_margin(raw_completion_tokens)
+                elif self.usage:
+                    # 结束时对账：优先使用服务端返回的usage
+                    prompt_tokens = self.usage.get('prompt_tokens') or prompt_tokens
+                    completion_tokens = self.usage.get('completion_tokens') or completion_tokens
+                else:
+                    # 没有usage时对完整回答做一次精确计数，修正按delta分词在边界处的误差
+                    completion_tokens = self.num_tokens_from_messages([complete_answer])
                 total_tokens = prompt_tokens + completion_tokens
 
             history[-1] = [prompt, complete_answer]
@@ -3,7 +3,9 @@ import aiohttp
 from typing import List
 from qanything_kernel.utils.custom_log import debug_logger
 from qanything_kernel.utils.general_utils import get_time_async
-from qanything_kernel.configs.model_config import LOCAL_RERANK_SERVICE_URL, LOCAL_RERANK_BATCH
+from qanything_kernel.connector.http_session import get_client_session
+from qanything_kernel.configs.model_config import LOCAL_RERANK_SERVICE_URL, LOCAL_RERANK_BATCH, \
+    LOCAL_RERANK_REQUEST_TIMEOUT
 from langchain.schema import Document
 import traceback
 
@@ -11,6 +13,7 @@ import traceback
 class YouDaoRerank:
     def __init__(self):
         self.url = f"http://{LOCAL_RERANK_SERVICE_URL}/rerank"
+        self.timeout = aiohttp.ClientTimeout(total=LOCAL_RERANK_REQUEST_TIMEOUT)
 
     async def _get_rerank_res(self, query, passages):
         data = {
@@ -19,14 +22,14 @@ class YouDaoRerank:
         }
         headers = {"content-type": "application/json"}
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.url, json=data, headers=headers) as response:
-                    if response.status == 200:
-                        scores = await response.json()
-                        return scores
-                    else:
-                        debug_logger.error(f'Rerank request failed with status {response.status}')
-                        return None
+            session = get_client_session()
+            async with session.post(self.url, json=data, headers=headers, timeout=self.timeout) as response:
+                if response.status == 200:
+                    scores = await response.json()
+                    return scores
+                else:
+                    debug_logger.error(f'Rerank request failed with status {response.status}')
+                    return None
         except Exception as e:
             debug_logger.info(f'rerank query: {query}, rerank passages length: {len(passages)}')
             debug_logger.error(f'rerank error: {traceback.format_exc()}')
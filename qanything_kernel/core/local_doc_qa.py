@@ -1,6 +1,7 @@
 from qanything_kernel.configs.model_config import VECTOR_SEARCH_TOP_K, VECTOR_SEARCH_SCORE_THRESHOLD, \
     PROMPT_TEMPLATE, STREAMING, SYSTEM, INSTRUCTIONS, SIMPLE_PROMPT_TEMPLATE, CUSTOM_PROMPT_TEMPLATE, \
-    LOCAL_RERANK_MODEL_NAME, LOCAL_EMBED_MAX_LENGTH, SEPARATORS
+    LOCAL_RERANK_MODEL_NAME, LOCAL_EMBED_MAX_LENGTH, SEPARATORS, RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_TTL, \
+    RERANK_MAX_CANDIDATES
 from typing import List, Tuple, Union, Dict
 import time
 from scipy.spatial import cKDTree
@@ -16,6 +17,7 @@ from qanything_kernel.connector.database.mysql.mysql_client import KnowledgeBase
 from qanything_kernel.core.retriever.vectorstore import VectorStoreMilvusClient
 from qanything_kernel.core.retriever.elasticsearchstore import StoreElasticSearchClient
 from qanything_kernel.core.retriever.parent_retriever import ParentRetriever
+from qanything_kernel.core.retriever.retrieval_cache import RetrievalCache
 from qanything_kernel.utils.general_utils import (get_time, clear_string, get_time_async, num_tokens,
                                                   cosine_similarity, clear_string_is_equal, num_tokens_embed,
                                                   num_tokens_rerank, deduplicate_documents, replace_image_references)
@@ -23,6 +25,7 @@ from qanything_kernel.utils.custom_log import debug_logger, qa_logger, rerank_lo
 from qanything_kernel.core.chains.condense_q_chain import RewriteQuestionChain
 from qanything_kernel.core.tools.web_search_tool import duckduckgo_search
 import copy
+import asyncio
 import requests
 import json
 import numpy as np
@@ -32,6 +35,9 @@ import traceback
 import re
 
 
+# prompt中不放图片，token预算和拼接时都先去掉图片引用
+FIGURE_PATTERN = re.compile(r'!\[figure]\(.*?\)')
+
 class LocalDocQA:
     def __init__(self, port):
         self.port = port
@@ -44,6 +50,8 @@ class LocalDocQA:
         self.retriever: ParentRetriever = None
         self.milvus_summary: KnowledgeBaseManager = None
         self.es_client: StoreElasticSearchClient = None
+        self.retrieval_cache = RetrievalCache(RETRIEVAL_CACHE_SIZE, ttl=RETRIEVAL_CACHE_TTL) \
+            if RETRIEVAL_CACHE_SIZE > 0 else None
         self.session = self.create_retry_session(retries=3, backoff_factor=1)
         self.doc_splitter = CharacterTextSplitter(
             chunk_size=LOCAL_EMBED_MAX_LENGTH / 2,
@@ -179,17 +187,21 @@ class LocalDocQA:
         new_source_docs = []
         total_token_num = 0
 
-        not_repeated_file_ids = []
+        not_repeated_file_ids = set()
         for doc in source_docs:
             headers_token_num = 0
             file_id = doc.metadata['file_id']
             if file_id not in not_repeated_file_ids:
-                not_repeated_file_ids.append(file_id)
+                not_repeated_file_ids.add(file_id)
                 if 'headers' in doc.metadata:
                     headers = f"headers={doc.metadata['headers']}"
                     headers_token_num = custom_llm.num_tokens_from_messages([headers])
-            doc_valid_content = re.sub(r'!\[figure]\(.*?\)', '', doc.page_content)
-            doc_token_num = custom_llm.num_tokens_from_messages([doc_valid_content])
+            doc_valid_content = FIGURE_PATTERN.sub('', doc.page_content)
+            # 大部分chunk不含图片，直接复用记录在metadata里的token数
+            if doc_valid_content == doc.page_content:
+                doc_token_num = custom_llm.num_tokens_from_docs([doc])
+            else:
+                doc_token_num = custom_llm.num_tokens_from_messages([doc_valid_content])
             doc_token_num += headers_token_num
             if total_token_num + doc_token_num <= limited_token_nums:
                 new_source_docs.append(doc)
@@ -202,23 +214,24 @@ class LocalDocQA:
 
     def generate_prompt(self, query, source_docs, prompt_template):
         if source_docs:
-            context = ''
+            context_parts = []
             not_repeated_file_ids = []
             for doc in source_docs:
-                doc_valid_content = re.sub(r'!\[figure]\(.*?\)', '', doc.page_content)  # 生成prompt时去掉图片
+                doc_valid_content = FIGURE_PATTERN.sub('', doc.page_content)  # 生成prompt时去掉图片
                 file_id = doc.metadata['file_id']
                 if file_id not in not_repeated_file_ids:
                     if len(not_repeated_file_ids) != 0:
-                        context += '</reference>\n'
+                        context_parts.append('</reference>\n')
                     not_repeated_file_ids.append(file_id)
                     if 'headers' in doc.metadata:
                         headers = f"headers={doc.metadata['headers']}"
-                        context += f"<reference {headers}>[{len(not_repeated_file_ids)}]" + '\n' + doc_valid_content + '\n'
+                        context_parts.append(f"<reference {headers}>[{len(not_repeated_file_ids)}]\n")
                     else:
-                        context += f"<reference>[{len(not_repeated_file_ids)}]" + '\n' + doc_valid_content + '\n'
-                else:
-                    context += doc_valid_content + '\n'
-            context += '</reference>\n'
+                        context_parts.append(f"<reference>[{len(not_repeated_file_ids)}]\n")
+                context_parts.append(doc_valid_content)
+                context_parts.append('\n')
+            context_parts.append('</reference>\n')
+            context = ''.join(context_parts)
 
             # prompt = prompt_template.format(context=context).replace("{{question}}", query)
             prompt = prompt_template.replace("{{context}}", context).replace("{{question}}", query)
@@ -231,8 +244,8 @@ class LocalDocQA:
         if doc_strs:
             docs = [Document(page_content=doc_str) for doc_str in doc_strs]
         else:
-            for doc_id in doc_ids:
-                doc_json = self.milvus_summary.get_document_by_doc_id(doc_id)
+            doc_jsons = self.milvus_summary.get_documents_by_doc_ids(doc_ids)
+            for doc_id, doc_json in zip(doc_ids, doc_jsons):
                 if doc_json is None:
                     docs.append(None)
                     continue
@@ -414,7 +427,7 @@ class LocalDocQA:
                                          temperature, api_base, api_key, api_context_length, top_p, top_k, web_chunk_size,
                                          chat_history=None, streaming: bool = STREAMING, rerank: bool = False,
                                          only_need_search_results: bool = False, need_web_search=False,
-                                         hybrid_search=False):
+                                         hybrid_search=False, rerank_top_n: int = RERANK_MAX_CANDIDATES):
         custom_llm = OpenAILLM(model, max_token, api_base, api_key, api_context_length, top_p, temperature)
         if chat_history is None:
             chat_history = []
@@ -470,81 +483,108 @@ class LocalDocQA:
             if clear_string(condense_question) != clear_string(query):
                 retrieval_query = condense_question
 
-        if kb_ids:
-            source_documents = await self.get_source_documents(retrieval_query, retriever, kb_ids, time_record,
-                                                               hybrid_search, top_k)
-        else:
-            source_documents = []
-
-        if need_web_search:
-            t1 = time.perf_counter()
-            web_search_results = self.web_page_search(query, top_k=3)
-            web_splitter = RecursiveCharacterTextSplitter(
-                separators=SEPARATORS,
-                chunk_size=web_chunk_size,
-                chunk_overlap=int(web_chunk_size / 4),
-                length_function=num_tokens_embed,
-            )
-            web_search_results = web_splitter.split_documents(web_search_results)
-
-            current_doc_id = 0
-            current_file_id = web_search_results[0].metadata['file_id']
-            for doc in web_search_results:
-                if doc.metadata['file_id'] == current_file_id:
-                    doc.metadata['doc_id'] = current_file_id + '_' + str(current_doc_id)
-                    current_doc_id += 1
-                else:
-                    current_file_id = doc.metadata['file_id']
-                    current_doc_id = 0
-                    doc.metadata['doc_id'] = current_file_id + '_' + str(current_doc_id)
-                    current_doc_id += 1
-                doc_json = doc.to_json()
-                if doc_json['kwargs'].get('metadata') is None:
-                    doc_json['kwargs']['metadata'] = doc.metadata
-                self.milvus_summary.add_document(doc_id=doc.metadata['doc_id'], json_data=doc_json)
+        # 检索缓存：同一问题、同一批知识库（且知识库版本未变）直接复用检索+rerank结果，web搜索结果不缓存
+        retrieval_cache_key = None
+        source_documents = None
+        if self.retrieval_cache is not None and kb_ids and not need_web_search:
+            kb_versions = await asyncio.to_thread(self.milvus_summary.get_kb_versions, kb_ids)
+            retrieval_cache_key = self.retrieval_cache.make_key(retrieval_query, condense_question, kb_ids,
+                                                                kb_versions, top_k, hybrid_search,
+                                                                rerank and num_tokens_rerank(query) <= 300,
+                                                                rerank_top_n)
+            source_documents = self.retrieval_cache.get(retrieval_cache_key)
+            if source_documents is not None:
+                time_record['retrieval_cache_hit'] = 1
+                debug_logger.info(f"retrieval cache hit: {retrieval_query}, kb_ids: {kb_ids}")
+
+        if source_documents is None:
+            if kb_ids:
+                source_documents = await self.get_source_documents(retrieval_query, retriever, kb_ids, time_record,
+                                                                   hybrid_search, top_k)
+            else:
+                source_documents = []
 
-            t2 = time.perf_counter()
-            time_record['web_search'] = round(t2 - t1, 2)
-            source_documents += web_search_results
-
-        # if kb_ids and not source_documents:
-        #     res = "数据库检索失败，请检查logs/debug_logs/debug.log日志！"
-        #     async for response, history in self.generate_response(query, res, condense_question, source_documents,
-        #                                                           time_record, chat_history, streaming,'NO_DOCUMENTS'):
-        #         yield response, history
-        #     return
-
-        source_documents = deduplicate_documents(source_documents)
-        if rerank and len(source_documents) > 1 and num_tokens_rerank(query) <= 300:
-            try:
+            if need_web_search:
                 t1 = time.perf_counter()
-                debug_logger.info(f"use rerank, rerank docs num: {len(source_documents)}")
-                source_documents = await self.rerank.arerank_documents(condense_question, source_documents)
-                t2 = time.perf_counter()
-                time_record['rerank'] = round(t2 - t1, 2)
-                # 过滤掉低分的文档
-                debug_logger.info(f"rerank step1 num: {len(source_documents)}")
-                debug_logger.info(f"rerank step1 scores: {[doc.metadata['score'] for doc in source_documents]}")
-                if len(source_documents) > 1:
-                    if filtered_documents := [doc for doc in source_documents if doc.metadata['score'] >= 0.28]:
-                        source_documents = filtered_documents
-                    debug_logger.info(f"rerank step2 num: {len(source_documents)}")
-                    saved_docs = [source_documents[0]]
-                    for doc in source_documents[1:]:
-                        debug_logger.info(f"rerank doc score: {doc.metadata['score']}")
-                        relative_difference = (saved_docs[0].metadata['score'] - doc.metadata['score']) / saved_docs[0].metadata['score']
-                        if relative_difference > 0.5:
-                            break
-                        else:
-                            saved_docs.append(doc)
-                    source_documents = saved_docs
-                    debug_logger.info(f"rerank step3 num: {len(source_documents)}")
-            except Exception as e:
-                time_record['rerank'] = 0.0
-                debug_logger.error(f"query {query}: kb_ids: {kb_ids}, rerank error: {traceback.format_exc()}")
+                web_search_results = self.web_page_search(query, top_k=3)
+                web_splitter = RecursiveCharacterTextSplitter(
+                    separators=SEPARATORS,
+                    chunk_size=web_chunk_size,
+                    chunk_overlap=int(web_chunk_size / 4),
+                    length_function=num_tokens_embed,
+                )
+                web_search_results = web_splitter.split_documents(web_search_results)
+
+                current_doc_id = 0
+                current_file_id = web_search_results[0].metadata['file_id']
+                web_doc_id_jsons = []
+                for doc in web_search_results:
+                    if doc.metadata['file_id'] == current_file_id:
+                        doc.metadata['doc_id'] = current_file_id + '_' + str(current_doc_id)
+                        current_doc_id += 1
+                    else:
+                        current_file_id = doc.metadata['file_id']
+                        current_doc_id = 0
+                        doc.metadata['doc_id'] = current_file_id + '_' + str(current_doc_id)
+                        current_doc_id += 1
+                    doc_json = doc.to_json()
+                    if doc_json['kwargs'].get('metadata') is None:
+                        doc_json['kwargs']['metadata'] = doc.metadata
+                    web_doc_id_jsons.append((doc.metadata['doc_id'], doc_json))
+                try:
+                    await asyncio.to_thread(self.milvus_summary.add_documents, web_doc_id_jsons)
+                except Exception as e:
+                    debug_logger.error(f"add web search documents error: {e}")
 
-        # es检索+milvus检索结果最多可能是2k
-        source_documents = source_documents[:top_k]
+                t2 = time.perf_counter()
+                time_record['web_search'] = round(t2 - t1, 2)
+                source_documents += web_search_results
+
+            # if kb_ids and not source_documents:
+            #     res = "数据库检索失败，请检查logs/debug_logs/debug.log日志！"
+            #     async for response, history in self.generate_response(query, res, condense_question, source_documents,
+            #                                                           time_record, chat_history, streaming,'NO_DOCUMENTS'):
+            #         yield response, history
+            #     return
+
+            source_documents = deduplicate_documents(source_documents)
+            if rerank and len(source_documents) > 1 and num_tokens_rerank(query) <= 300:
+                # 混合检索的结果已经过融合排序，只把排在前面的候选送去rerank
+                if rerank_top_n and len(source_documents) > rerank_top_n:
+                    debug_logger.info(f"cap rerank candidates: {len(source_documents)} -> {rerank_top_n}")
+                    source_documents = source_documents[:rerank_top_n]
+                try:
+                    t1 = time.perf_counter()
+                    debug_logger.info(f"use rerank, rerank docs num: {len(source_documents)}")
+                    source_documents = await self.rerank.arerank_documents(condense_question, source_documents)
+                    t2 = time.perf_counter()
+                    time_record['rerank'] = round(t2 - t1, 2)
+                    # 过滤掉低分的文档
+                    debug_logger.info(f"rerank step1 num: {len(source_documents)}")
+                    debug_logger.info(f"rerank step1 scores: {[doc.metadata['score'] for doc in source_documents]}")
+                    if len(source_documents) > 1:
+                        if filtered_documents := [doc for doc in source_documents if doc.metadata['score'] >= 0.28]:
+                            source_documents = filtered_documents
+                        debug_logger.info(f"rerank step2 num: {len(source_documents)}")
+                        saved_docs = [source_documents[0]]
+                        for doc in source_documents[1:]:
+                            debug_logger.info(f"rerank doc score: {doc.metadata['score']}")
+                            relative_difference = (saved_docs[0].metadata['score'] - doc.metadata['score']) / saved_docs[0].metadata['score']
+                            if relative_difference > 0.5:
+                                break
+                            else:
+                                saved_docs.append(doc)
+                        source_documents = saved_docs
+                        debug_logger.info(f"rerank step3 num: {len(source_documents)}")
+                except Exception as e:
+                    time_record['rerank'] = 0.0
+                    debug_logger.error(f"query {query}: kb_ids: {kb_ids}, rerank error: {traceback.format_exc()}")
+
+            # es检索+milvus检索结果最多可能是2k
+            source_documents = source_documents[:top_k]
+
+            if retrieval_cache_key is not None and source_documents:
+                self.retrieval_cache.put(retrieval_cache_key, source_documents)
 
         # rerank之后删除headers，只保留文本内容，用于后续处理
         for doc in source_documents:
@@ -1,6 +1,6 @@
 from qanything_kernel.utils.custom_log import insert_logger
 from qanything_kernel.connector.database.mysql.mysql_client import KnowledgeBaseManager
-from qanything_kernel.configs.model_config import UPLOAD_ROOT_PATH
+from qanything_kernel.configs.model_config import UPLOAD_ROOT_PATH, MYSQL_INSERT_DOCS_BATCH_SIZE
 from qanything_kernel.utils.custom_log import debug_logger
 from langchain_core.documents import Document
 from langchain.storage import InMemoryStore
@@ -11,13 +11,17 @@ from typing import (
     Tuple,
     TypeVar
 )
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import os
 import json
-from tqdm import tqdm
 
 
 V = TypeVar("V")
 
+# 父文档本地json备份的后台写线程
+_mirror_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="docstore_mirror")
+
 
 class MysqlStore(InMemoryStore):
     def __init__(self, mysql_client: KnowledgeBaseManager):
@@ -36,11 +40,16 @@ class MysqlStore(InMemoryStore):
         """
         doc_ids = [doc_id for doc_id, _ in key_value_pairs]
         insert_logger.info(f"add documents: {len(doc_ids)}")
-        for doc_id, doc in tqdm(key_value_pairs):
+        doc_id_jsons = []
+        for doc_id, doc in key_value_pairs:
             doc_json = doc.to_json()
             if doc_json['kwargs'].get('metadata') is None:
                 doc_json['kwargs']['metadata'] = doc.metadata
-            self.mysql_client.add_document(doc_id, doc_json)
+            doc_id_jsons.append((doc_id, doc_json))
+        self.mysql_client.add_documents(doc_id_jsons, batch_size=MYSQL_INSERT_DOCS_BATCH_SIZE)
+
+    async def amset(self, key_value_pairs: Sequence[Tuple[str, V]]) -> None:
+        await asyncio.to_thread(self.mset, key_value_pairs)
 
     def mget(self, keys: Sequence[str]) -> List[Optional[V]]:
         """Get the values associated with the given keys.
@@ -52,19 +61,19 @@ class MysqlStore(InMemoryStore):
             A sequence of optional values associated with the keys.
             If a key is not found, the corresponding value will be None.
         """
-       
+        # 一次批量查询取回所有父文档，顺序与keys保持一致
+        doc_jsons = self.mysql_client.get_documents_by_doc_ids(list(keys))
         docs = []
-        for doc_id in keys:
-            doc_json = self.mysql_client.get_document_by_doc_id(doc_id)
+        need_mirror = []
+        for doc_id, doc_json in zip(keys, doc_jsons):
             if doc_json is None:
                 docs.append(None)
                 continue
             # debug_logger.info(f'doc_id: {doc_id} get doc_json: {doc_json}')
-            user_id, file_id, file_name, kb_id = doc_json['kwargs']['metadata']['user_id'], doc_json['kwargs']['metadata']['file_id'], doc_json['kwargs']['metadata']['file_name'], doc_json['kwargs']['metadata']['kb_id'] 
-            doc_idx = doc_id.split('_')[-1]
-            upload_path = os.path.join(UPLOAD_ROOT_PATH, user_id)
-            local_path = os.path.join(upload_path, kb_id, file_id, file_name.rsplit('.', 1)[0] + '_' + doc_idx + '.json')
-            doc = Document(page_content=doc_json['kwargs']['page_content'], metadata=doc_json['kwargs']['metadata'])
+            file_name = doc_json['kwargs']['metadata']['file_name']
+            # metadata浅拷贝一份，避免后续对doc的修改与后台备份线程同时操作同一个dict
+            doc = Document(page_content=doc_json['kwargs']['page_content'],
+                           metadata=dict(doc_json['kwargs']['metadata']))
             doc.metadata['doc_id'] = doc_id
             if file_name.endswith('.faq'):
                 faq_dict = doc.metadata['faq_dict']
@@ -73,10 +82,31 @@ class MysqlStore(InMemoryStore):
                 doc.page_content = page_content
                 doc.metadata['nos_keys'] = nos_keys
             docs.append(doc)
-            if not os.path.exists(local_path):
+            need_mirror.append((doc_id, doc_json))
+        if need_mirror:
+            # 本地json备份不阻塞检索请求，交给后台线程写入
+            _mirror_executor.submit(self._mirror_to_local, need_mirror)
+        return docs
+
+    async def amget(self, keys: Sequence[str]) -> List[Optional[V]]:
+        return await asyncio.to_thread(self.mget, keys)
+
+    @staticmethod
+    def _mirror_to_local(doc_id_jsons: List[Tuple[str, dict]]) -> None:
+        for doc_id, doc_json in doc_id_jsons:
+            try:
+                metadata = doc_json['kwargs']['metadata']
+                user_id, file_id, file_name, kb_id = metadata['user_id'], metadata['file_id'], \
+                    metadata['file_name'], metadata['kb_id']
+                doc_idx = doc_id.split('_')[-1]
+                upload_path = os.path.join(UPLOAD_ROOT_PATH, user_id)
+                local_path = os.path.join(upload_path, kb_id, file_id, file_name.rsplit('.', 1)[0] + '_' + doc_idx + '.json')
+                if os.path.exists(local_path):
+                    continue
                 #  json字符串写入本地文件
                 os.makedirs(os.path.dirname(local_path), exist_ok=True)
                 # debug_logger.info(f'write local_path: {local_path}')
                 with open(local_path, 'w') as f:
                     f.write(json.dumps(doc_json, ensure_ascii=False))
-        return docs
+            except Exception as e:
+                debug_logger.error(f"mirror doc {doc_id} to local failed: {e}")
@@ -21,10 +21,19 @@ class StoreElasticSearchClient:
         except Exception as e:
             debug_logger.error(f"Delete ES document failed with error: {e}")
 
-    def delete_files(self, file_ids, file_chunks):
-        docs_ids = []
-        for file_id, file_chunk in zip(file_ids, file_chunks):
-            # doc_id 是file_id + '_' + i，其中i是range(file_chunk)
-            docs_ids.extend([file_id + '_' + str(i) for i in range(file_chunk)])
-        if docs_ids:
-            self.delete(docs_ids)
+    def delete_by_terms(self, field, values, batch_size=1000):
+        """按metadata字段批量delete-by-query，失败时抛出异常由调用方重试"""
+        total_deleted = 0
+        for i in range(0, len(values), batch_size):
+            res = self.es_store.client.delete_by_query(
+                index=ES_INDEX_NAME, query={"terms": {f"metadata.{field}.keyword": values[i:i + batch_size]}},
+                conflicts="proceed", refresh=True)
+            total_deleted += res.get('deleted', 0)
+        debug_logger.info(f"Delete ES document by {field}, values: {len(values)}, deleted: {total_deleted}")
+        return total_deleted
+
+    def delete_files(self, file_ids):
+        return self.delete_by_terms('file_id', file_ids)
+
+    def delete_kbs(self, kb_ids):
+        return self.delete_by_terms('kb_id', kb_ids)
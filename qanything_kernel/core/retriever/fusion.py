@@ -0,0 +1,80 @@
+from typing import List, Dict, Optional, Callable
+from langchain_core.documents import Document
+from qanything_kernel.utils.custom_log import debug_logger
+
+
+def _doc_key(doc: Document) -> str:
+    return doc.metadata.get('doc_id') or doc.page_content
+
+
+def rrf_fusion(ranked_lists: List[List[Document]], weights: List[float], rrf_k: int = 60,
+               **kwargs) -> Dict[str, float]:
+    """Reciprocal Rank Fusion：score = sum(weight / (rrf_k + rank))，只依赖排名，不需要各路分数可比"""
+    fused = {}
+    for docs, weight in zip(ranked_lists, weights):
+        for rank, doc in enumerate(docs, start=1):
+            key = _doc_key(doc)
+            fused[key] = fused.get(key, 0.0) + weight / (rrf_k + rank)
+    return fused
+
+
+def weighted_fusion(ranked_lists: List[List[Document]], weights: List[float],
+                    score_keys: List[str] = None, higher_is_better: List[bool] = None,
+                    **kwargs) -> Dict[str, float]:
+    """各路分数min-max归一化到[0, 1]后加权求和，没有分数的一路退化为按排名线性打分"""
+    fused = {}
+    for i, (docs, weight) in enumerate(zip(ranked_lists, weights)):
+        if not docs:
+            continue
+        score_key = score_keys[i] if score_keys else None
+        scores = [doc.metadata.get(score_key) if score_key else None for doc in docs]
+        if any(score is None for score in scores):
+            # 排名越靠前分数越高
+            norm_scores = [1 - rank / len(docs) for rank in range(len(docs))]
+        else:
+            low, high = min(scores), max(scores)
+            if high == low:
+                norm_scores = [1.0] * len(docs)
+            else:
+                norm_scores = [(score - low) / (high - low) for score in scores]
+            # milvus用L2距离，越小越相似，需要反转
+            if higher_is_better and not higher_is_better[i]:
+                norm_scores = [1 - score for score in norm_scores]
+        for doc, score in zip(docs, norm_scores):
+            key = _doc_key(doc)
+            fused[key] = fused.get(key, 0.0) + weight * score
+    return fused
+
+
+FUSION_METHODS: Dict[str, Callable[..., Dict[str, float]]] = {
+    'rrf': rrf_fusion,
+    'weighted': weighted_fusion,
+}
+
+
+def fuse_documents(ranked_lists: List[List[Document]], method: str = 'rrf', weights: Optional[List[float]] = None,
+                   **kwargs) -> List[Document]:
+    """把多路检索结果融合成一个按融合分数降序排列的列表，同一文档只保留第一次出现的那份，
+    融合分数写入metadata['fusion_score']。method为'none'或未注册时按原顺序拼接"""
+    if weights is None:
+        weights = [1.0] * len(ranked_lists)
+    docs_by_key = {}
+    for docs in ranked_lists:
+        for doc in docs:
+            docs_by_key.setdefault(_doc_key(doc), doc)
+
+    fusion_func = FUSION_METHODS.get(method)
+    if fusion_func is None:
+        if method != 'none':
+            debug_logger.warning(f"unknown fusion method: {method}, fallback to concat")
+        return list(docs_by_key.values())
+
+    fused = fusion_func(ranked_lists, weights, **kwargs)
+    # sorted是稳定排序，分数相同时保持各路原有的先后顺序
+    keys = sorted(docs_by_key.keys(), key=lambda k: fused.get(k, 0.0), reverse=True)
+    results = []
+    for key in keys:
+        doc = docs_by_key[key]
+        doc.metadata['fusion_score'] = round(fused.get(key, 0.0), 6)
+        results.append(doc)
+    return results
@@ -2,7 +2,8 @@ from qanything_kernel.utils.general_utils import get_time, get_table_infos, num_
     html_to_markdown, clear_string, get_time_async
 from typing import List, Optional
 from qanything_kernel.configs.model_config import UPLOAD_ROOT_PATH, LOCAL_OCR_SERVICE_URL, IMAGES_ROOT_PATH, \
-    DEFAULT_CHILD_CHUNK_SIZE, LOCAL_PDF_PARSER_SERVICE_URL, SEPARATORS
+    DEFAULT_CHILD_CHUNK_SIZE, LOCAL_PDF_PARSER_SERVICE_URL, SEPARATORS, PARSE_CACHE_ROOT_PATH, PARSE_CACHE_MAX_BYTES, \
+    PARSE_CACHE_PARSER_VERSION
 from langchain.docstore.document import Document
 from qanything_kernel.utils.loader.my_recursive_url_loader import MyRecursiveUrlLoader
 from qanything_kernel.utils.custom_log import insert_logger
@@ -14,6 +15,7 @@ from qanything_kernel.utils.loader import UnstructuredPaddlePDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from qanything_kernel.utils.loader.csv_loader import CSVLoader
 from qanything_kernel.utils.loader.markdown_parser import convert_markdown_to_langchaindoc
+from qanything_kernel.core.retriever.parse_cache import ParseCache
 import asyncio
 import aiohttp
 import docx2txt
@@ -55,12 +57,17 @@ def get_pdf_result_sync(file_path):
         response.raise_for_status()  # 如果请求返回了错误状态码，将会抛出异常
         response_json = response.json()
         markdown_file = response_json.get('markdown_file')
+        insert_logger.info(f"pdf parser memory: {response_json.get('memory_record')}")
         return markdown_file
     except Exception as e:
         insert_logger.warning(f"pdf parser error: {traceback.format_exc()}")
         return None
 
 
+parse_cache = ParseCache(PARSE_CACHE_ROOT_PATH, PARSE_CACHE_MAX_BYTES, PARSE_CACHE_PARSER_VERSION) \
+    if PARSE_CACHE_MAX_BYTES > 0 else None
+
+
 class LocalFileForInsert:
     def __init__(self, user_id, kb_id, file_id, file_location, file_name, file_url, chunk_size, mysql_client):
         self.chunk_size = chunk_size
@@ -77,6 +84,7 @@ class LocalFileForInsert:
         self.faq_dict = {}
         self.file_path = ""
         self.mysql_client = mysql_client
+        self.parse_cache_hit = False
         if self.file_location == 'FAQ':
             faq_info = self.mysql_client.get_faq(self.file_id)
             user_id, kb_id, question, answer, nos_keys = faq_info
@@ -365,6 +373,17 @@ class LocalFileForInsert:
     @get_time
     def split_file_to_docs(self):
         insert_logger.info(f"start split file to docs, file_path: {self.file_name}")
+        # FAQ和URL的内容不在本地文件里，不走缓存
+        cache_key = None
+        if parse_cache is not None and not self.faq_dict and not self.file_url:
+            cache_key = parse_cache.make_key(self.file_path, self.chunk_size)
+            docs = parse_cache.get(cache_key, os.path.join(IMAGES_ROOT_PATH, self.file_id))
+            if docs is not None:
+                insert_logger.info(f"parse cache hit: {self.file_name}, key: {cache_key}, docs: {len(docs)}")
+                self.parse_cache_hit = True
+                self.inject_metadata(docs)
+                return
+        markdown_file = None
         if self.faq_dict:
             docs = [Document(page_content=self.faq_dict['question'], metadata={"faq_dict": self.faq_dict})]
         elif self.file_url:
@@ -400,6 +419,8 @@ class LocalFileForInsert:
             else:
                 insert_logger.warning(
                     f'Error in Powerful PDF parsing, use fast PDF parser instead.')
+                # 解析服务失败可能是暂时的，降级结果不写缓存
+                cache_key = None
                 loader = UnstructuredPaddlePDFLoader(self.file_path, strategy="fast")
                 docs = loader.load()
         elif self.file_path.lower().endswith(".jpg") or self.file_path.lower().endswith(
@@ -446,6 +467,9 @@ class LocalFileForInsert:
             docs = loader.load()
         else:
             raise TypeError("文件类型不支持，目前仅支持：[md,txt,pdf,jpg,png,jpeg,docx,xlsx,pptx,eml,csv]")
+        # inject_metadata会修改docs中的title_lst，需要在这之前写缓存
+        if cache_key is not None and docs:
+            parse_cache.put(cache_key, docs, markdown_file if self.file_path.lower().endswith(".pdf") else None)
         self.inject_metadata(docs)
 
     def inject_metadata(self, docs: List[Document]):
@@ -3,7 +3,9 @@ from qanything_kernel.core.retriever.vectorstore import VectorStoreMilvusClient
 from qanything_kernel.core.retriever.elasticsearchstore import StoreElasticSearchClient
 from qanything_kernel.connector.database.mysql.mysql_client import KnowledgeBaseManager
 from qanything_kernel.core.retriever.docstrore import MysqlStore
-from qanything_kernel.configs.model_config import DEFAULT_CHILD_CHUNK_SIZE, DEFAULT_PARENT_CHUNK_SIZE, SEPARATORS
+from qanything_kernel.core.retriever.fusion import fuse_documents
+from qanything_kernel.configs.model_config import DEFAULT_CHILD_CHUNK_SIZE, DEFAULT_PARENT_CHUNK_SIZE, SEPARATORS, \
+    MILVUS_SEARCH_TIMEOUT, ES_SEARCH_TIMEOUT, HYBRID_FUSION_METHOD, HYBRID_VECTOR_WEIGHT, RRF_K
 from qanything_kernel.utils.custom_log import debug_logger, insert_logger
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from qanything_kernel.utils.general_utils import num_tokens_embed, get_time_async
@@ -15,6 +17,7 @@ from langchain_core.callbacks import (
 )
 from langchain_community.vectorstores.milvus import Milvus
 from langchain_elasticsearch import ElasticsearchStore
+import asyncio
 import time
 import traceback
 
@@ -25,40 +28,54 @@ class SelfParentRetriever(ParentDocumentRetriever):
         self.search_kwargs = kwargs
         debug_logger.info(f"Set search kwargs: {self.search_kwargs}")
 
-    async def _aget_relevant_documents(
-            self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
-    ) -> List[Document]:
-        """Asynchronously get documents relevant to a query.
-        Args:
-            query: String to find relevant documents for
-            run_manager: The callbacks handler to use
-        Returns:
-            List of relevant documents
+    async def asearch_parent_ids(self, query: str, search_type: Optional[str] = None,
+                                 search_kwargs: Optional[Dict] = None
+                                 ) -> Tuple[List[str], Dict[str, float], List[Document]]:
+        """
+        只做子文档的向量检索，返回按检索顺序去重后的父文档id、每个父文档id对应的分数以及子文档；
+        search_type/search_kwargs按请求传入，retriever被并发请求共享，不能依赖set_search_kwargs设置的值
         """
-        debug_logger.info(f"Search: query: {query}, {self.search_type} with {self.search_kwargs}")
+        search_type = search_type or self.search_type
+        search_kwargs = search_kwargs if search_kwargs is not None else self.search_kwargs
+        debug_logger.info(f"Search: query: {query}, {search_type} with {search_kwargs}")
         # self.vectorstore.col.load()
         scores = []
-        if self.search_type == "mmr":
+        if search_type == "mmr":
             sub_docs = await self.vectorstore.amax_marginal_relevance_search(
-                query, **self.search_kwargs
+                query, **search_kwargs
             )
         else:
             res = await self.vectorstore.asimilarity_search_with_score(
-                query, **self.search_kwargs
+                query, **search_kwargs
             )
             scores = [score for _, score in res]
             sub_docs = [doc for doc, _ in res]
 
         # We do this to maintain the order of the ids that are returned
         ids = []
-        for d in sub_docs:
-            if self.id_key in d.metadata and d.metadata[self.id_key] not in ids:
+        id_scores = {}
+        for i, d in enumerate(sub_docs):
+            if self.id_key in d.metadata and d.metadata[self.id_key] not in id_scores:
                 ids.append(d.metadata[self.id_key])
+                id_scores[d.metadata[self.id_key]] = scores[i] if scores else None
+        return ids, id_scores, sub_docs
+
+    async def _aget_relevant_documents(
+            self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        """Asynchronously get documents relevant to a query.
+        Args:
+            query: String to find relevant documents for
+            run_manager: The callbacks handler to use
+        Returns:
+            List of relevant documents
+        """
+        ids, id_scores, sub_docs = await self.asearch_parent_ids(query)
+        # 所有父文档一次批量从mysql取回
         docs = await self.docstore.amget(ids)
-        if scores:
-            for i, doc in enumerate(docs):
-                if doc is not None:
-                    doc.metadata['score'] = scores[i]
+        for _id, doc in zip(ids, docs):
+            if doc is not None and id_scores[_id] is not None:
+                doc.metadata['score'] = id_scores[_id]
         res = [d for d in docs if d is not None]
         sub_docs_lengths = [len(d.page_content) for d in sub_docs]
         res_lengths = [len(d.page_content) for d in res]
@@ -66,31 +83,35 @@ class SelfParentRetriever(ParentDocumentRetriever):
             f"Got child docs: {len(sub_docs)}, {sub_docs_lengths} and Parent docs: {len(res)}, {res_lengths}")
         return res
 
-    async def aadd_documents(
+    def split_for_insert(
             self,
             documents: List[Document],
             ids: Optional[List[str]] = None,
             add_to_docstore: bool = True,
             parent_chunk_size: Optional[int] = None,
-            es_store: Optional[ElasticsearchStore] = None,
             single_parent: bool = False,
-    ) -> Tuple[int, Dict]:
+            parent_splitter: Optional[RecursiveCharacterTextSplitter] = None,
+            child_splitter: Optional[RecursiveCharacterTextSplitter] = None,
+    ) -> Tuple[List[Document], List[Tuple[str, Document]], Dict]:
+        """切分父/子文档（CPU密集，可在线程中执行），返回待向量化的子文档、待写入docstore的父文档和time_record"""
+        parent_splitter = parent_splitter or self.parent_splitter
+        child_splitter = child_splitter or self.child_splitter
         # insert_logger.info(f"Inserting {len(documents)} complete documents, single_parent: {single_parent}")
         split_start = time.perf_counter()
-        if self.parent_splitter is not None and not single_parent:
+        if parent_splitter is not None and not single_parent:
             # documents = self.parent_splitter.split_documents(documents)
             split_documents = []
             need_split_docs = []
             for doc in documents:
                 if doc.metadata['has_table'] or num_tokens_embed(doc.page_content) <= parent_chunk_size:
                     if need_split_docs:
-                        split_documents.extend(self.parent_splitter.split_documents(need_split_docs))
+                        split_documents.extend(parent_splitter.split_documents(need_split_docs))
                         need_split_docs = []
                     split_documents.append(doc)
                 else:
                     need_split_docs.append(doc)
             if need_split_docs:
-                split_documents.extend(self.parent_splitter.split_documents(need_split_docs))
+                split_documents.extend(parent_splitter.split_documents(need_split_docs))
             documents = split_documents
         insert_logger.info(f"Inserting {len(documents)} parent documents")
         if ids is None:
@@ -112,7 +133,7 @@ class SelfParentRetriever(ParentDocumentRetriever):
         full_docs = []
         for i, doc in enumerate(documents):
             _id = doc_ids[i]
-            sub_docs = self.child_splitter.split_documents([doc])
+            sub_docs = child_splitter.split_documents([doc])
             if self.child_metadata_fields is not None:
                 for _doc in sub_docs:
                     _doc.metadata = {
@@ -137,8 +158,24 @@ class SelfParentRetriever(ParentDocumentRetriever):
             del doc.metadata['nos_key']
             del doc.metadata['faq_dict']
             del doc.metadata['page_id']
+        return embed_docs, full_docs, time_record
+
+    async def aembed_documents(self, embed_docs: List[Document], time_record: Dict) -> List[List[float]]:
+        return await self.vectorstore.aembed_texts([doc.page_content for doc in embed_docs], time_record=time_record)
 
-        res = await self.vectorstore.aadd_documents(embed_docs, time_record=time_record)
+    async def astore_documents(
+            self,
+            embed_docs: List[Document],
+            full_docs: List[Tuple[str, Document]],
+            embeddings: List[List[float]],
+            time_record: Dict,
+            add_to_docstore: bool = True,
+            es_store: Optional[ElasticsearchStore] = None,
+    ) -> int:
+        """把子文档向量写入milvus、子文档写入es、父文档写入mysql"""
+        res = await self.vectorstore.ainsert_embeddings([doc.page_content for doc in embed_docs], embeddings,
+                                                        [doc.metadata for doc in embed_docs],
+                                                        time_record=time_record)
         insert_logger.info(f'vectorstore insert number: {len(res)}, {res[0]}')
         if es_store is not None:
             try:
@@ -153,7 +190,23 @@ class SelfParentRetriever(ParentDocumentRetriever):
 
         if add_to_docstore:
             await self.docstore.amset(full_docs)
-        return len(res), time_record
+        return len(res)
+
+    async def aadd_documents(
+            self,
+            documents: List[Document],
+            ids: Optional[List[str]] = None,
+            add_to_docstore: bool = True,
+            parent_chunk_size: Optional[int] = None,
+            es_store: Optional[ElasticsearchStore] = None,
+            single_parent: bool = False,
+    ) -> Tuple[int, Dict]:
+        embed_docs, full_docs, time_record = self.split_for_insert(documents, ids, add_to_docstore,
+                                                                   parent_chunk_size, single_parent)
+        embeddings = await self.aembed_documents(embed_docs, time_record)
+        chunks_number = await self.astore_documents(embed_docs, full_docs, embeddings, time_record,
+                                                    add_to_docstore, es_store)
+        return chunks_number, time_record
 
 
 class ParentRetriever:
@@ -182,12 +235,11 @@ class ParentRetriever:
         self.backup_vectorstore: Optional[Milvus] = None
         self.es_store = es_client.es_store
         self.parent_chunk_size = DEFAULT_PARENT_CHUNK_SIZE
+        self.splitters = {DEFAULT_PARENT_CHUNK_SIZE: (init_parent_splitter, init_child_splitter)}
 
-    @get_time_async
-    async def insert_documents(self, docs, parent_chunk_size, single_parent=False):
-        insert_logger.info(f"Inserting {len(docs)} documents, parent_chunk_size: {parent_chunk_size}, single_parent: {single_parent}")
-        if parent_chunk_size != self.parent_chunk_size:
-            self.parent_chunk_size = parent_chunk_size
+    def get_splitters(self, parent_chunk_size: int) -> Tuple[RecursiveCharacterTextSplitter, RecursiveCharacterTextSplitter]:
+        """按父chunk大小缓存splitter，多个文件并发入库时互不影响"""
+        if parent_chunk_size not in self.splitters:
             parent_splitter = RecursiveCharacterTextSplitter(
                 separators=SEPARATORS,
                 chunk_size=parent_chunk_size,
@@ -199,49 +251,129 @@ class ParentRetriever:
                 chunk_size=child_chunk_size,
                 chunk_overlap=int(child_chunk_size / 4),
                 length_function=num_tokens_embed)
-            self.retriever = SelfParentRetriever(
-                vectorstore=self.vectorstore_client.local_vectorstore,
-                docstore=MysqlStore(self.mysql_client),
-                child_splitter=child_splitter,
-                parent_splitter=parent_splitter
-            )
-        # insert_logger.info(f'insert documents: {len(docs)}')
+            self.splitters[parent_chunk_size] = (parent_splitter, child_splitter)
+        return self.splitters[parent_chunk_size]
+
+    def prepare_insert(self, docs, parent_chunk_size, single_parent=False):
+        """入库流水线的切分阶段，返回(embed_docs, full_docs, time_record)"""
+        parent_splitter, child_splitter = self.get_splitters(parent_chunk_size)
         ids = None if not single_parent else [doc.metadata['doc_id'] for doc in docs]
-        return await self.retriever.aadd_documents(docs, parent_chunk_size=parent_chunk_size,
-                                                   es_store=self.es_store, ids=ids, single_parent=single_parent)
+        return self.retriever.split_for_insert(docs, ids=ids, parent_chunk_size=parent_chunk_size,
+                                               single_parent=single_parent, parent_splitter=parent_splitter,
+                                               child_splitter=child_splitter)
+
+    async def aembed_prepared(self, embed_docs, time_record):
+        return await self.retriever.aembed_documents(embed_docs, time_record)
+
+    async def astore_prepared(self, embed_docs, full_docs, embeddings, time_record):
+        return await self.retriever.astore_documents(embed_docs, full_docs, embeddings, time_record,
+                                                     es_store=self.es_store)
+
+    @get_time_async
+    async def insert_documents(self, docs, parent_chunk_size, single_parent=False):
+        insert_logger.info(f"Inserting {len(docs)} documents, parent_chunk_size: {parent_chunk_size}, single_parent: {single_parent}")
+        embed_docs, full_docs, time_record = self.prepare_insert(docs, parent_chunk_size, single_parent)
+        embeddings = await self.aembed_prepared(embed_docs, time_record)
+        chunks_number = await self.astore_prepared(embed_docs, full_docs, embeddings, time_record)
+        return chunks_number, time_record
 
     async def get_retrieved_documents(self, query: str, partition_keys: List[str], time_record: dict,
                                       hybrid_search: bool, top_k: int):
-        milvus_start_time = time.perf_counter()
         expr = f'kb_id in {partition_keys}'
-        # self.retriever.set_search_kwargs("mmr", k=VECTOR_SEARCH_TOP_K, expr=expr)
-        self.retriever.set_search_kwargs("similarity", k=top_k, expr=expr)
-        query_docs = await self.retriever.aget_relevant_documents(query)
-        for doc in query_docs:
-            doc.metadata['retrieval_source'] = 'milvus'
-        milvus_end_time = time.perf_counter()
-        time_record['retriever_search_by_milvus'] = round(milvus_end_time - milvus_start_time, 2)
-
-        if not hybrid_search:
-            return query_docs
-
-        try:
+        # 检索参数随请求传入，不修改共享的retriever，避免并发请求互相覆盖expr
+        search_kwargs = {'k': top_k, 'expr': expr}
+
+        # milvus和es并发检索，各自有超时，命中的父文档id合并后一次性从mysql取回
+        search_start = time.perf_counter()
+        spans = {}
+
+        async def timed_search(name, coro, timeout):
+            start = time.perf_counter()
+            try:
+                return await asyncio.wait_for(coro, timeout=timeout)
+            finally:
+                spans[name] = (start - search_start, time.perf_counter() - search_start)
+
+        tasks = [timed_search('milvus', self.retriever.asearch_parent_ids(query, "similarity", search_kwargs),
+                           MILVUS_SEARCH_TIMEOUT)]
+        if hybrid_search:
             # filter = []
             # for partition_key in partition_keys:
             filter = [{"terms": {"metadata.kb_id.keyword": partition_keys}}]
-            es_sub_docs = await self.es_store.asimilarity_search(query, k=top_k, filter=filter)
-            es_ids = []
-            milvus_doc_ids = [d.metadata[self.retriever.id_key] for d in query_docs]
-            for d in es_sub_docs:
-                if self.retriever.id_key in d.metadata and d.metadata[self.retriever.id_key] not in es_ids and d.metadata[self.retriever.id_key] not in milvus_doc_ids:
-                    es_ids.append(d.metadata[self.retriever.id_key])
-            es_docs = await self.retriever.docstore.amget(es_ids)
-            es_docs = [d for d in es_docs if d is not None]
-            for doc in es_docs:
+            tasks.append(timed_search('es', self.es_store.asimilarity_search_with_score(query, k=top_k, filter=filter),
+                                      ES_SEARCH_TIMEOUT))
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        milvus_res = results[0]
+        es_sub_docs = []
+        if hybrid_search:
+            if isinstance(results[1], BaseException):
+                debug_logger.error(f"Error in get_retrieved_documents on es_search, fallback to milvus only: "
+                                   f"{repr(results[1])}")
+            else:
+                es_sub_docs = results[1]
+        if isinstance(milvus_res, BaseException):
+            if not es_sub_docs:
+                raise milvus_res
+            debug_logger.error(f"Error in get_retrieved_documents on milvus_search, use es only: {repr(milvus_res)}")
+            milvus_ids, milvus_scores = [], {}
+        else:
+            milvus_ids, milvus_scores, _ = milvus_res
+
+        # es的一路保留完整排名（包括和milvus重复的父文档），供融合阶段使用，父文档分数取子文档中的最高分
+        es_ids = []
+        es_scores = {}
+        for d, score in es_sub_docs:
+            parent_id = d.metadata.get(self.retriever.id_key)
+            if parent_id is None:
+                continue
+            if parent_id not in es_scores:
+                es_ids.append(parent_id)
+                es_scores[parent_id] = score
+            else:
+                es_scores[parent_id] = max(es_scores[parent_id], score)
+        milvus_id_set = set(milvus_ids)
+        es_only_ids = [doc_id for doc_id in es_ids if doc_id not in milvus_id_set]
+
+        hydrate_start = time.perf_counter()
+        docs = await self.retriever.docstore.amget(milvus_ids + es_only_ids)
+        time_record['retriever_hydrate'] = round(time.perf_counter() - hydrate_start, 2)
+
+        docs_by_id = {}
+        query_docs = []
+        for i, (doc_id, doc) in enumerate(zip(milvus_ids + es_only_ids, docs)):
+            if doc is None:
+                continue
+            docs_by_id[doc_id] = doc
+            if i < len(milvus_ids):
+                doc.metadata['retrieval_source'] = 'milvus'
+                if milvus_scores[doc_id] is not None:
+                    doc.metadata['score'] = milvus_scores[doc_id]
+                query_docs.append(doc)
+            else:
                 doc.metadata['retrieval_source'] = 'es'
-            time_record['retriever_search_by_es'] = round(time.perf_counter() - milvus_end_time, 2)
-            debug_logger.info(f"Got {len(query_docs)} documents from vectorstore and {len(es_sub_docs)} documents from es, total {len(query_docs) + len(es_docs)} merged documents.")
-            query_docs.extend(es_docs)
-        except Exception as e:
-            debug_logger.error(f"Error in get_retrieved_documents on es_search: {e}")
+        es_docs = []
+        for doc_id in es_ids:
+            if doc_id in docs_by_id:
+                docs_by_id[doc_id].metadata['es_score'] = es_scores[doc_id]
+                es_docs.append(docs_by_id[doc_id])
+
+        milvus_span = spans.get('milvus', (0, 0))
+        time_record['retriever_search_by_milvus'] = round(milvus_span[1] - milvus_span[0], 2)
+        if hybrid_search:
+            es_span = spans.get('es', (0, 0))
+            time_record['retriever_search_by_es'] = round(es_span[1] - es_span[0], 2)
+            overlap = min(milvus_span[1], es_span[1]) - max(milvus_span[0], es_span[0])
+            time_record['retriever_search_overlap'] = round(max(overlap, 0), 2)
+            # 1表示es在关键路径上（比milvus结束得晚），0表示milvus在关键路径上
+            time_record['retriever_critical_path_es'] = int(es_span[1] > milvus_span[1])
+            fusion_start = time.perf_counter()
+            merged_docs = fuse_documents([query_docs, es_docs], method=HYBRID_FUSION_METHOD,
+                                         weights=[HYBRID_VECTOR_WEIGHT, 1 - HYBRID_VECTOR_WEIGHT], rrf_k=RRF_K,
+                                         score_keys=['score', 'es_score'], higher_is_better=[False, True])
+            time_record['retriever_fusion'] = round(time.perf_counter() - fusion_start, 2)
+            debug_logger.info(f"Got {len(query_docs)} documents from vectorstore and {len(es_docs)} documents "
+                              f"from es, {len(merged_docs)} documents after {HYBRID_FUSION_METHOD} fusion, "
+                              f"critical path: {'es' if es_span[1] > milvus_span[1] else 'milvus'}")
+            query_docs = merged_docs
         return query_docs
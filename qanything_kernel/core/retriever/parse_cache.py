@@ -0,0 +1,161 @@
+from typing import List, Optional
+from langchain_core.documents import Document
+from qanything_kernel.utils.custom_log import insert_logger
+import threading
+import traceback
+import hashlib
+import pickle
+import shutil
+import json
+import uuid
+import time
+import os
+
+
+class ParseCache:
+    """文件解析结果缓存：按文件内容寻址，同一个文件传到多个知识库或重复上传时不再重新解析。
+
+    key = sha256(文件内容) + 文件后缀 + 解析器版本 + chunk_size，每个key一个目录：
+        docs.pkl     split_file_to_docs中inject_metadata之前的docs（与file_id、kb_id无关）
+        markdown.md  pdf解析服务生成的markdown
+        images/      pdf解析服务抽取的图片，命中时复制到IMAGES_ROOT_PATH/file_id
+        meta.json    条目大小等信息
+    条目先写到临时目录再rename，多个入库进程共用一个缓存目录也不会读到写了一半的条目。
+    总大小超过max_bytes时按最近访问时间（目录mtime，命中时刷新）淘汰。
+    """
+    DOCS_FILE = 'docs.pkl'
+    MARKDOWN_FILE = 'markdown.md'
+    IMAGES_DIR = 'images'
+    META_FILE = 'meta.json'
+
+    def __init__(self, root_path: str, max_bytes: int, parser_version: str):
+        self.root_path = root_path
+        self.max_bytes = max_bytes
+        self.parser_version = parser_version
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def file_sha256(file_path: str, block_size: int = 1 << 20) -> str:
+        sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha256.update(block)
+        return sha256.hexdigest()
+
+    def make_key(self, file_path: str, chunk_size: int) -> str:
+        # 同样的内容不同后缀会走不同的loader，后缀也要放进key
+        suffix = os.path.splitext(file_path)[1].lower()
+        raw_key = f"{self.file_sha256(file_path)}|{suffix}|{self.parser_version}|{chunk_size}"
+        return hashlib.sha256(raw_key.encode('utf-8')).hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.root_path, key)
+
+    def get(self, key: str, images_output_dir: Optional[str] = None) -> Optional[List[Document]]:
+        """命中时返回docs，并把缓存的图片复制到images_output_dir；未命中返回None，条目损坏时删除条目并返回None"""
+        entry = self.entry_path(key)
+        try:
+            with open(os.path.join(entry, self.DOCS_FILE), 'rb') as f:
+                docs = pickle.load(f)
+            images_dir = os.path.join(entry, self.IMAGES_DIR)
+            if images_output_dir and os.path.isdir(images_dir):
+                os.makedirs(images_output_dir, exist_ok=True)
+                for image in os.listdir(images_dir):
+                    shutil.copy(os.path.join(images_dir, image), images_output_dir)
+            # 刷新mtime，淘汰时按最近访问时间排序
+            os.utime(entry)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        except Exception as e:
+            insert_logger.warning(f"parse cache read error: {key}, {traceback.format_exc()}")
+            # 删除损坏的条目，否则put发现目录已存在不会重写，这个key会一直未命中
+            shutil.rmtree(entry, ignore_errors=True)
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return docs
+
+    def put(self, key: str, docs: List[Document], markdown_file: Optional[str] = None):
+        """写入一个条目，失败只记日志，不影响入库"""
+        entry = self.entry_path(key)
+        if os.path.exists(entry):
+            return
+        tmp_entry = os.path.join(self.root_path, f".tmp-{uuid.uuid4().hex}")
+        try:
+            os.makedirs(tmp_entry)
+            with open(os.path.join(tmp_entry, self.DOCS_FILE), 'wb') as f:
+                pickle.dump(docs, f, protocol=pickle.HIGHEST_PROTOCOL)
+            if markdown_file:
+                shutil.copy(markdown_file, os.path.join(tmp_entry, self.MARKDOWN_FILE))
+                images_dir = os.path.join(tmp_entry, self.IMAGES_DIR)
+                os.makedirs(images_dir)
+                markdown_dir = os.path.dirname(markdown_file)
+                for image in os.listdir(markdown_dir):
+                    if image.endswith('.jpg'):
+                        shutil.copy(os.path.join(markdown_dir, image), images_dir)
+            size = self.dir_size(tmp_entry)
+            with open(os.path.join(tmp_entry, self.META_FILE), 'w') as f:
+                json.dump({'size': size, 'created': time.time(), 'docs': len(docs)}, f)
+            if size > self.max_bytes:
+                insert_logger.info(f"parse cache skip: {key}, size {size} > {self.max_bytes}")
+                return
+            try:
+                os.rename(tmp_entry, entry)
+            except OSError:
+                # 其他进程已经写入了同一个key
+                return
+            insert_logger.info(f"parse cache put: {key}, docs: {len(docs)}, size: {size}")
+        except Exception as e:
+            insert_logger.warning(f"parse cache write error: {key}, {traceback.format_exc()}")
+            return
+        finally:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict()
+
+    @staticmethod
+    def dir_size(path: str) -> int:
+        size = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return size
+
+    def entry_size(self, entry: str) -> int:
+        try:
+            with open(os.path.join(entry, self.META_FILE)) as f:
+                return json.load(f)['size']
+        except Exception:
+            return self.dir_size(entry)
+
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.root_path) as it:
+            for item in it:
+                if item.name.startswith('.') or not item.is_dir():
+                    continue
+                try:
+                    mtime = item.stat().st_mtime
+                except OSError:
+                    continue
+                size = self.entry_size(item.path)
+                entries.append((mtime, size, item.path))
+                total += size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            insert_logger.info(f"parse cache evict: {os.path.basename(path)}, size: {size}")
@@ -0,0 +1,61 @@
+from collections import OrderedDict
+from typing import List, Optional, Dict, Tuple
+from langchain_core.documents import Document
+from qanything_kernel.utils.custom_log import debug_logger
+import threading
+import copy
+import time
+
+
+class RetrievalCache:
+    """检索结果缓存：缓存milvus/es检索 + mysql父文档 + rerank之后的source_documents。
+
+    key里带上各个知识库的版本号（KnowledgeBase.version），文件入库完成或被删除时版本号递增，
+    旧key自然不再命中，再由LRU淘汰；TTL兜底防止长时间不变的知识库返回过旧的结果。
+    """
+
+    def __init__(self, capacity: int, ttl: Optional[float] = None):
+        self.capacity = capacity
+        self.ttl = ttl if ttl and ttl > 0 else None
+        self.cache = OrderedDict()  # key -> (timestamp, documents)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(retrieval_query: str, condense_question: str, kb_ids: List[str], kb_versions: Dict[str, int],
+                 top_k: int, hybrid_search: bool, rerank: bool, rerank_top_n: int = 0) -> Tuple:
+        sorted_kb_ids = tuple(sorted(kb_ids))
+        versions = tuple(kb_versions.get(kb_id, 0) for kb_id in sorted_kb_ids)
+        return (retrieval_query, condense_question, sorted_kb_ids, versions, top_k, bool(hybrid_search), bool(rerank),
+                rerank_top_n)
+
+    def get(self, key: Tuple) -> Optional[List[Document]]:
+        with self.lock:
+            item = self.cache.get(key)
+            if item is None or (self.ttl is not None and time.time() - item[0] > self.ttl):
+                if item is not None:
+                    self.cache.pop(key)
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            documents = item[1]
+        # 后续流程会修改page_content和metadata，返回副本
+        return copy.deepcopy(documents)
+
+    def put(self, key: Tuple, documents: List[Document]):
+        documents = copy.deepcopy(documents)
+        with self.lock:
+            self.cache[key] = (time.time(), documents)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+        debug_logger.info(f"retrieval cache put, size: {len(self.cache)}")
+
+    def stats(self) -> Dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': round(self.hits / total, 4) if total else 0.0,
+                    'size': len(self.cache), 'capacity': self.capacity}
@@ -1,36 +1,156 @@
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-from typing import Optional, List, Any, Iterable, Callable
+from typing import Optional, List, Any, Iterable, Callable, Dict
 from qanything_kernel.utils.custom_log import debug_logger, insert_logger
-from qanything_kernel.configs.model_config import MILVUS_PORT, MILVUS_COLLECTION_NAME, MILVUS_HOST_LOCAL
+from qanything_kernel.configs.model_config import MILVUS_PORT, MILVUS_COLLECTION_NAME, MILVUS_HOST_LOCAL, \
+    EMBED_DEDUPE_MILVUS, EMBED_DEDUPE_LOOKUP_BATCH, EMBED_DEDUPE_LOOKUP_TIMEOUT, MILVUS_FLUSH_ROWS, MILVUS_FLUSH_INTERVAL
 from qanything_kernel.connector.embedding.embedding_for_online_client import YouDaoEmbeddings
+from qanything_kernel.connector.embedding.embedding_cache import embedding_cache_key
 from qanything_kernel.utils.general_utils import get_time, get_time_async
 from langchain_community.vectorstores.milvus import Milvus
 from pymilvus.orm.collection import MutationResult
 import asyncio
 import time
 
+# 子文档的(模型版本, 归一化文本)hash，与向量缓存的key一致，入库时用来复用已有向量
+EMBED_KEY_FIELD = 'embed_key'
+# embed_key上的标量索引，没有索引时按key查找是全集合扫描，比重新计算向量还慢
+EMBED_KEY_INDEX = 'embed_key_index'
+
+
+class MilvusFlushCoordinator:
+    """
+    合并一个集合的flush请求：未flush的行数达到row_threshold时立即flush，否则在第一次未flush的插入之后
+    interval秒flush；同一时间最多一个flush在执行，执行期间新插入的行在这次flush结束后再处理。
+    每个文件插入后都flush会产生大量很小的sealed segment，compaction压力大，检索延迟也会变差。
+
+    行数和时间窗口按进程统计；调用set_shared_state之后多个入库worker通过mysql中的MilvusFlush表协调：
+    flush前先看其他worker最近一次完成的flush是否在本进程最后一次插入之后开始（flush是整个集合的，
+    已经覆盖了本进程的数据，直接跳过），否则领取该集合的flush租约，保证所有worker同时最多一个flush。
+    """
+    SHARED_LEASE_SECONDS = 300
+    SHARED_POLL_SECONDS = 1
+
+    def __init__(self, flush_func: Callable[[], Any], row_threshold: int, interval: float):
+        self.flush_func = flush_func  # 同步的flush函数，在线程中执行
+        self.row_threshold = max(row_threshold, 1)
+        self.interval = interval
+        self.inserted_rows = 0  # 累计插入行数
+        self.flushed_rows = 0  # 最近一次成功的flush覆盖到的累计行数
+        self.flush_task: Optional[asyncio.Task] = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.flush_count = 0
+        self.skipped_count = 0
+        self.last_insert_time = 0.0
+        self.shared = None  # (mysql_client, collection_name, owner)
+
+    def set_shared_state(self, mysql_client, collection_name: str, owner: str):
+        self.shared = (mysql_client, collection_name, owner)
+
+    @property
+    def pending_rows(self) -> int:
+        return self.inserted_rows - self.flushed_rows
+
+    def add_rows(self, rows: int):
+        """插入rows行之后调用，按行数和时间窗口安排flush"""
+        self.inserted_rows += rows
+        self.last_insert_time = time.time()
+        if self.flush_task is not None:
+            # flush结束后会根据剩余行数重新安排
+            return
+        if self.pending_rows >= self.row_threshold:
+            self._start_flush()
+        else:
+            self._schedule()
+
+    def _schedule(self):
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.interval, self._start_flush)
+
+    def _start_flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.flush_task is None:
+            self.flush_task = asyncio.get_running_loop().create_task(self._run_flush())
+
+    async def _shared_flush(self, target_time: float) -> bool:
+        """多worker协调的flush，返回是否由本进程执行了flush；被其他worker的flush覆盖时返回False"""
+        mysql_client, collection_name, owner = self.shared
+        while True:
+            last_flush_start = await asyncio.to_thread(mysql_client.get_milvus_last_flush, collection_name)
+            if last_flush_start >= target_time:
+                return False
+            acquired = await asyncio.to_thread(mysql_client.acquire_milvus_flush, collection_name, owner,
+                                               self.SHARED_LEASE_SECONDS)
+            if acquired is None:
+                # mysql不可用时退化为本进程独立flush
+                await asyncio.to_thread(self.flush_func)
+                return True
+            if acquired:
+                break
+            # 其他worker正在flush，等它完成后大概率已经覆盖本进程的数据
+            await asyncio.sleep(self.SHARED_POLL_SECONDS)
+        flush_start = time.time()
+        try:
+            await asyncio.to_thread(self.flush_func)
+        except Exception:
+            await asyncio.to_thread(mysql_client.release_milvus_flush, collection_name, owner)
+            raise
+        await asyncio.to_thread(mysql_client.release_milvus_flush, collection_name, owner, flush_start)
+        return True
+
+    async def _run_flush(self) -> bool:
+        target = self.inserted_rows
+        target_time = self.last_insert_time
+        rows = target - self.flushed_rows
+        start = time.perf_counter()
+        try:
+            if self.shared is None:
+                await asyncio.to_thread(self.flush_func)
+                flushed = True
+            else:
+                flushed = await self._shared_flush(target_time)
+            self.flushed_rows = max(self.flushed_rows, target)
+            if flushed:
+                self.flush_count += 1
+            else:
+                self.skipped_count += 1
+            insert_logger.info(f"milvus flush {'done' if flushed else 'covered by other worker'}, rows: {rows}, "
+                               f"cost: {time.perf_counter() - start:.2f}s, flush count: {self.flush_count}, "
+                               f"skipped: {self.skipped_count}")
+            ok = True
+        except Exception as e:
+            insert_logger.error(f"milvus flush error, rows: {rows}, {e}")
+            ok = False
+        finally:
+            self.flush_task = None
+        if self.pending_rows >= self.row_threshold and ok:
+            self._start_flush()
+        elif self.pending_rows > 0:
+            # flush失败时也等一个时间窗口再重试，避免连续重试
+            self._schedule()
+        return ok
+
+    async def flush(self) -> bool:
+        """等待调用之前插入的行全部flush完成（读己之写），flush失败返回False"""
+        target = self.inserted_rows
+        while self.flushed_rows < target:
+            if self.flush_task is None:
+                self._start_flush()
+            if not await asyncio.shield(self.flush_task):
+                return False
+        return True
+
 
 class SelfMilvus(Milvus):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.last_flush_time = 0  # 初始化为0，确保首次调用_should_flush时返回True
-        self.inserted_since_last_flush = 0
-        self.flush_interval = 600  # 600 seconds
-        self.flush_threshold = 10000  # 10,000 entities
-
-    def _should_flush(self) -> bool:
-        current_time = time.time()
-        time_since_last_flush = current_time - self.last_flush_time
-        return (self.inserted_since_last_flush >= self.flush_threshold or
-                time_since_last_flush >= self.flush_interval or self.last_flush_time == 0)
+        self.flusher = MilvusFlushCoordinator(self._flush_collection, MILVUS_FLUSH_ROWS, MILVUS_FLUSH_INTERVAL)
+        self.embed_key_indexed = None  # 集合上是否有embed_key索引，首次用到时检查一次
 
-    @get_time
-    def _milvus_flush(self):
-        asyncio.create_task(asyncio.to_thread(self.col.flush))
-        self.last_flush_time = time.time()
-        self.inserted_since_last_flush = 0
-        insert_logger.info(f"Flushed Milvus collection at {self.last_flush_time}")
+    def _flush_collection(self):
+        self.col.flush()
 
     def _create_collection(
             self, embeddings: list, metadatas: Optional[list[dict]] = None
@@ -79,6 +199,10 @@ class SelfMilvus(Milvus):
         fields.append(
             FieldSchema(self._text_field, DataType.VARCHAR, max_length=65_535)
         )
+        # Create the embed key field, 用于跨文件复用相同文本的向量
+        fields.append(
+            FieldSchema(EMBED_KEY_FIELD, DataType.VARCHAR, max_length=64)
+        )
         # Create the primary key field
         if self.auto_id:
             fields.append(
@@ -120,6 +244,8 @@ class SelfMilvus(Milvus):
             # Set the collection properties if they exist
             if self.collection_properties is not None:
                 self.col.set_properties(self.collection_properties)
+            self.col.create_index(EMBED_KEY_FIELD, index_params={"index_type": "INVERTED"},
+                                  index_name=EMBED_KEY_INDEX)
         except MilvusException as e:
             debug_logger.error(
                 "Failed to create collection: %s error: %s", self.collection_name, e
@@ -164,23 +290,86 @@ class SelfMilvus(Milvus):
     ) -> List[str]:
         """Asynchronously run texts through embeddings and add to the vectorstore."""
         # 从kwargs中获取time_record
-        time_record = kwargs.get('time_record', {})
-
-        from pymilvus import Collection, MilvusException
-
+        time_record = kwargs.pop('time_record', {})
         texts = list(texts)
-        if not self.auto_id:
-            assert isinstance(ids, list), "A list of valid ids are required when auto_id is False."
-            assert len(set(ids)) == len(texts), "Different lengths of texts and unique ids are provided."
-            assert all(len(x.encode()) <= 65_535 for x in ids), "Each id should be a string less than 65535 bytes."
+        embeddings = await self.aembed_texts(texts, time_record=time_record)
+        return await self.ainsert_embeddings(texts, embeddings, metadatas, timeout, batch_size, ids=ids,
+                                             time_record=time_record, **kwargs)
 
+    async def aembed_texts(self, texts: List[str], time_record: Optional[dict] = None) -> List[List[float]]:
+        """只做向量化，入库流水线中embedding和写入milvus是两个独立的阶段"""
+        time_record = time_record if time_record is not None else {}
         # Assuming self.embedding_func has an async method embed_documents_async
         embedding_start = time.perf_counter()
         try:
-            embeddings = await self.embedding_func.aembed_documents(texts)
+            if isinstance(self.embedding_func, YouDaoEmbeddings):
+                stats = {}
+                lookup = self.alookup_embeddings if await self._aembed_dedupe_enabled() else None
+                # 入库的chunk只读缓存不写缓存，缓存留给重复的查询
+                embeddings = await self.embedding_func.aembed_documents(texts, stats=stats, lookup=lookup,
+                                                                        write_cache=False)
+                time_record.update(stats)
+            else:
+                embeddings = await self.embedding_func.aembed_documents(texts)
         except NotImplementedError:
             embeddings = [await self.embedding_func.aembed_query(x) for x in texts]
         time_record['milvus_embedding_time'] = round(time.perf_counter() - embedding_start, 2)
+        return embeddings
+
+    def _embed_keys(self, texts: List[str]) -> List[str]:
+        return [embedding_cache_key(self.embedding_func.embed_version, text) for text in texts]
+
+    async def _aembed_dedupe_enabled(self) -> bool:
+        # 旧集合没有embed_key字段或索引，无法高效地按hash查找，只用本地向量缓存
+        from pymilvus import Collection
+        if not EMBED_DEDUPE_MILVUS or not isinstance(self.col, Collection) or EMBED_KEY_FIELD not in self.fields:
+            return False
+        if self.embed_key_indexed is None:
+            try:
+                self.embed_key_indexed = await asyncio.to_thread(self.col.has_index, index_name=EMBED_KEY_INDEX)
+            except Exception as e:
+                insert_logger.warning(f"check embed_key index error: {e}")
+                return False
+            if not self.embed_key_indexed:
+                insert_logger.warning(f"{self.collection_name} has no {EMBED_KEY_INDEX}, skip milvus embedding lookup")
+        return self.embed_key_indexed
+
+    async def alookup_embeddings(self, keys: List[str]) -> Dict[str, List[float]]:
+        """按embed_key查找milvus中已入库的向量，同一个key有多条时取任意一条"""
+        found = {}
+        for i in range(0, len(keys), EMBED_DEDUPE_LOOKUP_BATCH):
+            batch = keys[i:i + EMBED_DEDUPE_LOOKUP_BATCH]
+            # 同一个key可能入库过多次，limit按key数放大几倍，查不全的key交给embedding服务计算
+            rows = await asyncio.wait_for(asyncio.to_thread(
+                self.col.query, expr=f'{EMBED_KEY_FIELD} in {batch}',
+                output_fields=[EMBED_KEY_FIELD, self._vector_field], limit=len(batch) * 4),
+                timeout=EMBED_DEDUPE_LOOKUP_TIMEOUT)
+            for row in rows:
+                found.setdefault(row[EMBED_KEY_FIELD], list(row[self._vector_field]))
+        insert_logger.info(f"milvus embedding lookup: {len(found)}/{len(keys)}")
+        return found
+
+    async def ainsert_embeddings(
+            self,
+            texts: List[str],
+            embeddings: List[List[float]],
+            metadatas: Optional[List[dict]] = None,
+            timeout: Optional[int] = None,
+            batch_size: int = 1000,
+            *,
+            ids: Optional[List[str]] = None,
+            time_record: Optional[dict] = None,
+            **kwargs: Any,
+    ) -> List[str]:
+        """把已经算好的向量写入milvus"""
+        time_record = time_record if time_record is not None else {}
+
+        from pymilvus import Collection, MilvusException
+
+        if not self.auto_id:
+            assert isinstance(ids, list), "A list of valid ids are required when auto_id is False."
+            assert len(set(ids)) == len(texts), "Different lengths of texts and unique ids are provided."
+            assert all(len(x.encode()) <= 65_535 for x in ids), "Each id should be a string less than 65535 bytes."
 
         if len(embeddings) == 0:
             insert_logger.info("Nothing to insert, skipping.")
@@ -206,6 +395,9 @@ class SelfMilvus(Milvus):
         if not self.auto_id:
             insert_dict[self._primary_field] = ids
 
+        if EMBED_KEY_FIELD in self.fields:
+            insert_dict[EMBED_KEY_FIELD] = self._embed_keys(texts)
+
         if self._metadata_field is not None:
             for d in metadatas or []:
                 insert_dict.setdefault(self._metadata_field, []).append(d)
@@ -250,15 +442,9 @@ class SelfMilvus(Milvus):
                     "Failed to insert batch starting at entity: %s/%s", i, total_count
                 )
                 raise e
-            self.inserted_since_last_flush += end - i
+            self.flusher.add_rows(end - i)
 
         time_record['milvus_insert_time'] = round(time.perf_counter() - insert_start, 2)
-
-        asyncio.create_task(asyncio.to_thread(self.col.flush))
-        # if self._should_flush():
-        #     self._milvus_flush()
-
-        # self.col.flush()
         return pks
 
 
@@ -289,13 +475,15 @@ class VectorStoreMilvusClient:
     #     debug_logger.info(f'milvus delete chunk number: {len(chunk_ids)} res: {res}')
 
     @get_time
-    def delete_expr(self, expr):
-        # 如果expr为空，则不执行删除操作
-        if len(self.get_local_chunks(expr)) == 0:
-            debug_logger.info(f'expr: {expr} not found in local milvus')
+    def delete_expr(self, expr, timeout=10, raise_error=False):
+        # 直接按表达式删除，没有匹配的数据时milvus的delete也很快，不需要先查一遍主键
+        if self.local_vectorstore.col is None:
+            debug_logger.info(f'expr: {expr} skipped, local milvus collection not created')
             return
         try:
-            res = self.local_vectorstore.delete(expr=expr, timeout=10)
+            res = self.local_vectorstore.delete(expr=expr, timeout=timeout)
             debug_logger.info(f'local milvus delete expr: {expr} res: {res}')
         except Exception as e:
             debug_logger.error(f'local milvus delete expr: {expr} error: {e}')
+            if raise_error:
+                raise
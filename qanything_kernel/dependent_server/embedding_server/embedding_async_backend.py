@@ -1,90 +1,132 @@
 import asyncio
 import time
-import numpy as np
-from onnxruntime import SessionOptions, GraphOptimizationLevel, InferenceSession
+from typing import List
 from concurrent.futures import ThreadPoolExecutor
-from transformers import AutoTokenizer
 from qanything_kernel.utils.custom_log import embed_logger
-from qanything_kernel.configs.model_config import LOCAL_EMBED_MAX_LENGTH, LOCAL_EMBED_PATH, LOCAL_EMBED_BATCH
-from qanything_kernel.utils.general_utils import get_time, get_time_async
+from qanything_kernel.configs.model_config import LOCAL_EMBED_MAX_LENGTH, LOCAL_EMBED_MAX_BATCH_SIZE, \
+    LOCAL_EMBED_MAX_BATCH_TOKENS, LOCAL_EMBED_MAX_WAIT_MS
+from qanything_kernel.utils.general_utils import get_time_async
 
 
 class EmbeddingAsyncBackend:
-    def __init__(self, model_path, use_cpu=True, num_threads=4):
-        self.use_cpu = use_cpu
-        self.return_tensors = "np"
-        sess_options = SessionOptions()
-        sess_options.graph_optimization_level = GraphOptimizationLevel.ORT_ENABLE_ALL
-
-        if use_cpu:
-            providers = ['CPUExecutionProvider']
-            self.executor = ThreadPoolExecutor(max_workers=num_threads)
-            self.batch_size = LOCAL_EMBED_BATCH  # CPU批处理大小
-        else:
-            providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
-            self.executor = ThreadPoolExecutor(max_workers=num_threads)
-            self.batch_size = 16  # GPU批处理大小固定为16
-
-        self.session = InferenceSession(model_path, sess_options=sess_options, providers=providers)
-        self._tokenizer = AutoTokenizer.from_pretrained(LOCAL_EMBED_PATH, use_fast=True)  # 请根据实际使用的模型调整
+    """动态micro-batching调度器：
+
+    所有请求的文本拆成单条进入队列，调度协程在max_wait_ms窗口内尽量多地收集文本，
+    按估计的token长度排序后装箱成batch（padding后的token数不超过max_batch_tokens，条数不超过max_batch_size），
+    在线程池中推理，结果再按原顺序分发回各自的请求。
+    """
+
+    def __init__(self, onnx_backend, num_threads=1, max_batch_size=LOCAL_EMBED_MAX_BATCH_SIZE,
+                 max_batch_tokens=LOCAL_EMBED_MAX_BATCH_TOKENS, max_wait_ms=LOCAL_EMBED_MAX_WAIT_MS):
+        self.onnx_backend = onnx_backend
+        self.max_length = LOCAL_EMBED_MAX_LENGTH
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max(max_batch_tokens, self.max_length)
+        self.max_wait = max_wait_ms / 1000
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        # 限制同时在执行器里跑的batch数，其余的继续留在队列里参与后续装箱
+        self.inflight = asyncio.Semaphore(num_threads)
 
         self.queue = asyncio.Queue()
-        asyncio.create_task(self.process_queue())
+        self.metrics = {'requests': 0, 'texts': 0, 'batches': 0, 'batched_texts': 0, 'last_batch_size': 0,
+                        'last_batch_tokens': 0, 'max_batch_size': 0, 'inflight_batches': 0}
+        self.task = asyncio.create_task(self.process_queue())
+
+    def token_lengths(self, texts: List[str]) -> List[int]:
+        # 只用于装箱的长度估计：字符数+特殊token，中文约一字一token，英文会高估，batch偏小但不会超预算。
+        # 不在事件循环上跑tokenizer，也避免和执行器线程里的predict并发使用同一个fast tokenizer
+        return [min(len(text) + 2, self.max_length) for text in texts]
 
     @get_time_async
-    async def embed_documents_async(self, texts):
+    async def embed_documents_async(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        loop = asyncio.get_running_loop()
+        lengths = self.token_lengths(texts)
         futures = []
-        # 设置mini_batch=1，每次处理1个文本
-        mini_batch = 1
-        for i in range(0, len(texts), mini_batch):
-            future = asyncio.Future()
+        for text, length in zip(texts, lengths):
+            future = loop.create_future()
             futures.append(future)
-            await self.queue.put((texts[i:i + mini_batch], future))
-
-        results = await asyncio.gather(*futures)
-        return [item for sublist in results for item in sublist]
-
-    # @get_time
-    @get_time
-    def embed_documents(self, texts):
-        inputs_onnx = self._tokenizer(texts, padding=True, truncation=True, max_length=LOCAL_EMBED_MAX_LENGTH,
-                                      return_tensors=self.return_tensors)
-        inputs_onnx = {k: v for k, v in inputs_onnx.items()}
-
-        # start_time = time.time()
-        outputs_onnx = self.session.run(output_names=['output'], input_feed=inputs_onnx)
-        # debug_logger.info(f"onnx infer time: {time.time() - start_time}")
-
-        embedding = outputs_onnx[0][:, 0]
-        embed_logger.info(f'embedding shape: {embedding.shape}')
-
-        norm_arr = np.linalg.norm(embedding, axis=1, keepdims=True)
-        embeddings_normalized = embedding / norm_arr
-
-        return embeddings_normalized.tolist()
+            self.queue.put_nowait((text, length, future))
+        self.metrics['requests'] += 1
+        self.metrics['texts'] += len(texts)
+        return list(await asyncio.gather(*futures))
+
+    def pack_batches(self, items):
+        """按token长度排序后贪心装箱，相近长度的文本放在同一个batch里以减少padding"""
+        items = sorted(items, key=lambda x: x[1])
+        batches = []
+        batch = []
+        for item in items:
+            # 排过序，加入当前item后batch的padding长度就是item自己的长度
+            if batch and (len(batch) + 1 > self.max_batch_size or
+                          (len(batch) + 1) * item[1] > self.max_batch_tokens):
+                batches.append(batch)
+                batch = []
+            batch.append(item)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def collect_items(self):
+        # 阻塞等待第一条，然后在max_wait窗口内继续收集，直到攒够一个满batch的token预算
+        first = await self.queue.get()
+        items = [first]
+        deadline = time.perf_counter() + self.max_wait
+        budget_tokens = first[1]
+        while budget_tokens < self.max_batch_tokens and len(items) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                break
+            items.append(item)
+            budget_tokens += item[1]
+        # 窗口结束时队列中已有的也一起装箱
+        while not self.queue.empty() and len(items) < self.max_batch_size * 4:
+            items.append(self.queue.get_nowait())
+        return items
+
+    async def run_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        texts = [text for text, _, _ in batch]
+        self.metrics['inflight_batches'] += 1
+        try:
+            embeddings = await loop.run_in_executor(self.executor, self.onnx_backend.predict, texts, len(texts))
+            for (_, _, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+        except Exception as e:
+            embed_logger.error(f"embedding batch error: {e}")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.metrics['inflight_batches'] -= 1
+            self.inflight.release()
 
     async def process_queue(self):
         while True:
-            batch_texts = []
-            futures = []
-
             try:
-                while len(batch_texts) < self.batch_size:
-                    texts, future = await asyncio.wait_for(self.queue.get(), timeout=0.01)
-                    batch_texts.extend(texts)
-                    futures.append((future, len(texts)))
-            except asyncio.TimeoutError:
-                pass
-
-            # debug_logger.info(f"process_queue embedding texts number: {len(batch_texts)}")
-            if batch_texts:
-                loop = asyncio.get_running_loop()
-                result = await loop.run_in_executor(self.executor, self.embed_documents, batch_texts)
-
-                start = 0
-                for future, text_count in futures:
-                    end = start + text_count
-                    future.set_result(result[start:end])
-                    start = end
-            else:
-                await asyncio.sleep(0.1)  # 如果没有文本要处理，短暂休眠
+                items = await self.collect_items()
+            except Exception as e:
+                embed_logger.error(f"embedding scheduler collect error: {e}")
+                continue
+            for batch in self.pack_batches(items):
+                await self.inflight.acquire()
+                self.metrics['batches'] += 1
+                self.metrics['batched_texts'] += len(batch)
+                self.metrics['last_batch_size'] = len(batch)
+                self.metrics['last_batch_tokens'] = len(batch) * batch[-1][1]
+                self.metrics['max_batch_size'] = max(self.metrics['max_batch_size'], len(batch))
+                embed_logger.info(f"embedding batch size: {len(batch)}, padded length: {batch[-1][1]}, "
+                                  f"queue depth: {self.queue.qsize()}")
+                asyncio.create_task(self.run_batch(batch))
+
+    def get_metrics(self):
+        metrics = dict(self.metrics)
+        metrics['queue_depth'] = self.queue.qsize()
+        metrics['avg_batch_size'] = round(metrics['batched_texts'] / metrics['batches'], 2) if metrics['batches'] else 0
+        return metrics
@@ -5,7 +5,8 @@ from numpy import ndarray
 import torch
 from torch import Tensor
 from onnxruntime import InferenceSession, SessionOptions, GraphOptimizationLevel
-from qanything_kernel.configs.model_config import LOCAL_EMBED_MODEL_PATH, LOCAL_EMBED_PATH, LOCAL_EMBED_BATCH, LOCAL_RERANK_MAX_LENGTH
+from qanything_kernel.configs.model_config import LOCAL_EMBED_MODEL_PATH, LOCAL_EMBED_PATH, LOCAL_EMBED_BATCH, \
+    LOCAL_RERANK_MAX_LENGTH, LOCAL_EMBED_PAD_TO_MULTIPLE_OF
 from qanything_kernel.utils.custom_log import debug_logger
 from transformers import AutoTokenizer
 from qanything_kernel.dependent_server.embedding_server.embedding_backend import EmbeddingBackend
@@ -17,6 +18,7 @@ class EmbeddingOnnxBackend:
         self.return_tensors = "np"
         self.batch_size = LOCAL_EMBED_BATCH
         self.max_length = LOCAL_RERANK_MAX_LENGTH
+        self.pad_to_multiple_of = LOCAL_EMBED_PAD_TO_MULTIPLE_OF
         sess_options = SessionOptions()
         sess_options.intra_op_num_threads = 0
         sess_options.inter_op_num_threads = 0
@@ -85,25 +87,24 @@ class EmbeddingOnnxBackend:
         using_time_tokenizer = 0
         using_time_model = 0
 
-        total_batch = len(sentence) // batch_size + (1 if len(sentence) % batch_size > 0 else 0)
-        for batch_id in range(total_batch):
+        if tokenizer is None:
+            tokenizer = self._tokenizer
+        # 先整体分词一次（不padding），按token长度排序后再切batch，相近长度的句子放在一起以减少padding
+        start_time_tokenizer = time.time()
+        all_inputs = tokenizer(sentence, padding=False, truncation=True, max_length=max_length)
+        lengths = [len(ids) for ids in all_inputs['input_ids']]
+        sorted_idxs = sorted(range(len(sentence)), key=lambda i: lengths[i])
+        using_time_tokenizer += (time.time() - start_time_tokenizer)
+
+        for batch_start in range(0, len(sorted_idxs), batch_size):
             start_time_tokenizer = time.time()
-            if tokenizer is not None:
-                inputs = tokenizer(
-                    sentence[batch_id * batch_size:(batch_id + 1) * batch_size],
-                    padding=True,
-                    truncation=True,
-                    max_length=max_length,
-                    return_tensors="np"
-                )
-            else:
-                inputs = self._tokenizer(
-                    sentence[batch_id * batch_size:(batch_id + 1) * batch_size],
-                    padding=True,
-                    truncation=True,
-                    max_length=max_length,
-                    return_tensors="np"
-                )
+            batch_idxs = sorted_idxs[batch_start:batch_start + batch_size]
+            batch_features = [{k: v[i] for k, v in all_inputs.items()} for i in batch_idxs]
+            # 补齐到pad_to_multiple_of的整数倍，形状种类变少，ORT可以复用内存池
+            pad_length = max(lengths[i] for i in batch_idxs)
+            if self.pad_to_multiple_of:
+                pad_length = min(-(-pad_length // self.pad_to_multiple_of) * self.pad_to_multiple_of, max_length)
+            inputs = tokenizer.pad(batch_features, padding='max_length', max_length=pad_length, return_tensors="np")
             using_time_tokenizer += (time.time() - start_time_tokenizer)
             if return_tokens_num:
                 tokens_num += (inputs['attention_mask'].sum().item() - 2 * inputs['attention_mask'].shape[0])
@@ -119,7 +120,10 @@ class EmbeddingOnnxBackend:
                 embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
             embedding_list.append(embeddings)
 
-        embeddings = np.concatenate(embedding_list, axis=0)
+        # 恢复原始顺序
+        sorted_embeddings = np.concatenate(embedding_list, axis=0)
+        embeddings = np.empty_like(sorted_embeddings)
+        embeddings[sorted_idxs] = sorted_embeddings
 
         if single_sentence and not keepdim:
             embeddings = embeddings[0]
@@ -136,9 +140,9 @@ class EmbeddingOnnxBackend:
         else:
             return embeddings
 
-    def predict(self, queries, return_tokens_num=False):
+    def predict(self, queries, batch_size=None, return_tokens_num=False):
         embeddings = self.encode(
-            queries, batch_size=self.batch_size, normalize_to_unit=True, return_numpy=True, max_length=self.max_length,
+            queries, batch_size=batch_size or self.batch_size, normalize_to_unit=True, return_numpy=True, max_length=self.max_length,
             tokenizer=self._tokenizer,
             return_tokens_num=return_tokens_num
         )
@@ -14,7 +14,7 @@ from sanic import Sanic
 from sanic.response import json
 from qanything_kernel.dependent_server.embedding_server.embedding_async_backend import EmbeddingAsyncBackend
 from qanything_kernel.dependent_server.embedding_server.embedding_onnx_backend import EmbeddingOnnxBackend
-from qanything_kernel.configs.model_config import LOCAL_EMBED_MODEL_PATH, LOCAL_EMBED_THREADS
+from qanything_kernel.configs.model_config import LOCAL_EMBED_THREADS
 from qanything_kernel.utils.general_utils import get_time_async
 import argparse
 
@@ -37,21 +37,26 @@ async def embedding(request):
     texts = data.get('texts')
     # print("local embedding texts number:", len(texts), flush=True)
 
-    # onnx_backend: EmbeddingAsyncBackend = request.app.ctx.onnx_backend
-    onnx_backend: EmbeddingOnnxBackend = request.app.ctx.onnx_backend
-    # result_data = await onnx_backend.embed_documents_async(texts)
-    result_data = onnx_backend.predict(texts)
+    # 请求进入动态batch调度队列，推理在线程池中执行，不阻塞event loop
+    async_backend: EmbeddingAsyncBackend = request.app.ctx.async_backend
+    result_data = await async_backend.embed_documents_async(texts)
     # print("local embedding result number:", len(result_data), flush=True)
     # print("local embedding result:", result_data, flush=True)
 
     return json(result_data)
 
 
+@app.route("/metrics", methods=["GET"])
+async def metrics(request):
+    async_backend: EmbeddingAsyncBackend = request.app.ctx.async_backend
+    return json(async_backend.get_metrics())
+
+
 @app.listener('before_server_start')
 async def setup_onnx_backend(app, loop):
-    # app.ctx.onnx_backend = EmbeddingAsyncBackend(model_path=LOCAL_EMBED_MODEL_PATH,
-    #                                              use_cpu=not args.use_gpu, num_threads=LOCAL_EMBED_THREADS)
-    app.ctx.onnx_backend = EmbeddingOnnxBackend(use_cpu=not args.use_gpu)
+    onnx_backend = EmbeddingOnnxBackend(use_cpu=not args.use_gpu)
+    app.ctx.onnx_backend = onnx_backend
+    app.ctx.async_backend = EmbeddingAsyncBackend(onnx_backend, num_threads=LOCAL_EMBED_THREADS)
 
 
 if __name__ == "__main__":
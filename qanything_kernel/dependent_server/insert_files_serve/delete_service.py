@@ -0,0 +1,189 @@
+from qanything_kernel.utils.custom_log import insert_logger
+from qanything_kernel.configs.model_config import UPLOAD_ROOT_PATH, IMAGES_ROOT_PATH, DELETE_BATCH_SIZE, \
+    DELETE_POLL_MAX_INTERVAL
+from typing import List, Dict
+import traceback
+import asyncio
+import shutil
+import os
+
+# 删除任务的步骤，DeleteTasks.stage记录已经完成到哪一步
+STAGE_MILVUS = 1
+STAGE_ES = 2
+STAGE_MYSQL = 3
+STAGE_DISK = 4
+
+
+class DeleteTaskQueue:
+    """基于DeleteTasks表的删除任务队列，和FileJobQueue一样用SKIP LOCKED领取、租约防止worker崩溃后任务丢失：
+
+    - claim_batch: 一次领取一批pending（或租约过期的running）任务，置为running；
+    - advance: 每完成一个步骤就把stage写回，重启或重试时跳过已完成的步骤；
+    - fail: 失败的任务放回pending，超过最大尝试次数的置为failed。
+    """
+
+    TASK_FIELDS = ('id', 'user_id', 'kb_id', 'file_id', 'stage')
+
+    def __init__(self, pool, owner: str, lease_seconds: int, max_attempts: int):
+        self.pool = pool
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    async def claim_batch(self, limit: int) -> List[Dict]:
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                try:
+                    await cur.execute(f"""
+                        SELECT {', '.join(self.TASK_FIELDS)} FROM DeleteTasks
+                        WHERE (status = 'pending' OR (status = 'running' AND lease_expire < NOW()))
+                        AND attempts < %s
+                        ORDER BY id LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    """, (self.max_attempts, limit))
+                    rows = await cur.fetchall()
+                    if not rows:
+                        await conn.commit()
+                        return []
+                    ids = [row[0] for row in rows]
+                    await cur.execute(f"""
+                        UPDATE DeleteTasks SET status = 'running', lease_owner = %s,
+                        lease_expire = DATE_ADD(NOW(), INTERVAL %s SECOND), attempts = attempts + 1
+                        WHERE id IN ({','.join(['%s'] * len(ids))})
+                    """, (self.owner, self.lease_seconds, *ids))
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+        return [dict(zip(self.TASK_FIELDS, row)) for row in rows]
+
+    async def _update(self, query: str, params: tuple, ids: List[int]):
+        if not ids:
+            return
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query.format(','.join(['%s'] * len(ids))), (*params, *ids))
+                await conn.commit()
+
+    async def advance(self, ids: List[int], stage: int):
+        await self._update("UPDATE DeleteTasks SET stage = %s, "
+                           "lease_expire = DATE_ADD(NOW(), INTERVAL %s SECOND) WHERE id IN ({})",
+                           (stage, self.lease_seconds), ids)
+
+    async def complete(self, ids: List[int]):
+        await self._update("UPDATE DeleteTasks SET status = 'done', msg = '', lease_owner = NULL, "
+                           "lease_expire = NULL WHERE id IN ({})", (), ids)
+
+    async def fail(self, ids: List[int], msg: str):
+        await self._update("UPDATE DeleteTasks SET status = IF(attempts >= %s, 'failed', 'pending'), msg = %s, "
+                           "lease_owner = NULL, lease_expire = NULL WHERE id IN ({})",
+                           (self.max_attempts, msg[:1024]), ids)
+
+
+class DeleteService:
+    """
+    后台删除服务：把一批删除任务合并成按知识库/文件批量的milvus delete(expr)、es delete-by-query、
+    mysql父文档/FAQ批量删除，最后删除磁盘上的上传文件和图片。
+    接口里只做逻辑删除并登记任务，删除大知识库时不再阻塞handler。
+    """
+
+    def __init__(self, queue: DeleteTaskQueue, milvus_kb, es_client, mysql_client):
+        self.queue = queue
+        self.milvus_kb = milvus_kb
+        self.es_client = es_client
+        self.mysql_client = mysql_client
+
+    async def run(self):
+        sleep_time = 0.1
+        while True:
+            try:
+                tasks = await self.queue.claim_batch(DELETE_BATCH_SIZE)
+            except Exception as e:
+                insert_logger.error(f'claim delete tasks error: {e}')
+                tasks = []
+            if not tasks:
+                await asyncio.sleep(sleep_time)
+                sleep_time = min(sleep_time * 2, DELETE_POLL_MAX_INTERVAL)
+                continue
+            sleep_time = 0.1
+            await self.process(tasks)
+
+    async def process(self, tasks: List[Dict]):
+        kb_tasks = [t for t in tasks if t['file_id'] is None]
+        deleted_kb_ids = {t['kb_id'] for t in kb_tasks}
+        # 同一批里整库删除的任务已经覆盖了该知识库下的文件任务
+        file_tasks = [t for t in tasks if t['file_id'] is not None and t['kb_id'] not in deleted_kb_ids]
+        insert_logger.info(f"delete tasks: {len(tasks)}, kbs: {len(kb_tasks)}, files: {len(file_tasks)}")
+        kb_file_ids = {}
+        steps = [(STAGE_MILVUS, self.delete_milvus), (STAGE_ES, self.delete_es), (STAGE_MYSQL, self.delete_mysql),
+                 (STAGE_DISK, self.delete_disk)]
+        try:
+            for stage, step in steps:
+                todo_kbs = [t for t in kb_tasks if t['stage'] < stage]
+                todo_files = [t for t in file_tasks if t['stage'] < stage]
+                if not todo_kbs and not todo_files:
+                    continue
+                await step(todo_kbs, todo_files, kb_file_ids)
+                await self.queue.advance([t['id'] for t in todo_kbs + todo_files], stage)
+                for t in todo_kbs + todo_files:
+                    t['stage'] = stage
+        except Exception as e:
+            insert_logger.error(f'delete tasks error: {traceback.format_exc()}')
+            await self.queue.fail([t['id'] for t in tasks], str(e))
+            return
+        await self.queue.complete([t['id'] for t in tasks])
+        insert_logger.info(f"delete tasks done: {len(tasks)}")
+
+    async def get_kb_file_ids(self, kb_id, kb_file_ids):
+        if kb_id not in kb_file_ids:
+            kb_file_ids[kb_id] = await asyncio.to_thread(self.mysql_client.get_kb_file_ids, kb_id)
+        return kb_file_ids[kb_id]
+
+    @staticmethod
+    def group_by_kb(file_tasks):
+        groups = {}
+        for t in file_tasks:
+            groups.setdefault(t['kb_id'], []).append(t['file_id'])
+        return groups
+
+    async def delete_milvus(self, kb_tasks, file_tasks, kb_file_ids, batch_size=1000):
+        exprs = [f'kb_id == "{t["kb_id"]}"' for t in kb_tasks]
+        for kb_id, file_ids in self.group_by_kb(file_tasks).items():
+            for i in range(0, len(file_ids), batch_size):
+                exprs.append(f'kb_id == "{kb_id}" and file_id in {file_ids[i:i + batch_size]}')
+        for expr in exprs:
+            await asyncio.to_thread(self.milvus_kb.delete_expr, expr, 60, True)
+
+    async def delete_es(self, kb_tasks, file_tasks, kb_file_ids):
+        if kb_tasks:
+            await asyncio.to_thread(self.es_client.delete_kbs, [t['kb_id'] for t in kb_tasks])
+        if file_tasks:
+            await asyncio.to_thread(self.es_client.delete_files, [t['file_id'] for t in file_tasks])
+
+    async def delete_mysql(self, kb_tasks, file_tasks, kb_file_ids):
+        file_ids = [t['file_id'] for t in file_tasks]
+        for t in kb_tasks:
+            file_ids.extend(await self.get_kb_file_ids(t['kb_id'], kb_file_ids))
+        if file_ids:
+            await asyncio.to_thread(self.mysql_client.delete_documents_batch, file_ids)
+            await asyncio.to_thread(self.mysql_client.delete_faqs, file_ids)
+        # 检索来源都已清理，递增版本号使删除期间缓存的检索结果失效
+        kb_ids = list({t['kb_id'] for t in kb_tasks + file_tasks})
+        await asyncio.to_thread(self.mysql_client.bump_kb_version, kb_ids)
+
+    async def delete_disk(self, kb_tasks, file_tasks, kb_file_ids):
+        dirs = []
+        for t in kb_tasks:
+            dirs.append(os.path.join(UPLOAD_ROOT_PATH, t['user_id'], t['kb_id']))
+            file_ids = await self.get_kb_file_ids(t['kb_id'], kb_file_ids)
+            dirs.extend(os.path.join(IMAGES_ROOT_PATH, file_id) for file_id in file_ids)
+        for t in file_tasks:
+            dirs.append(os.path.join(UPLOAD_ROOT_PATH, t['user_id'], t['kb_id'], t['file_id']))
+            dirs.append(os.path.join(IMAGES_ROOT_PATH, t['file_id']))
+
+        def remove_dirs():
+            for path in dirs:
+                shutil.rmtree(path, ignore_errors=True)
+
+        await asyncio.to_thread(remove_dirs)
+        insert_logger.info(f"delete dirs: {len(dirs)}")
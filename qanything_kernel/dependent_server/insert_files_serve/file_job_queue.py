@@ -0,0 +1,107 @@
+from qanything_kernel.utils.custom_log import insert_logger
+from typing import Optional, Tuple
+
+
+class FileJobQueue:
+    """基于File表的入库任务队列：
+
+    - claim: SELECT ... FOR UPDATE SKIP LOCKED 原子地领取一个gray文件并置为yellow，多个worker之间不会抢到同一个文件；
+    - 领取时写入lease_owner和lease_expire（租约），处理期间由heartbeat定期续约；
+    - requeue_expired: 租约过期（worker崩溃、被kill）仍是yellow的文件重新置为gray，超过最大尝试次数的置为red。
+    """
+
+    FILE_INFO_FIELDS = "id, file_id, user_id, file_name, kb_id, file_location, file_size, file_url, chunk_size, " \
+                       "attempts"
+
+    def __init__(self, pool, owner: str, lease_seconds: int, max_attempts: int, small_file_first: bool = False):
+        self.pool = pool
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.order_by = "file_size ASC, timestamp ASC" if small_file_first else "timestamp ASC"
+
+    async def claim(self) -> Optional[Tuple]:
+        """领取一个待处理文件，返回(id, file_id, user_id, file_name, kb_id, file_location, file_size, file_url,
+        chunk_size, attempts)，attempts为包括本次在内的领取次数，没有待处理文件时返回None"""
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                try:
+                    await cur.execute(f"""
+                        SELECT {self.FILE_INFO_FIELDS} FROM File
+                        WHERE status = 'gray' AND deleted = 0
+                        ORDER BY {self.order_by} LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                    """)
+                    file_info = await cur.fetchone()
+                    if file_info is None:
+                        await conn.commit()
+                        return None
+                    await cur.execute("""
+                        UPDATE File SET status = 'yellow', lease_owner = %s,
+                        lease_expire = DATE_ADD(NOW(), INTERVAL %s SECOND), attempts = attempts + 1
+                        WHERE id = %s
+                    """, (self.owner, self.lease_seconds, file_info[0]))
+                    await conn.commit()
+                    file_info = file_info[:-1] + (file_info[-1] + 1,)
+                except Exception:
+                    await conn.rollback()
+                    raise
+        insert_logger.info(f"{self.owner} claimed file: {file_info}")
+        return file_info
+
+    async def heartbeat(self, id: int):
+        """续约，只续自己持有的租约"""
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("""
+                    UPDATE File SET lease_expire = DATE_ADD(NOW(), INTERVAL %s SECOND)
+                    WHERE id = %s AND status = 'yellow' AND lease_owner = %s
+                """, (self.lease_seconds, id, self.owner))
+                await conn.commit()
+
+    async def complete(self, id: int, status: str, content_length: int, chunks_number: int, msg: str) -> bool:
+        """只更新自己持有的yellow文件，租约已过期并被其他worker重新领取时不覆盖对方的结果"""
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("""
+                    UPDATE File SET status = %s, content_length = %s, chunks_number = %s, msg = %s,
+                    lease_owner = NULL, lease_expire = NULL
+                    WHERE id = %s AND status = 'yellow' AND lease_owner = %s
+                """, (status, content_length, chunks_number, msg, id, self.owner))
+                updated = cur.rowcount
+                await conn.commit()
+        if not updated:
+            insert_logger.warning(f"{self.owner} lost lease of file id {id}, status {status} not written")
+        return bool(updated)
+
+    async def fail(self, id: int):
+        """处理过程中出现异常，仍是自己持有的yellow文件直接置为red"""
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("""
+                    UPDATE File SET status = 'red', lease_owner = NULL, lease_expire = NULL
+                    WHERE id = %s AND status = 'yellow' AND lease_owner = %s
+                """, (id, self.owner))
+                await conn.commit()
+
+    async def requeue_expired(self) -> int:
+        """租约过期的yellow文件重新入队；lease_expire为空的yellow文件是旧版本遗留的，也视为过期"""
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("""
+                    UPDATE File SET status = 'red', msg = 'insert failed: exceeded max attempts',
+                    lease_owner = NULL, lease_expire = NULL
+                    WHERE status = 'yellow' AND deleted = 0 AND attempts >= %s
+                    AND (lease_expire IS NULL OR lease_expire < NOW())
+                """, (self.max_attempts,))
+                failed = cur.rowcount
+                await cur.execute("""
+                    UPDATE File SET status = 'gray', lease_owner = NULL, lease_expire = NULL
+                    WHERE status = 'yellow' AND deleted = 0
+                    AND (lease_expire IS NULL OR lease_expire < NOW())
+                """)
+                requeued = cur.rowcount
+                await conn.commit()
+        if failed or requeued:
+            insert_logger.warning(f"lease expired files: requeued {requeued}, marked red {failed}")
+        return requeued
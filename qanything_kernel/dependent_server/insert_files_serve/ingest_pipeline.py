@@ -0,0 +1,228 @@
+from qanything_kernel.utils.custom_log import insert_logger
+from qanything_kernel.core.retriever.general_document import LocalFileForInsert
+from qanything_kernel.configs.model_config import MAX_CHARS, INSERT_HEARTBEAT_SECONDS, MILVUS_FLUSH_BEFORE_GREEN
+import asyncio
+import traceback
+import random
+import time
+import json
+
+PARSE_TIMEOUT_SECONDS = 300
+INSERT_TIMEOUT_SECONDS = 300
+
+
+class IngestJob:
+    """一个文件在流水线中的上下文，随文件在各阶段之间传递"""
+
+    def __init__(self, file_info):
+        self.file_info = file_info
+        self.id, self.file_id, self.user_id, self.file_name, self.kb_id, self.file_location, self.file_size, \
+            self.file_url, self.chunk_size, self.attempts = file_info
+        self.time_record = {}
+        self.start = time.perf_counter()
+        self.content_length = -1
+        self.chunks_number = 0
+        self.local_file = None
+        self.embed_docs = None
+        self.full_docs = None
+        self.embeddings = None
+        self.heartbeat_task = None
+
+
+class IngestPipeline:
+    """多阶段入库流水线：parse -> split -> embed -> store。
+
+    阶段之间用有界队列连接，每个阶段有独立的并发数；下游队列满时上游阻塞在put上，形成背压。
+    解析（CPU）、向量化（网络）和写入milvus/es/mysql（IO）因此可以在不同文件之间重叠执行。
+    任一阶段失败都会把文件置为red，成功写入后置为green，并释放租约。
+    """
+
+    STAGES = ('parse', 'split', 'embed', 'store')
+
+    def __init__(self, job_queue, retriever, milvus_kb, es_client, mysql_client, concurrency: dict, queue_size: int,
+                 max_inflight: int):
+        self.job_queue = job_queue
+        self.retriever = retriever
+        self.milvus_kb = milvus_kb
+        self.es_client = es_client
+        self.mysql_client = mysql_client
+        self.concurrency = concurrency
+        self.queues = {stage: asyncio.Queue(maxsize=queue_size) for stage in self.STAGES}
+        self.handlers = {'parse': self.parse, 'split': self.split, 'embed': self.embed, 'store': self.store}
+        # 同时在流水线中的文件数上限，有空位时才去领取新文件
+        self.slots = asyncio.Semaphore(max_inflight)
+        self.tasks = []
+
+    def start(self):
+        for i, stage in enumerate(self.STAGES):
+            next_stage = self.STAGES[i + 1] if i + 1 < len(self.STAGES) else None
+            for _ in range(self.concurrency.get(stage, 1)):
+                self.tasks.append(asyncio.create_task(self.stage_worker(stage, next_stage)))
+        insert_logger.info(f"ingest pipeline started, concurrency: {self.concurrency}")
+
+    async def submit(self, file_info):
+        job = IngestJob(file_info)
+        insert_logger.info(f'Start insert file: {file_info}')
+        job.heartbeat_task = asyncio.create_task(self.heartbeat_loop(job))
+        await self.queues['parse'].put(job)
+
+    def stats(self):
+        return {stage: self.queues[stage].qsize() for stage in self.STAGES}
+
+    async def heartbeat_loop(self, job):
+        # 处理期间定期续约，防止长文件被当成卡死的任务重新入队
+        while True:
+            await asyncio.sleep(INSERT_HEARTBEAT_SECONDS)
+            try:
+                await self.job_queue.heartbeat(job.id)
+            except Exception as e:
+                insert_logger.error(f'heartbeat error, id: {job.id}, {e}')
+
+    async def stage_worker(self, stage, next_stage):
+        handler = self.handlers[stage]
+        while True:
+            job = await self.queues[stage].get()
+            try:
+                ok = await handler(job)
+            except Exception as e:
+                insert_logger.error(f"process_files Error in {stage} stage: {traceback.format_exc()}")
+                ok = False
+                await self.finish(job, 'red', f"{stage} error")
+            finally:
+                self.queues[stage].task_done()
+            if ok and next_stage is not None:
+                await self.queues[next_stage].put(job)
+
+    async def finish(self, job, status, msg):
+        try:
+            await self.job_queue.complete(job.id, status, job.content_length, job.chunks_number, msg)
+            insert_logger.info(f"UPDATE FILE: {job.file_id}, {job.file_name}, {status}")
+            # 知识库内容变化，递增版本号使检索缓存失效
+            await asyncio.to_thread(self.mysql_client.bump_kb_version, [job.kb_id])
+        except Exception as e:
+            insert_logger.error('MySQL 二次连接异常：' + str(e))
+            try:
+                # 如果file的status是yellow，就改为red
+                await self.job_queue.fail(job.id)
+            except Exception as e:
+                insert_logger.error('MySQL 二次连接异常：' + str(e))
+        finally:
+            if job.heartbeat_task is not None:
+                job.heartbeat_task.cancel()
+            job.local_file = job.embed_docs = job.full_docs = job.embeddings = None
+            self.slots.release()
+
+    async def parse(self, job):
+        # 获取格式为'2021-08-01 00:00:00'的时间戳
+        insert_timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+        # mysql_client是同步的，事件循环被所有阶段和删除服务共用，数据库调用都放到线程中执行
+        await asyncio.to_thread(self.mysql_client.update_knowlegde_base_latest_insert_time, job.kb_id,
+                                insert_timestamp)
+        job.local_file = LocalFileForInsert(job.user_id, job.kb_id, job.file_id, job.file_location, job.file_name,
+                                            job.file_url, job.chunk_size, self.mysql_client)
+        await asyncio.to_thread(self.mysql_client.update_file_msg, job.file_id, f'Processing:{random.randint(1, 5)}%')
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(
+                asyncio.to_thread(job.local_file.split_file_to_docs),
+                timeout=PARSE_TIMEOUT_SECONDS
+            )
+        except asyncio.TimeoutError:
+            job.local_file.event.set()
+            insert_logger.error(f'Timeout: split_file_to_docs took longer than {PARSE_TIMEOUT_SECONDS} seconds')
+            await self.finish(job, 'red', f"split_file_to_docs timeout: {PARSE_TIMEOUT_SECONDS}s")
+            return False
+        except Exception as e:
+            insert_logger.error(f'split_file_to_docs error: {traceback.format_exc()}')
+            await self.finish(job, 'red', f"split_file_to_docs error")
+            return False
+        job.content_length = sum([len(doc.page_content) for doc in job.local_file.docs])
+        if job.content_length > MAX_CHARS:
+            await self.finish(job, 'red', f"{job.file_name} content_length too large, {job.content_length} >= "
+                                          f"MaxLength({MAX_CHARS})")
+            return False
+        elif job.content_length == 0:
+            await self.finish(job, 'red', f"{job.file_name} content_length is 0, file content is empty or The URL "
+                                          f"exists anti-crawling or requires login.")
+            return False
+        end = time.perf_counter()
+        job.time_record['parse_time'] = round(end - start, 2)
+        job.time_record['parse_cache_hit'] = job.local_file.parse_cache_hit
+        insert_logger.info(f'parse time: {end - start} {len(job.local_file.docs)}')
+        await asyncio.to_thread(self.mysql_client.update_file_msg, job.file_id,
+                                f'Processing:{random.randint(5, 75)}%')
+        return True
+
+    async def split(self, job):
+        # 父/子文档切分要跑embedding tokenizer，放到线程中执行
+        try:
+            job.embed_docs, job.full_docs, split_time_record = await asyncio.to_thread(
+                self.retriever.prepare_insert, job.local_file.docs, job.chunk_size)
+        except Exception as e:
+            insert_logger.error(f'split error: {traceback.format_exc()}')
+            job.time_record['split_error'] = True
+            await self.finish(job, 'red', f"split error")
+            return False
+        job.time_record.update(split_time_record)
+        job.local_file = None
+        return True
+
+    async def run_insert_step(self, job, coro):
+        # embed和store各自从handler开始处理时计时，在阶段队列中等待的时间不算在内，背压时不会把正常文件判为超时
+        try:
+            return True, await asyncio.wait_for(coro, timeout=INSERT_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            insert_logger.error(f'Timeout: milvus insert took longer than {INSERT_TIMEOUT_SECONDS} seconds')
+            expr = f'file_id == \"{job.file_id}\"'
+            await asyncio.to_thread(self.milvus_kb.delete_expr, expr)
+            job.time_record['insert_timeout'] = True
+            await self.finish(job, 'red', f"milvus insert timeout: {INSERT_TIMEOUT_SECONDS}s")
+        except Exception as e:
+            insert_logger.error(f'milvus insert error: {traceback.format_exc()}')
+            job.time_record['insert_error'] = True
+            await self.finish(job, 'red', f"milvus insert error")
+        return False, None
+
+    async def embed(self, job):
+        ok, job.embeddings = await self.run_insert_step(
+            job, self.retriever.aembed_prepared(job.embed_docs, job.time_record))
+        return ok
+
+    async def cleanup_previous_attempt(self, job):
+        # 租约过期后重新领取的文件，上一次可能已经写入了部分向量（milvus是auto_id，重复写入会产生重复的子文档）
+        expr = f'file_id == \"{job.file_id}\"'
+        await asyncio.to_thread(self.milvus_kb.delete_expr, expr, 60, True)
+        await asyncio.to_thread(self.es_client.delete_files, [job.file_id])
+        insert_logger.info(f'cleanup previous attempt: {job.file_id}, attempts: {job.attempts}')
+
+    async def store(self, job):
+        if job.attempts > 1:
+            try:
+                await self.cleanup_previous_attempt(job)
+            except Exception as e:
+                insert_logger.error(f'cleanup previous attempt error: {traceback.format_exc()}')
+                await self.finish(job, 'red', f"cleanup previous attempt error")
+                return False
+        start = time.perf_counter()
+        ok, chunks_number = await self.run_insert_step(
+            job, self.retriever.astore_prepared(job.embed_docs, job.full_docs, job.embeddings, job.time_record))
+        if not ok:
+            return False
+        job.chunks_number = chunks_number
+        insert_logger.info(f'insert time: {time.perf_counter() - start}')
+        await asyncio.to_thread(self.mysql_client.update_chunks_number, job.file_id, chunks_number)
+        await asyncio.to_thread(self.mysql_client.update_file_msg, job.file_id,
+                                f'Processing:{random.randint(75, 100)}%')
+        if MILVUS_FLUSH_BEFORE_GREEN:
+            # 置green之前确认本文件的向量已经flush，flush失败不影响入库结果
+            flush_start = time.perf_counter()
+            if not await self.milvus_kb.local_vectorstore.flusher.flush():
+                insert_logger.warning(f'milvus flush before green failed: {job.file_id}')
+            job.time_record['milvus_flush_time'] = round(time.perf_counter() - flush_start, 2)
+        job.time_record['upload_total_time'] = round(time.perf_counter() - job.start, 2)
+        await asyncio.to_thread(self.mysql_client.update_file_upload_infos, job.file_id, job.time_record)
+        insert_logger.info(f'insert_files_to_milvus: {job.user_id}, {job.kb_id}, {job.file_id}, {job.file_name}, '
+                           f'green')
+        insert_logger.info('time_record: ' + json.dumps(job.time_record, ensure_ascii=False))
+        await self.finish(job, 'green', json.dumps(job.time_record, ensure_ascii=False))
+        return True
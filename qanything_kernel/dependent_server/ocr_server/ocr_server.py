@@ -16,13 +16,15 @@ import os
 from qanything_kernel.dependent_server.ocr_server.operators import *
 from qanything_kernel.dependent_server.ocr_server.postprocess import build_post_process
 from qanything_kernel.utils.general_utils import safe_get
-from qanything_kernel.configs.model_config import OCR_MODEL_PATH
+from qanything_kernel.configs.model_config import OCR_MODEL_PATH, OCR_EXECUTOR_WORKERS, OCR_BATCH_MAX_IMAGES
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import onnxruntime as ort
 from sanic import Sanic, response
 from sanic.request import Request
 from sanic.response import json
 import base64
+import asyncio
 import argparse
 
 # 接收外部参数mode
@@ -612,6 +614,51 @@ class OCRQAnything(object):
         time_dict['all'] = end - start
         return [item[0] for item in list(filter_rec_res)]
 
+    def ocr_with_boxes(self, img):
+        """
+        返回[[四点坐标], text, score]列表，坐标从左上角开始顺时针排列，单位是输入图片的像素，
+        与pdf解析中page_ocr从文字层得到的行框格式一致
+        """
+        return self.ocr_batch([img], return_boxes=True)[0] or []
+
+    def ocr_batch(self, imgs, return_boxes=False):
+        """
+        多张图片一起识别：逐张做文本检测，所有图片的文本框截图汇总后一次交给TextRecognizer，
+        由它按宽高比排序后组batch，不同图片的文本行共享识别batch，减少模型调用次数。
+        返回与输入顺序一致的列表，每项是文本列表（return_boxes时为[[四点坐标], text, score]列表），图片为None时对应None
+        """
+        det_boxes, img_crop_list = [], []
+        for img in imgs:
+            if img is None:
+                det_boxes.append(None)
+                continue
+            ori_im = img.copy()
+            dt_boxes, elapse = self.text_detector(img)
+            if dt_boxes is None or len(dt_boxes) == 0:
+                det_boxes.append([])
+                continue
+            dt_boxes = self.sorted_boxes(dt_boxes)
+            det_boxes.append(dt_boxes)
+            for box in dt_boxes:
+                img_crop_list.append(self.get_rotate_crop_image(ori_im, copy.deepcopy(box)))
+
+        rec_res = self.text_recognizer(img_crop_list)[0] if img_crop_list else []
+        results = []
+        rno = 0
+        for dt_boxes in det_boxes:
+            if dt_boxes is None:
+                results.append(None)
+                continue
+            res = []
+            for box in dt_boxes:
+                text, score = rec_res[rno]
+                rno += 1
+                if score < self.drop_score:
+                    continue
+                res.append([box.tolist(), text, float(score)] if return_boxes else text)
+            results.append(res)
+        return results
+
 
 app = Sanic("OCRService")
 
@@ -620,24 +667,72 @@ app = Sanic("OCRService")
 async def setup_ocr(app, loop):
     device = 'cpu' if not args.use_gpu else 'cuda'
     app.ctx.ocr = OCRQAnything(model_dir=OCR_MODEL_PATH, device=device)
+    # 模型推理放到线程池中执行，不阻塞事件循环
+    app.ctx.executor = ThreadPoolExecutor(max_workers=OCR_EXECUTOR_WORKERS)
+
+
+@app.after_server_stop
+async def shutdown_executor(app, loop):
+    app.ctx.executor.shutdown(wait=False)
+
+
+def decode_image(data):
+    try:
+        return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    except Exception:
+        return None
+
+
+# 以下两个函数在线程池中执行，整页图片的解码和识别一样耗时，都不能放在事件循环里
+def ocr_base64_image(ocr, img64, return_boxes):
+    """解码base64图片并识别，返回(错误信息, 识别结果)"""
+    try:
+        img_data = base64.b64decode(img64)
+    except Exception:
+        return "Invalid image data", None
+    img = decode_image(img_data)
+    if img is None:
+        return "Invalid image file", None
+    return None, ocr.ocr_with_boxes(img) if return_boxes else ocr(img)
+
+
+def ocr_image_bytes(ocr, datas, return_boxes):
+    """解码多张图片的原始字节并一起识别，无法解码的图片对应None"""
+    return ocr.ocr_batch([decode_image(data) for data in datas], return_boxes)
+
 
 @app.post("/ocr")
 async def ocr_api(request: Request):
     img64 = safe_get(request, 'img64')
+    # 为True时同时返回文本框坐标，供pdf解析对扫描页做OCR
+    return_boxes = safe_get(request, 'return_boxes', False)
 
     if img64 is None:
         return json({"error": "No image data provided"}, status=400)
 
-    try:
-        img_data = base64.b64decode(img64)
-        img = cv2.imdecode(np.frombuffer(img_data, np.uint8), cv2.IMREAD_COLOR)
-    except Exception as e:
-        return json({"error": "Invalid image data"}, status=400)
+    loop = asyncio.get_running_loop()
+    error, result = await loop.run_in_executor(app.ctx.executor, ocr_base64_image, app.ctx.ocr, img64, return_boxes)
+    if error is not None:
+        return json({"error": error}, status=400)
+    return json({"result": result})
 
-    if img is None:
-        return json({"error": "Invalid image file"}, status=400)
 
-    result = app.ctx.ocr(img)
+@app.post("/ocr/batch")
+async def ocr_batch_api(request: Request):
+    """
+    multipart/form-data上传多张图片（字段名files），直接传原始字节，不需要base64；
+    返回与上传顺序一致的识别结果列表，无法解码的图片对应null
+    """
+    files = request.files.getlist('files') if request.files else None
+    if not files:
+        return json({"error": "No image data provided"}, status=400)
+    if len(files) > OCR_BATCH_MAX_IMAGES:
+        return json({"error": f"Too many images, max {OCR_BATCH_MAX_IMAGES}"}, status=400)
+    return_boxes = str(safe_get(request, 'return_boxes', False)).lower() in ('true', '1')
+
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(app.ctx.executor, ocr_image_bytes, app.ctx.ocr, [f.body for f in files],
+                                        return_boxes)
     return json({"result": result})
 
 
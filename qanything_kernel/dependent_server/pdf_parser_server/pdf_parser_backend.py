@@ -3,10 +3,81 @@ import re
 from qanything_kernel.dependent_server.pdf_parser_server.pdf_to_markdown.core.parser import PdfParser
 from qanything_kernel.dependent_server.pdf_parser_server.pdf_to_markdown.convert2markdown import json2markdown
 from qanything_kernel.utils.custom_log import debug_logger
+from qanything_kernel.configs.model_config import PDF_STREAM_WINDOW_PAGES
 from timeit import default_timer as timer
 import numpy as np
 import os
+import sys
 import time
+import resource
+
+
+class ShardedLayouts:
+    """
+    其他worker按页分片计算的版面检测结果，每个分片一个concurrent.futures.Future。
+    get(page_from, page_to)只等待覆盖这些页的分片，流式解析时每个窗口拿到自己的版面结果即可继续，
+    不必等所有分片返回；任一分片失败或页数不对时返回None，此后的页面都在本进程检测
+    """
+
+    def __init__(self, shards):
+        # shards: [(page_from, page_to, future), ...]，按页码顺序排列
+        self.shards = shards
+        self.failed = False
+
+    def get(self, page_from, page_to):
+        if self.failed:
+            return None
+        layouts = []
+        for shard_from, shard_to, future in self.shards:
+            if shard_to <= page_from or shard_from >= page_to:
+                continue
+            try:
+                shard_layouts = future.result()
+            except Exception as e:
+                debug_logger.warning(f"sharded layout detection [{shard_from}, {shard_to}) failed, "
+                                     f"fallback to serial: {e}")
+                self.failed = True
+                return None
+            if len(shard_layouts) != shard_to - shard_from:
+                debug_logger.warning(f"sharded layouts [{shard_from}, {shard_to}) pages {len(shard_layouts)} "
+                                     f"!= {shard_to - shard_from}, fallback to serial")
+                self.failed = True
+                return None
+            layouts.extend(shard_layouts[max(page_from, shard_from) - shard_from:min(page_to, shard_to) - shard_from])
+        if len(layouts) != page_to - page_from:
+            return None
+        return layouts
+
+
+def get_rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024, 1)
+    except (OSError, ValueError):
+        return None
+
+
+def reset_peak_rss():
+    """把进程的RSS峰值（VmHWM）重置为当前RSS，需要Linux 4.0+；失败时get_peak_rss_mb得到的是进程生命周期内的峰值"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # 非Linux平台：ru_maxrss在macOS上单位是字节，其他平台是KB
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1024 / (1024 if sys.platform == 'darwin' else 1), 1)
 
 
 class PdfLoader(PdfParser):
@@ -19,7 +90,11 @@ class PdfLoader(PdfParser):
         self.callback = callback
         
 
-    def load_to_markdown(self, filename, save_dir):
+    def load_to_markdown(self, filename, save_dir, sharded_layouts: ShardedLayouts = None):
+        """
+        sharded_layouts: 其他worker按页分片算好的版面检测结果，为空或失败时在本进程检测；
+        解析期间的内存峰值记录在self.memory_record中
+        """
         os.makedirs(save_dir, exist_ok=True)
         json_dir = os.path.join(save_dir, os.path.basename(filename)[:-4]) + '.json'
         basedir = os.path.dirname(json_dir)
@@ -28,19 +103,28 @@ class PdfLoader(PdfParser):
         os.makedirs(markdown_path, exist_ok=True)
         markdown_dir = os.path.join(markdown_path, basename.split('.')[0] + '.md')
 
+        self.memory_record = {'rss_before_mb': get_rss_mb(), 'peak_rss_per_parse': reset_peak_rss()}
         ocr_start = timer()
         self.__images__(
             filename if self.binary is None else self.binary,
             self.zoomin,
             self.from_page,
             self.to_page,
-            self.callback
+            self.callback,
+            stream_window=PDF_STREAM_WINDOW_PAGES,
+            layouts_getter=sharded_layouts.get if sharded_layouts is not None else None
         )
         debug_logger.info("OCR finished in %s seconds" % (timer() - ocr_start))
 
         np.set_printoptions(threshold=np.inf)
         start = timer()
-        self._layouts_rec(self.zoomin)
+        if self.streaming:
+            layouts = self.stream_layouts
+        else:
+            layouts = None
+            if sharded_layouts is not None:
+                layouts = sharded_layouts.get(self.from_page, self.from_page + len(self.page_images))
+        self._layouts_rec(self.zoomin, layouts=layouts)
 
         self._text_merge()
         tbls = self._extract_table_figure(True, self.zoomin, True, True, markdown_path)
@@ -111,6 +195,9 @@ class PdfLoader(PdfParser):
         json.dump(new_sections, open(json_dir, 'w'), ensure_ascii=False, indent=4)
         markdown_str = json2markdown(json_dir, markdown_dir)
         debug_logger.info("PDF Parse finished in %s seconds" % (timer() - start))
+        self.memory_record.update({'peak_rss_mb': get_peak_rss_mb(), 'stream_mode': self.streaming,
+                                   'pages': len(self.page_images)})
+        debug_logger.info(f"PDF Parse memory: {self.memory_record}")
         # print(new_sections, flush=True)
         return markdown_dir
 
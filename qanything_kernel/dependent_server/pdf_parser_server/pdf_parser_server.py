@@ -15,7 +15,12 @@ from qanything_kernel.utils.general_utils import safe_get
 from sanic import Sanic, response
 from sanic.request import Request
 from sanic.response import json
-from qanything_kernel.dependent_server.pdf_parser_server.pdf_parser_backend import PdfLoader
+from qanything_kernel.dependent_server.pdf_parser_server.pdf_parser_backend import PdfLoader, ShardedLayouts
+from qanything_kernel.connector.http_session import get_client_session, close_client_session
+from qanything_kernel.configs.model_config import LOCAL_PDF_PARSER_SERVICE_URL, PDF_LAYOUT_PAGES_PER_SHARD, \
+    PDF_LAYOUT_SHARD_MIN_PAGES, PDF_LAYOUT_SHARD_TIMEOUT
+import asyncio
+import aiohttp
 import time
 import torch
 import argparse
@@ -37,19 +42,67 @@ app = Sanic("pdf_parser_server")
 async def init_pdf_parser(app, loop):
     start = time.time()
     app.ctx.pdf_parser = PdfLoader(device=torch.device('cpu') if not args.use_gpu else torch.device('cuda'))
+    # PdfLoader在解析过程中保存了状态，同一个worker内的解析请求串行执行
+    app.ctx.parse_lock = asyncio.Lock()
     end = time.time()
     print(f'init pdf_parser cost {end - start}s', flush=True)
 
 
+@app.after_server_stop
+async def close_http_session(app, loop):
+    await close_client_session(loop)
+
+
+async def fetch_layout_shard(filename, page_from, page_to):
+    """请求本服务的某个worker进程计算[page_from, page_to)页的版面检测结果"""
+    session = get_client_session()
+    timeout = aiohttp.ClientTimeout(total=PDF_LAYOUT_SHARD_TIMEOUT)
+    data = {'filename': filename, 'page_from': page_from, 'page_to': page_to}
+    async with session.post(f"http://{LOCAL_PDF_PARSER_SERVICE_URL}/pdfparser/layout", json=data,
+                            timeout=timeout) as response:
+        response.raise_for_status()
+        return (await response.json())['layouts']
+
+
+def submit_sharded_layouts(filename, total_pages, loop) -> ShardedLayouts:
+    """把版面检测按页分片，分发给本服务的各个worker进程并发计算，每个分片单独一个future"""
+    shards = [(i, min(i + PDF_LAYOUT_PAGES_PER_SHARD, total_pages))
+              for i in range(0, total_pages, PDF_LAYOUT_PAGES_PER_SHARD)]
+    return ShardedLayouts([(page_from, page_to,
+                            asyncio.run_coroutine_threadsafe(fetch_layout_shard(filename, page_from, page_to), loop))
+                           for page_from, page_to in shards])
+
+
 @app.post("/pdfparser")
 async def pdf_parser(request: Request):
     filename = safe_get(request, 'filename')
     save_dir = safe_get(request, 'save_dir')
 
     pdf_parser_: PdfLoader = request.app.ctx.pdf_parser
-    markdown_file = pdf_parser_.load_to_markdown(filename, save_dir)
+    sharded_layouts = None
+    if args.workers > 1 and PDF_LAYOUT_SHARD_MIN_PAGES > 0:
+        # 统计页数要打开并解析pdf，放到线程中执行
+        total_pages = await asyncio.to_thread(PdfLoader.total_page_number, filename)
+        if total_pages >= PDF_LAYOUT_SHARD_MIN_PAGES:
+            # 分片检测和本worker的页面渲染同时进行，解析线程处理到某个窗口时只等待覆盖该窗口的分片
+            sharded_layouts = submit_sharded_layouts(filename, total_pages, asyncio.get_running_loop())
+    async with request.app.ctx.parse_lock:
+        markdown_file = await asyncio.to_thread(pdf_parser_.load_to_markdown, filename, save_dir, sharded_layouts)
+        memory_record = pdf_parser_.memory_record
+
+    return json({"markdown_file": markdown_file, "memory_record": memory_record})
+
+
+@app.post("/pdfparser/layout")
+async def pdf_layout(request: Request):
+    filename = safe_get(request, 'filename')
+    page_from = safe_get(request, 'page_from')
+    page_to = safe_get(request, 'page_to')
 
-    return json({"markdown_file": markdown_file})
+    pdf_parser_: PdfLoader = request.app.ctx.pdf_parser
+    # 只读使用layouter，不需要获取parse_lock
+    layouts = await asyncio.to_thread(pdf_parser_.detect_layouts, filename, page_from, page_to, pdf_parser_.zoomin)
+    return json({"layouts": layouts})
 
 
 if __name__ == '__main__':
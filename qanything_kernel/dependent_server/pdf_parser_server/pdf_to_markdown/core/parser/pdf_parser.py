@@ -15,17 +15,54 @@ import numpy as np
 from PyPDF2 import PdfReader as pdf2_read
 
 from qanything_kernel.dependent_server.pdf_parser_server.pdf_to_markdown.core.vision import Recognizer, LayoutRecognizer, \
-    TableStructureRecognizer_LORE
+    TableStructureRecognizer_LORE, BoxIndex
 from qanything_kernel.dependent_server.pdf_parser_server.pdf_to_markdown.core.nlp import huqie
 # from qanything_kernel.dependent_server.ocr_server.ocr import OCRQAnything
-from qanything_kernel.configs.model_config import PDF_MODEL_PATH
+from qanything_kernel.configs.model_config import PDF_MODEL_PATH, PDF_STREAM_MIN_PAGES, LOCAL_OCR_SERVICE_URL, \
+    PDF_OCR_MIN_TEXT_CHARS, PDF_OCR_MIN_IMAGE_COVERAGE, PDF_OCR_CONCURRENCY, PDF_OCR_TIMEOUT, PDF_OCR_BATCH_PAGES
 from qanything_kernel.utils.custom_log import debug_logger
 from tqdm import tqdm
+from timeit import default_timer as timer
 from copy import deepcopy
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import requests
 
 logging.getLogger("pdfminer").setLevel(logging.WARNING)
 
 
+def layout_crop_box(left, top, right, bott, zoomin):
+    """
+    版面区域（页面坐标，即检测框除以zoomin）在zoomin倍渲染图上的截图区域。
+    流式解析预先截取表格/图片和_extract_table_figure截图都用它计算，两处浮点结果一致，预先截好的图才能按crop_key命中，
+    否则每次截图都会重新渲染整页
+    """
+    return left * zoomin, top * zoomin, right * zoomin, bott * zoomin
+
+
+class StreamedPage:
+    """
+    流式解析时代替整页位图：只保留页面尺寸和表格/图片版面区域的截图，
+    截取其他区域时重新渲染该页，渲染结果是确定的，和从整页位图上截取的一致
+    """
+
+    def __init__(self, size, crops, render):
+        self.size = size
+        self.crops = crops
+        self.render = render
+
+    @staticmethod
+    def crop_key(box):
+        # 与PIL的Image.crop一致，截图区域按四舍五入取整
+        return tuple(int(round(v)) for v in box)
+
+    def crop(self, box):
+        key = self.crop_key(box)
+        if key in self.crops:
+            return self.crops[key].copy()
+        return self.render().crop(box)
+
+
 class HuParser:
     def __init__(self, device=torch.device("cpu")):
         # self.ocr = OCRQAnything(model_dir=OCR_MODEL_PATH, device=device)  # 省显存
@@ -214,17 +251,20 @@ class HuParser:
         clmns = sorted([r for r in self.tb_cpns if re.match(
             r"table column$", r["label"])], key=lambda x: (x["pn"], x["layoutno"], x["x0"]))
         clmns = Recognizer.layouts_cleanup(self.boxes, clmns, 5, 0.5)
+        # 每个表格文本框都要和全文档的行/表头/列/合并单元格匹配，建索引避免逐一扫描
+        rows_index, headers_index = BoxIndex.build(rows), BoxIndex.build(headers)
+        clmns_index, spans_index = BoxIndex.build(clmns), BoxIndex.build(spans)
         for b in self.boxes:
             if b.get("layout_type", "") != "table":
                 continue
-            ii = Recognizer.find_overlapped_with_threashold(b, rows, thr=0.3)
+            ii = Recognizer.find_overlapped_with_threashold(b, rows, thr=0.3, index=rows_index)
             if ii is not None:
                 b["R"] = ii
                 b["R_top"] = rows[ii]["top"]
                 b["R_bott"] = rows[ii]["bottom"]
 
             ii = Recognizer.find_overlapped_with_threashold(
-                b, headers, thr=0.3)
+                b, headers, thr=0.3, index=headers_index)
             if ii is not None:
                 b["H_top"] = headers[ii]["top"]
                 b["H_bott"] = headers[ii]["bottom"]
@@ -232,13 +272,13 @@ class HuParser:
                 b["H_right"] = headers[ii]["x1"]
                 b["H"] = ii
 
-            ii = Recognizer.find_horizontally_tightest_fit(b, clmns)
+            ii = Recognizer.find_horizontally_tightest_fit(b, clmns, index=clmns_index)
             if ii is not None:
                 b["C"] = ii
                 b["C_left"] = clmns[ii]["x0"]
                 b["C_right"] = clmns[ii]["x1"]
 
-            ii = Recognizer.find_overlapped_with_threashold(b, spans, thr=0.3)
+            ii = Recognizer.find_overlapped_with_threashold(b, spans, thr=0.3, index=spans_index)
             if ii is not None:
                 b["H_top"] = spans[ii]["top"]
                 b["H_bott"] = spans[ii]["bottom"]
@@ -270,10 +310,10 @@ class HuParser:
                                               for b in bxs])
         self.boxes.append(bxs)
 
-    def _layouts_rec(self, ZM, drop=True):
+    def _layouts_rec(self, ZM, drop=True, layouts=None):
         assert len(self.page_images) == len(self.boxes)
         self.boxes, self.page_layout = self.layouter(
-            self.page_images, self.boxes, ZM, thr=0.15, drop=drop)
+            self.page_images, self.boxes, ZM, thr=0.15, drop=drop, layouts=layouts)
         # cumlative Y
         for i in range(len(self.boxes)):
             self.boxes[i]["top"] += \
@@ -707,9 +747,7 @@ class HuParser:
 
                 left, top, right, bott = b["x0"], b["top"], b["x1"], b["bottom"]
                 poss.append((pn + self.page_from, left, right, top, bott))
-                return self.page_images[pn] \
-                    .crop((left * ZM, top * ZM,
-                           right * ZM, bott * ZM))
+                return self.page_images[pn].crop(layout_crop_box(left, top, right, bott, ZM))
             pn = {}
             for b in bxs:
                 p = b["page_number"] - 1
@@ -908,6 +946,18 @@ class HuParser:
                 stream=fnm, filetype="pdf")
             return len(pdf)
 
+    @staticmethod
+    def render_page(page, mat):
+        pix = page.get_pixmap(matrix=mat)
+        return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+
+    def detect_layouts(self, fnm, page_from, page_to, zoomin=3):
+        """渲染[page_from, page_to)范围内的页面并做版面检测，返回和_layouts_rec中一致的逐页检测结果"""
+        mat = fitz.Matrix(zoomin, zoomin)
+        with fitz.open(fnm) as pdf:
+            images = [self.render_page(pdf[i], mat) for i in range(page_from, min(page_to, len(pdf)))]
+        return self.layouter.detect(images, thr=0.15)
+
     def page_ocr(self, page, zoomin):
         blocks = page.get_text(
             "dict", flags=0,
@@ -929,8 +979,109 @@ class HuParser:
                 ocr_res.append([four_point_bbox, line_text, 1])
         return ocr_res
 
+    @staticmethod
+    def text_layer_usable(page, page_ocr_res):
+        """
+        文字层是否可用：有效字符（不含乱码替换符、空白和标点）足够多即可用；
+        否则只有图片覆盖了较大面积的页面才认为是扫描页，空白页、纯矢量图形页不需要OCR
+        """
+        valid_chars = len(re.findall(r"\w", "".join([res[1] for res in page_ocr_res])))
+        if valid_chars >= PDF_OCR_MIN_TEXT_CHARS:
+            return True
+        page_area = abs(page.rect)
+        if not page_area:
+            return True
+        image_area = 0
+        for info in page.get_image_info():
+            image_area += abs(fitz.Rect(info["bbox"]) & page.rect)
+        return image_area / page_area < PDF_OCR_MIN_IMAGE_COVERAGE
+
+    @staticmethod
+    def ocr_images(images):
+        """
+        每PDF_OCR_BATCH_PAGES页一个/ocr/batch请求（multipart上传原始jpeg字节），多个请求并发发给OCR服务，
+        返回和page_ocr格式一致的行框（坐标单位是渲染后图片的像素），失败的页面返回None
+        """
+        def ocr(batch):
+            files = []
+            for i, img in enumerate(batch):
+                buf = BytesIO()
+                img.save(buf, format="JPEG", quality=95)
+                files.append(('files', (f'{i}.jpg', buf.getvalue(), 'image/jpeg')))
+            try:
+                response = requests.post(f"http://{LOCAL_OCR_SERVICE_URL}/ocr/batch", files=files,
+                                         data={'return_boxes': 'true'}, timeout=PDF_OCR_TIMEOUT)
+                response.raise_for_status()
+                return response.json()["result"]
+            except Exception as e:
+                debug_logger.warning(f"page ocr error: {e}")
+                return [None] * len(batch)
+
+        batches = [images[i:i + PDF_OCR_BATCH_PAGES] for i in range(0, len(images), PDF_OCR_BATCH_PAGES)]
+        with ThreadPoolExecutor(max_workers=min(PDF_OCR_CONCURRENCY, len(batches))) as executor:
+            return [res for batch_res in executor.map(ocr, batches) for res in batch_res]
+
+    def __ocr_scanned_pages(self, pns, images):
+        # 扫描页的OCR结果替换文字层的结果，之后和数字页走同样的文本框流程
+        if not pns:
+            return
+        start = timer()
+        for pn, res in zip(pns, self.ocr_images(images)):
+            if res is not None:
+                self.ocr_res[pn] = res
+        self.ocr_page_numbers.extend([pn + self.page_from for pn in pns])
+        debug_logger.info(f"OCR scanned pages {[pn + self.page_from for pn in pns]} in {timer() - start} seconds")
+
+    def _render_page_cached(self, pno, mat):
+        # 只缓存最近渲染的一页，连续截取同一页的多个区域时不重复渲染
+        if self.rendered_page[0] != pno:
+            self.rendered_page = (pno, self.render_page(self.fitz_pdf[pno], mat))
+        return self.rendered_page[1]
+
+    def __stream_pages(self, page_from, page_to, zoomin, window, layouts_getter=None):
+        """
+        流式模式：每window页一个窗口，渲染页面、抽取文本框、做版面检测并截下表格/图片区域，窗口处理完整页位图即丢弃。
+        self.page_images中放StreamedPage，只保留页面尺寸和截图，版面检测结果保存在self.stream_layouts
+        """
+        mat = fitz.Matrix(zoomin, zoomin)
+        self.rendered_page = (None, None)
+        self.stream_layouts = []
+        for start in range(page_from, page_to, window):
+            end = min(start + window, page_to)
+            images = [self.render_page(self.fitz_pdf[i], mat) for i in range(start, end)]
+            ocr_pns = []
+            for i in range(start, end):
+                self.page_chars.append([])
+                self.ocr_res.append(self.page_ocr(self.fitz_pdf[i], zoomin))
+                if PDF_OCR_CONCURRENCY > 0 and not self.text_layer_usable(self.fitz_pdf[i], self.ocr_res[-1]):
+                    ocr_pns.append(len(self.ocr_res) - 1)
+            self.__ocr_scanned_pages(ocr_pns, [images[pn - (start - page_from)] for pn in ocr_pns])
+            # 渲染、抽取文本框之后才取预先算好的版面结果，只等待覆盖本窗口的分片
+            layouts = layouts_getter(start, end) if layouts_getter is not None else None
+            if layouts is None or len(layouts) != end - start:
+                layouts = self.layouter.detect(images, thr=0.15)
+            self.stream_layouts.extend(layouts)
+            for i, img in enumerate(images):
+                crops = {}
+                for lt in self.stream_layouts[start - page_from + i]:
+                    if lt["type"] not in ("table", "figure"):
+                        continue
+                    # 和_layouts_rec中一样先换算成页面坐标，再按_extract_table_figure的方式算截图区域
+                    box = layout_crop_box(*(v / zoomin for v in
+                                            (lt["bbox"][0], lt["bbox"][1], lt["bbox"][2], lt["bbox"][-1])), zoomin)
+                    crops[StreamedPage.crop_key(box)] = img.crop(box)
+                self.page_images.append(StreamedPage(img.size, crops,
+                                                     partial(self._render_page_cached, start + i, mat)))
+            del images
+            debug_logger.info(f"stream window pages [{start}, {end}) done")
+
     def __images__(self, fnm, zoomin=3, page_from=0,
-                   page_to=299, callback=None):
+                   page_to=299, callback=None, stream_window=0, layouts_getter=None):
+        """
+        stream_window: 大于0且页数不少于PDF_STREAM_MIN_PAGES时按窗口流式处理，不常驻整页位图，
+        此时版面检测在窗口内完成，_layouts_rec需传入self.stream_layouts；
+        layouts_getter: 流式模式下按窗口获取预先算好的版面检测结果，layouts_getter(page_from, page_to)返回None时在窗口内检测
+        """
         self.lefted_chars = []
         self.mean_height = []
         self.mean_width = []
@@ -942,23 +1093,33 @@ class HuParser:
         self.pdf = fitz.open(fnm) if isinstance(
             fnm, str) else fitz.open(
             stream=fnm, filetype="pdf")
+        self.fitz_pdf = self.pdf
         self.page_images = []
         self.page_chars = []
         self.ocr_res = []
         mat = fitz.Matrix(zoomin, zoomin)
         self.total_page = len(self.pdf)
-        for i, page in enumerate(self.pdf):
-            if i < page_from:
-                continue
-            if i >= page_to:
-                break
-            pix = page.get_pixmap(matrix=mat)
-            img = Image.frombytes("RGB", [pix.width, pix.height],
-                                  pix.samples)
-            self.page_images.append(img)
-            self.page_chars.append([])
-            page_ocr_res = self.page_ocr(page, zoomin)
-            self.ocr_res.append(page_ocr_res)
+        page_count = max(min(page_to, self.total_page) - page_from, 0)
+        self.streaming = stream_window > 0 and page_count >= PDF_STREAM_MIN_PAGES
+        self.stream_layouts = None
+        self.ocr_page_numbers = []
+        if self.streaming:
+            self.__stream_pages(page_from, page_from + page_count, zoomin, stream_window, layouts_getter)
+        else:
+            ocr_pns = []
+            for i, page in enumerate(self.pdf):
+                if i < page_from:
+                    continue
+                if i >= page_to:
+                    break
+                img = self.render_page(page, mat)
+                self.page_images.append(img)
+                self.page_chars.append([])
+                page_ocr_res = self.page_ocr(page, zoomin)
+                self.ocr_res.append(page_ocr_res)
+                if PDF_OCR_CONCURRENCY > 0 and not self.text_layer_usable(page, page_ocr_res):
+                    ocr_pns.append(len(self.ocr_res) - 1)
+            self.__ocr_scanned_pages(ocr_pns, [self.page_images[pn] for pn in ocr_pns])
 
         self.outlines = []
         try:
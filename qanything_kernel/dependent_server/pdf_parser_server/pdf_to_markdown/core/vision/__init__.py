@@ -1,3 +1,4 @@
+from .box_index import BoxIndex
 from .recognizer import Recognizer
 from .layout_recognizer import LayoutRecognizer
 from .table_structure_recognizer_lore import TableStructureRecognizer_LORE
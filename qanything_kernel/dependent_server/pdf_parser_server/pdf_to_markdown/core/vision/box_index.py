@@ -0,0 +1,60 @@
+import math
+import numpy as np
+
+
+class BoxIndex(object):
+    """
+    框的空间索引：按y方向等高分桶，每个框登记到它跨越的所有桶中。
+    query返回与给定框相交（闭区间，和Recognizer.overlapped_area中不返回0的条件一致）的框的下标，
+    下标按原列表升序排列，调用方按这个顺序遍历，结果和线性扫描完全一致。
+    框的坐标在索引建立后不能再修改。
+    """
+    # 框数较少时线性扫描更快，不建索引
+    MIN_BOXES = 32
+
+    def __init__(self, boxes, bucket_size=None):
+        self.boxes = boxes
+        if bucket_size is None:
+            heights = [abs(b["bottom"] - b["top"]) for b in boxes]
+            bucket_size = float(np.median(heights)) if heights else 1
+        self.bucket_size = max(bucket_size, 1)
+        self.buckets = {}
+        for i, b in enumerate(boxes):
+            for k in self._bucket_range(b):
+                if k not in self.buckets:
+                    self.buckets[k] = []
+                self.buckets[k].append(i)
+        self.layoutno_groups = None
+
+    @classmethod
+    def build(cls, boxes):
+        """框数不少于MIN_BOXES时建立索引，否则返回None，由调用方线性扫描"""
+        if len(boxes) < cls.MIN_BOXES:
+            return None
+        return cls(boxes)
+
+    def _bucket_range(self, box):
+        top, bottom = min(box["top"], box["bottom"]), max(box["top"], box["bottom"])
+        return range(math.floor(top / self.bucket_size), math.floor(bottom / self.bucket_size) + 1)
+
+    @staticmethod
+    def intersected(a, b):
+        return not (b["x0"] > a["x1"] or b["x1"] < a["x0"] or b["bottom"] < a["top"] or b["top"] > a["bottom"])
+
+    def query(self, box):
+        """与box相交的框的下标，升序"""
+        ids = set()
+        for k in self._bucket_range(box):
+            ids.update(self.buckets.get(k, ()))
+        return sorted(i for i in ids if self.intersected(box, self.boxes[i]))
+
+    def same_layoutno(self, box):
+        """和box的layoutno相同的框的下标，升序"""
+        if self.layoutno_groups is None:
+            self.layoutno_groups = {}
+            for i, b in enumerate(self.boxes):
+                key = b.get("layoutno", "0")
+                if key not in self.layoutno_groups:
+                    self.layoutno_groups[key] = []
+                self.layoutno_groups[key].append(i)
+        return self.layoutno_groups.get(box.get("layoutno", "0"), [])
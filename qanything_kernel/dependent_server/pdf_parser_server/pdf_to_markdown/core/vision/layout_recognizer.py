@@ -3,8 +3,9 @@ import re
 from collections import Counter
 from copy import deepcopy
 import numpy as np
-from qanything_kernel.dependent_server.pdf_parser_server.pdf_to_markdown.core.vision import Recognizer
-from qanything_kernel.configs.model_config import PDF_MODEL_PATH
+from qanything_kernel.dependent_server.pdf_parser_server.pdf_to_markdown.core.vision import Recognizer, BoxIndex
+from qanything_kernel.configs.model_config import PDF_MODEL_PATH, PDF_LAYOUT_BATCH_SIZE, PDF_LAYOUT_INTRA_OP_THREADS, \
+    PDF_LAYOUT_INTER_OP_THREADS
 from tqdm import tqdm
 
 
@@ -17,15 +18,22 @@ class LayoutRecognizer(Recognizer):
         model_dir = os.path.join(
                     PDF_MODEL_PATH,
                     "checkpoints/layout")
-        super().__init__(self.labels, domain, model_dir, device)
+        super().__init__(self.labels, domain, model_dir, device, intra_op_num_threads=PDF_LAYOUT_INTRA_OP_THREADS,
+                         inter_op_num_threads=PDF_LAYOUT_INTER_OP_THREADS)
         self.garbage_layouts = ["footer", "header"]
 
-    def __call__(self, image_list, ocr_res, scale_factor=3, thr=0.4, batch_size=16, drop=True):
+    def detect(self, image_list, thr=0.4, batch_size=PDF_LAYOUT_BATCH_SIZE):
+        """只做版面检测，每页的结果互不依赖，可以按页分片在不同进程中计算后再传给__call__"""
+        return super().__call__(image_list, thr, batch_size)
+
+    def __call__(self, image_list, ocr_res, scale_factor=3, thr=0.4, batch_size=PDF_LAYOUT_BATCH_SIZE, drop=True,
+                 layouts=None):
         def __is_garbage(b):
             patt = ['\* Corresponding Author', '\*Corresponding to']
             return any([re.search(p, b["text"]) for p in patt])
 
-        layouts = super().__call__(image_list, thr, batch_size)
+        if layouts is None:
+            layouts = self.detect(image_list, thr, batch_size)
         # save_results(image_list, layouts, self.labels, output_dir='output/', threshold=0.7)
         assert len(image_list) == len(ocr_res)
         # Tag layout type
@@ -57,6 +65,7 @@ class LayoutRecognizer(Recognizer):
             def findLayout(ty):
                 nonlocal bxs, lts, self
                 lts_ = [lt for lt in lts if lt["type"] == ty]
+                lts_index = BoxIndex.build(lts_)
                 i = 0
                 while i < len(bxs):
                     if bxs[i].get("layout_type"):
@@ -67,7 +76,7 @@ class LayoutRecognizer(Recognizer):
                         continue
 
                     ii = self.find_overlapped_with_threashold(bxs[i], lts_,
-                                                              thr=0.4)
+                                                              thr=0.4, index=lts_index)
 
                     if ii is None:  # belong to nothing
                         bxs[i]["layout_type"] = ""
@@ -110,10 +119,11 @@ class LayoutRecognizer(Recognizer):
                 bxs.append(lt)
             
             lts_ = [lt for lt in lts if lt["type"] == 'item']
+            lts_index = BoxIndex.build(lts_)
             for i, bx in enumerate(bxs):
                 if bx["layout_type"] != 'reference': continue
                 ii = self.find_overlapped_with_threashold(bx, lts_,
-                                                              thr=0.4)
+                                                              thr=0.4, index=lts_index)
                 if ii is None:
                     continue
                 layoutno = bx["layoutno"]
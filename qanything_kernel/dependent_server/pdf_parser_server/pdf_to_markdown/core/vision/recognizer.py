@@ -1,12 +1,14 @@
 import os
-from copy import deepcopy
+import logging
 import onnxruntime as ort
 import torch
 from qanything_kernel.dependent_server.pdf_parser_server.pdf_to_markdown.core.vision.operators import *
+from qanything_kernel.dependent_server.pdf_parser_server.pdf_to_markdown.core.vision.box_index import BoxIndex
 
 
 class Recognizer(object):
-    def __init__(self, label_list, task_name, model_dir=None, device=torch.device("cpu")):
+    def __init__(self, label_list, task_name, model_dir=None, device=torch.device("cpu"), intra_op_num_threads=0,
+                 inter_op_num_threads=0):
         """
         If you have trouble downloading HuggingFace models, -_^ this might help!!
 
@@ -31,59 +33,60 @@ class Recognizer(object):
         else:
             sess_options = ort.SessionOptions()
             sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            # 0表示使用onnxruntime的默认线程数
+            sess_options.intra_op_num_threads = intra_op_num_threads
+            sess_options.inter_op_num_threads = inter_op_num_threads
             self.ort_sess = ort.InferenceSession(model_file_path, sess_options, providers=['CPUExecutionProvider'])
         self.input_names = [node.name for node in self.ort_sess.get_inputs()]
         self.output_names = [node.name for node in self.ort_sess.get_outputs()]
         self.input_shape = self.ort_sess.get_inputs()[0].shape[2:4]
+        # 导出时batch维是固定值（如1）的模型不能整批推理，动态batch维是字符串或None
+        batch_dim = self.ort_sess.get_inputs()[0].shape[0]
+        self.batch_inference = not isinstance(batch_dim, int) or batch_dim > 1
+        self.max_batch_size = batch_dim if isinstance(batch_dim, int) else None
         self.label_list = label_list
 
+    @staticmethod
+    def adjacent_swap_pass(arr, should_swap):
+        """
+        原来的写法是对每个i，从j=i到0依次比较arr[j]和arr[j+1]，should_swap时交换。
+        每一轮结束后前缀中都不存在需要交换的相邻对，所以新元素左移一旦停下，这一轮剩下的比较都不会交换，
+        在第一次不交换时停止得到的顺序完全相同，复杂度从O(n²)降为O(n + 交换次数)。
+        阈值关系不满足传递性，不能改写成一次按分桶key的排序，否则同一行内top逐渐变化的框顺序会不同
+        """
+        for i in range(1, len(arr)):
+            j = i
+            while j > 0 and should_swap(arr[j - 1], arr[j]):
+                arr[j - 1], arr[j] = arr[j], arr[j - 1]
+                j -= 1
+        return arr
+
     @staticmethod
     def sort_Y_firstly(arr, threashold):
         # sort using y1 first and then x1
         arr = sorted(arr, key=lambda r: (r["top"], r["x0"]))
-        for i in range(len(arr) - 1):
-            for j in range(i, -1, -1):
-                # restore the order using th
-                if abs(arr[j + 1]["top"] - arr[j]["top"]) < threashold \
-                        and arr[j + 1]["x0"] < arr[j]["x0"]:
-                    tmp = deepcopy(arr[j])
-                    arr[j] = deepcopy(arr[j + 1])
-                    arr[j + 1] = deepcopy(tmp)
-        return arr
+        # restore the order using th
+        return Recognizer.adjacent_swap_pass(
+            arr, lambda a, b: abs(b["top"] - a["top"]) < threashold and b["x0"] < a["x0"])
 
     @staticmethod
     def sort_X_firstly(arr, threashold, copy=True):
         # sort using y1 first and then x1
+        # 交换时不再复制dict，copy参数只为兼容保留
         arr = sorted(arr, key=lambda r: (r["x0"], r["top"]))
-        for i in range(len(arr) - 1):
-            for j in range(i, -1, -1):
-                # restore the order using th
-                if abs(arr[j + 1]["x0"] - arr[j]["x0"]) < threashold \
-                        and arr[j + 1]["top"] < arr[j]["top"]:
-                    tmp = deepcopy(arr[j]) if copy else arr[j]
-                    arr[j] = deepcopy(arr[j + 1]) if copy else arr[j + 1]
-                    arr[j + 1] = deepcopy(tmp) if copy else tmp
-        return arr
+        # restore the order using th
+        return Recognizer.adjacent_swap_pass(
+            arr, lambda a, b: abs(b["x0"] - a["x0"]) < threashold and b["top"] < a["top"])
 
     @staticmethod
     def sort_C_firstly(arr, thr=0):
         # sort using y1 first and then x1
         # sorted(arr, key=lambda r: (r["x0"], r["top"]))
         arr = Recognizer.sort_X_firstly(arr, thr)
-        for i in range(len(arr) - 1):
-            for j in range(i, -1, -1):
-                # restore the order using th
-                if "C" not in arr[j] or "C" not in arr[j + 1]:
-                    continue
-                if arr[j + 1]["C"] < arr[j]["C"] \
-                        or (
-                        arr[j + 1]["C"] == arr[j]["C"]
-                        and arr[j + 1]["top"] < arr[j]["top"]
-                ):
-                    tmp = arr[j]
-                    arr[j] = arr[j + 1]
-                    arr[j + 1] = tmp
-        return arr
+        # restore the order using th
+        return Recognizer.adjacent_swap_pass(
+            arr, lambda a, b: "C" in a and "C" in b
+                              and (b["C"] < a["C"] or (b["C"] == a["C"] and b["top"] < a["top"])))
 
         return sorted(arr, key=lambda r: (r.get("C", r["x0"]), r["top"]))
 
@@ -92,19 +95,9 @@ class Recognizer(object):
         # sort using y1 first and then x1
         # sorted(arr, key=lambda r: (r["top"], r["x0"]))
         arr = Recognizer.sort_Y_firstly(arr, thr)
-        for i in range(len(arr) - 1):
-            for j in range(i, -1, -1):
-                if "R" not in arr[j] or "R" not in arr[j + 1]:
-                    continue
-                if arr[j + 1]["R"] < arr[j]["R"] \
-                        or (
-                        arr[j + 1]["R"] == arr[j]["R"]
-                        and arr[j + 1]["x0"] < arr[j]["x0"]
-                ):
-                    tmp = arr[j]
-                    arr[j] = arr[j + 1]
-                    arr[j + 1] = tmp
-        return arr
+        return Recognizer.adjacent_swap_pass(
+            arr, lambda a, b: "R" in a and "R" in b
+                              and (b["R"] < a["R"] or (b["R"] == a["R"] and b["x0"] < a["x0"])))
 
     @staticmethod
     def overlapped_area(a, b, ratio=True):
@@ -135,6 +128,8 @@ class Recognizer(object):
                         a["bottom"] < b["top"],
                         a["top"] > b["bottom"]])
 
+        # 只在需要按文本框面积取舍时才建索引
+        box_index = None
         i = 0
         while i + 1 < len(layouts):
             j = i + 1
@@ -165,11 +160,20 @@ class Recognizer(object):
                 continue
 
             area_i, area_i_1 = 0, 0
-            for b in boxes:
-                if not notOverlapped(b, layouts[i]):
-                    area_i += Recognizer.overlapped_area(b, layouts[i], False)
-                if not notOverlapped(b, layouts[j]):
-                    area_i_1 += Recognizer.overlapped_area(b, layouts[j], False)
+            if box_index is None:
+                box_index = BoxIndex.build(boxes) or False
+            if box_index:
+                # 候选框按原顺序累加，和线性扫描的浮点求和顺序一致
+                for k in box_index.query(layouts[i]):
+                    area_i += Recognizer.overlapped_area(boxes[k], layouts[i], False)
+                for k in box_index.query(layouts[j]):
+                    area_i_1 += Recognizer.overlapped_area(boxes[k], layouts[j], False)
+            else:
+                for b in boxes:
+                    if not notOverlapped(b, layouts[i]):
+                        area_i += Recognizer.overlapped_area(b, layouts[i], False)
+                    if not notOverlapped(b, layouts[j]):
+                        area_i_1 += Recognizer.overlapped_area(b, layouts[j], False)
 
             if area_i > area_i_1:
                 layouts.pop(j)
@@ -254,11 +258,13 @@ class Recognizer(object):
         return max_overlaped_i
 
     @staticmethod
-    def find_horizontally_tightest_fit(box, boxes):
+    def find_horizontally_tightest_fit(box, boxes, index=None):
         if not boxes:
             return
         min_dis, min_i = 1000000, None
-        for i, b in enumerate(boxes):
+        candidates = index.same_layoutno(box) if index else range(len(boxes))
+        for i in candidates:
+            b = boxes[i]
             if box.get("layoutno", "0") != b.get("layoutno", "0"): continue
             dis = min(abs(box["x0"] - b["x0"]), abs(box["x1"] - b["x1"]),
                       abs(box["x0"] + box["x1"] - b["x1"] - b["x0"]) / 2)
@@ -268,12 +274,14 @@ class Recognizer(object):
         return min_i
 
     @staticmethod
-    def find_overlapped_with_threashold(box, boxes, thr=0.3):
+    def find_overlapped_with_threashold(box, boxes, thr=0.3, index=None):
+        """index: boxes的BoxIndex；thr大于0时不相交的框不可能被选中，只需遍历索引返回的候选框"""
         if not boxes:
             return
         max_overlapped_i, max_overlapped, _max_overlapped = None, thr, 0
         s, e = 0, len(boxes)
-        for i in range(s, e):
+        candidates = index.query(box) if index and thr > 0 else range(s, e)
+        for i in candidates:
             ov = Recognizer.overlapped_area(box, boxes[i])
             _ov = Recognizer.overlapped_area(boxes[i], box)
             if (ov, _ov) < (max_overlapped, _max_overlapped):
@@ -423,17 +431,34 @@ class Recognizer(object):
             else:
                 imgs.append(image_list[i])
 
+        if self.max_batch_size is not None:
+            batch_size = min(batch_size, self.max_batch_size)
         batch_loop_cnt = math.ceil(float(len(imgs)) / batch_size)
         for i in range(batch_loop_cnt):
             start_index = i * batch_size
             end_index = min((i + 1) * batch_size, len(imgs))
             batch_image_list = imgs[start_index:end_index]
             inputs = self.preprocess(batch_image_list)
-            print("preprocess")
-            for ins in inputs:
-                bb = self.postprocess(
-                    self.ort_sess.run(None, {k: v for k, v in ins.items() if k in self.input_names})[0], ins, thr)
+            for ins, outputs in zip(inputs, self.run_batch(inputs)):
+                bb = self.postprocess(outputs, ins, thr)
                 # print(f"page_rec_res: {bb}")
                 res.append(bb)
 
         return res
+
+    def run_batch(self, inputs):
+        """
+        preprocess后每张图都被letterbox到相同的input_shape，可以直接在batch维上拼接，一次推理整批图片；
+        返回每张图对应的输出（保留batch维，和单张推理的输出形状一致）
+        """
+        if len(inputs) > 1 and self.batch_inference:
+            feed = {k: np.concatenate([ins[k] for ins in inputs], axis=0) for k in self.input_names}
+            try:
+                outputs = self.ort_sess.run(None, feed)[0]
+                return [outputs[i:i + 1] for i in range(len(inputs))]
+            except Exception as e:
+                # 模型不支持batch推理时退化为逐张推理，之后不再尝试
+                logging.warning(f"batch inference failed, fallback to per-image inference: {e}")
+                self.batch_inference = False
+        return [self.ort_sess.run(None, {k: v for k, v in ins.items() if k in self.input_names})[0]
+                for ins in inputs]
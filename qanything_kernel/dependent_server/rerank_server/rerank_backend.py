@@ -2,7 +2,7 @@ from transformers import AutoTokenizer
 from copy import deepcopy
 from typing import List
 from qanything_kernel.configs.model_config import LOCAL_RERANK_MAX_LENGTH, \
-    LOCAL_RERANK_BATCH, LOCAL_RERANK_PATH, LOCAL_RERANK_THREADS
+    LOCAL_RERANK_BATCH, LOCAL_RERANK_PATH, LOCAL_RERANK_THREADS, LOCAL_RERANK_PAD_TO_MULTIPLE_OF
 from qanything_kernel.utils.custom_log import debug_logger
 from qanything_kernel.utils.general_utils import get_time
 import concurrent.futures
@@ -17,6 +17,7 @@ class RerankBackend(ABC):
         self.overlap_tokens = 80
         self.batch_size = LOCAL_RERANK_BATCH
         self.max_length = LOCAL_RERANK_MAX_LENGTH
+        self.pad_to_multiple_of = LOCAL_RERANK_PAD_TO_MULTIPLE_OF
         self.return_tensors = None
         self.workers = LOCAL_RERANK_THREADS
 
@@ -87,15 +88,21 @@ class RerankBackend(ABC):
     def get_rerank(self, query: str, passages: List[str]):
         tot_batches, merge_inputs_idxs_sort = self.tokenize_preproc(query, passages)
 
-        tot_scores = []
+        # 按token长度排序后再切batch，减少padding，推理完成后恢复原始顺序
+        sorted_idxs = sorted(range(len(tot_batches)), key=lambda i: len(tot_batches[i]['input_ids']))
+        sorted_scores = []
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
             futures = []
-            for k in range(0, len(tot_batches), self.batch_size):
+            for k in range(0, len(sorted_idxs), self.batch_size):
+                batch_inputs = [tot_batches[i] for i in sorted_idxs[k:k + self.batch_size]]
+                pad_length = max(len(inputs['input_ids']) for inputs in batch_inputs)
+                if self.pad_to_multiple_of:
+                    pad_length = min(-(-pad_length // self.pad_to_multiple_of) * self.pad_to_multiple_of,
+                                     self.max_length)
                 batch = self._tokenizer.pad(
-                    tot_batches[k:k + self.batch_size],
-                    padding=True,
-                    max_length=None,
-                    pad_to_multiple_of=None,
+                    batch_inputs,
+                    padding='max_length',
+                    max_length=pad_length,
                     return_tensors=self.return_tensors
                 )
                 future = executor.submit(self.inference, batch)
@@ -103,7 +110,10 @@ class RerankBackend(ABC):
             # debug_logger.info(f'rerank number: {len(futures)}')
             for future in futures:
                 scores = future.result()
-                tot_scores.extend(scores)
+                sorted_scores.extend(scores)
+        tot_scores = [0 for _ in range(len(tot_batches))]
+        for i, score in zip(sorted_idxs, sorted_scores):
+            tot_scores[i] = score
 
         merge_tot_scores = [0 for _ in range(len(passages))]
         for pid, score in zip(merge_inputs_idxs_sort, tot_scores):
@@ -5,7 +5,7 @@ from qanything_kernel.core.local_doc_qa import LocalDocQA
 from qanything_kernel.utils.custom_log import debug_logger, qa_logger
 from qanything_kernel.configs.model_config import (BOT_DESC, BOT_IMAGE, BOT_PROMPT, BOT_WELCOME,
                                                    DEFAULT_PARENT_CHUNK_SIZE, MAX_CHARS, VECTOR_SEARCH_TOP_K,
-                                                   UPLOAD_ROOT_PATH, IMAGES_ROOT_PATH)
+                                                   UPLOAD_ROOT_PATH, IMAGES_ROOT_PATH, RERANK_MAX_CANDIDATES)
 from qanything_kernel.utils.general_utils import *
 from langchain.schema import Document
 from sanic.response import ResponseStream
@@ -470,32 +470,15 @@ async def delete_knowledge_base(req: request):
     if not_exist_kb_ids:
         return sanic_json({"code": 2003, "msg": "fail, knowledge Base {} not found".format(not_exist_kb_ids)})
 
-    # milvus = local_doc_qa.match_milvus_kb(user_id, kb_ids)
+    # 这里只做逻辑删除并登记删除任务，milvus/es/父文档/磁盘文件由入库服务中的后台删除服务批量清理
+    # 先登记任务再逻辑删除，登记失败时直接报错，知识库仍然可见，重试即可
     for kb_id in kb_ids:
-        expr = f"kb_id == \"{kb_id}\""
-        asyncio.create_task(run_in_background(local_doc_qa.milvus_kb.delete_expr, expr))
-        # local_doc_qa.milvus_kb.delete_expr(expr)
-        # milvus.delete_partition(kb_id)
+        if not local_doc_qa.milvus_summary.add_delete_tasks(user_id, kb_id):
+            return sanic_json({"code": 2007, "msg": "fail, add delete task for knowledge base {} failed, please retry"
+                               .format(kb_id)})
+    local_doc_qa.milvus_summary.delete_knowledge_base(user_id, kb_ids)
     for kb_id in kb_ids:
-        file_infos = local_doc_qa.milvus_summary.get_files(user_id, kb_id)
-        file_ids = [file_info[0] for file_info in file_infos]
-        file_chunks = [file_info[8] for file_info in file_infos]
-        asyncio.create_task(run_in_background(local_doc_qa.es_client.delete_files, file_ids, file_chunks))
-        local_doc_qa.milvus_summary.delete_documents(file_ids)
-        local_doc_qa.milvus_summary.delete_faqs(file_ids)
-
-        # delete kb_id file dir
-        try:
-            upload_path = os.path.join(UPLOAD_ROOT_PATH, user_id)
-            file_dir = os.path.join(upload_path, kb_id)
-            debug_logger.info("delete_knowledge_base file dir : %s", file_dir)
-            shutil.rmtree(file_dir)
-        except Exception as e:
-            debug_logger.error("An error occurred while constructing file paths: %s", str(e))
-
-
         debug_logger.info(f"""delete knowledge base {kb_id} success""")
-    local_doc_qa.milvus_summary.delete_knowledge_base(user_id, kb_ids)
     return sanic_json({"code": 200, "msg": "Knowledge Base {} delete success".format(kb_ids)})
 
 
@@ -540,31 +523,12 @@ async def delete_docs(req: request):
         return sanic_json({"code": 2004, "msg": "fail, files {} not found".format(file_ids)})
     valid_file_ids = [file_info[0] for file_info in valid_file_infos]
     debug_logger.info("delete_docs valid_file_ids %s", valid_file_ids)
-    # milvus_kb = local_doc_qa.match_milvus_kb(user_id, [kb_id])
-    # milvus_kb.delete_files(file_ids)
-    expr = f"""kb_id == "{kb_id}" and file_id in {valid_file_ids}"""  # 删除数据库中的记录
-    asyncio.create_task(run_in_background(local_doc_qa.milvus_kb.delete_expr, expr))
-    # local_doc_qa.milvus_kb.delete_expr(expr)
-    file_chunks = local_doc_qa.milvus_summary.get_chunk_size(valid_file_ids)
-    asyncio.create_task(run_in_background(local_doc_qa.es_client.delete_files, valid_file_ids, file_chunks))
-
+    # 这里只做逻辑删除并登记删除任务，milvus/es/父文档/磁盘文件由入库服务中的后台删除服务批量清理
+    # 先登记任务再逻辑删除，登记失败时直接报错，文件仍然可见，重试即可
+    if not local_doc_qa.milvus_summary.add_delete_tasks(user_id, kb_id, valid_file_ids):
+        return sanic_json({"code": 2007, "msg": "fail, add delete tasks for documents {} failed, please retry"
+                           .format(valid_file_ids)})
     local_doc_qa.milvus_summary.delete_files(kb_id, valid_file_ids)
-    local_doc_qa.milvus_summary.delete_documents(valid_file_ids)
-    local_doc_qa.milvus_summary.delete_faqs(valid_file_ids)
-    # list file_ids
-    for file_id in file_ids:
-        try:
-            upload_path = os.path.join(UPLOAD_ROOT_PATH, user_id)
-            file_dir = os.path.join(upload_path, kb_id, file_id)
-            debug_logger.info("delete_docs file_dir %s", file_dir)
-            # delete file dir
-            shutil.rmtree(file_dir)
-            # delele images dir
-            images_dir = os.path.join(IMAGES_ROOT_PATH, file_id)
-            debug_logger.info("delete_docs images_dir %s", images_dir)
-            shutil.rmtree(images_dir)
-        except Exception as e:
-            debug_logger.error("An error occurred while constructing file paths: %s", str(e))
 
     return sanic_json({"code": 200, "msg": "documents {} delete success".format(valid_file_ids)})
 
@@ -680,6 +644,7 @@ async def local_doc_chat(req: request):
         max_token = llm_setting.get('max_token')
         hybrid_search = llm_setting.get('hybrid_search', False)
         chunk_size = llm_setting.get('chunk_size', DEFAULT_PARENT_CHUNK_SIZE)
+        rerank_top_n = llm_setting.get('rerank_top_n', RERANK_MAX_CANDIDATES)
     else:
         kb_ids = safe_get(req, 'kb_ids')
         custom_prompt = safe_get(req, 'custom_prompt', None)
@@ -701,6 +666,7 @@ async def local_doc_chat(req: request):
 
         hybrid_search = safe_get(req, 'hybrid_search', False)
         chunk_size = safe_get(req, 'chunk_size', DEFAULT_PARENT_CHUNK_SIZE)
+        rerank_top_n = safe_get(req, 'rerank_top_n', RERANK_MAX_CANDIDATES)
 
     debug_logger.info('rerank %s', rerank)
 
@@ -801,6 +767,7 @@ async def local_doc_chat(req: request):
                                                                                     time_record=time_record,
                                                                                     need_web_search=need_web_search,
                                                                                     hybrid_search=hybrid_search,
+                                                                                    rerank_top_n=rerank_top_n,
                                                                                     web_chunk_size=chunk_size,
                                                                                     temperature=temperature,
                                                                                     api_base=api_base,
@@ -882,6 +849,7 @@ async def local_doc_chat(req: request):
                                                                            only_need_search_results=only_need_search_results,
                                                                            need_web_search=need_web_search,
                                                                            hybrid_search=hybrid_search,
+                                                                           rerank_top_n=rerank_top_n,
                                                                            web_chunk_size=chunk_size,
                                                                            temperature=temperature,
                                                                            api_base=api_base,
@@ -1240,7 +1208,10 @@ async def get_user_status(req: request):
 @get_time_async
 async def health_check(req: request):
     # 实现一个服务健康检查的逻辑，正常就返回200，不正常就返回500
-    return sanic_json({"code": 200, "msg": "success"})
+    local_doc_qa: LocalDocQA = req.app.ctx.local_doc_qa
+    retrieval_cache = local_doc_qa.retrieval_cache.stats() if local_doc_qa.retrieval_cache is not None else {}
+    return sanic_json({"code": 200, "msg": "success", "embed_cache": local_doc_qa.embeddings.cache_stats,
+                       "retrieval_cache": retrieval_cache})
 
 
 @get_time_async
@@ -1382,6 +1353,9 @@ async def update_bot(req: request):
     hybrid_search = safe_get(req, "hybrid_search")
     if hybrid_search is not None:
         llm_setting["hybrid_search"] = hybrid_search
+    rerank_top_n = safe_get(req, "rerank_top_n")
+    if rerank_top_n is not None:
+        llm_setting["rerank_top_n"] = rerank_top_n
     networking = safe_get(req, "networking")
     if networking is not None:
         llm_setting["networking"] = networking
@@ -1445,6 +1419,8 @@ async def update_chunks(req: request):
     expr = f'doc_id == "{doc_id}"'
     local_doc_qa.milvus_kb.delete_expr(expr)
     await local_doc_qa.retriever.insert_documents([doc], chunk_size, True)
+    # 重新入库完成后再递增版本号，否则期间的检索会把旧chunk缓存到新版本下
+    local_doc_qa.milvus_summary.bump_kb_version([doc.metadata['kb_id']])
     return sanic_json({"code": 200, "msg": "success update doc_id {}".format(doc_id)})
 
 
@@ -17,6 +17,8 @@ sys.path.append(root_dir)
 
 from handler import *
 from qanything_kernel.core.local_doc_qa import LocalDocQA
+from qanything_kernel.connector.http_session import close_client_session
+from qanything_kernel.connector.llm.llm_for_openai_api import close_llm_clients
 from qanything_kernel.utils.custom_log import debug_logger, qa_logger
 from sanic.worker.manager import WorkerManager
 from sanic import Sanic
@@ -55,6 +57,13 @@ async def init_local_doc_qa(app, loop):
     print(f'init local_doc_qa cost {end - start}s', flush=True)
     app.ctx.local_doc_qa = local_doc_qa
     
+@app.after_server_stop
+async def close_http_session(app, loop):
+    # 关闭embedding/rerank共享的aiohttp连接池以及缓存的LLM客户端
+    await close_client_session(loop)
+    await close_llm_clients(loop)
+
+
 @app.after_server_start
 async def notify_server_started(app, loop):
     print(f"Server Start Cost {time.time() - start_time} seconds", flush=True)
@@ -13,7 +13,7 @@ import logging
 import re
 import requests
 import aiohttp
-from functools import wraps
+from functools import wraps, lru_cache
 import tiktoken
 from openpyxl.utils import get_column_letter
 from openpyxl import load_workbook
@@ -222,9 +222,14 @@ def validate_user_id(user_id):
         return False
 
 
+@lru_cache(maxsize=16)
+def get_tiktoken_encoding(model: str):
+    return tiktoken.encoding_for_model(model)
+
+
 def num_tokens(text: str, model: str = 'gpt-3.5-turbo-0613') -> int:
     """Return the number of tokens in a string."""
-    encoding = tiktoken.encoding_for_model(model)
+    encoding = get_tiktoken_encoding(model)
     return len(encoding.encode(text, disallowed_special=()))
 
 
@@ -259,7 +264,7 @@ def cur_func_name():
 
 
 def num_tokens_from_messages(message_texts, model="gpt-3.5-turbo-0301"):
-    encoding = tiktoken.encoding_for_model(model)
+    encoding = get_tiktoken_encoding(model)
     num_tokens = 0
     for message in message_texts:
         # num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
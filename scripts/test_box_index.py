@@ -0,0 +1,111 @@
+import os
+import sys
+import time
+import random
+import argparse
+from copy import deepcopy
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from qanything_kernel.dependent_server.pdf_parser_server.pdf_to_markdown.core.vision import Recognizer, BoxIndex
+
+parser = argparse.ArgumentParser(description="表格框匹配：线性扫描与BoxIndex的耗时对比，并校验结果一致")
+parser.add_argument('--pdf', type=str, default=None, help='表格较多的pdf，用文本span作为文本框、文本行作为表格行；不指定时随机生成')
+parser.add_argument('--pages', type=int, default=50, help='随机生成的页数')
+parser.add_argument('--tables_per_page', type=int, default=2)
+parser.add_argument('--rows', type=int, default=30, help='每个表格的行数')
+parser.add_argument('--cols', type=int, default=8, help='每个表格的列数')
+args = parser.parse_args()
+
+PAGE_HEIGHT = 842
+
+
+def synthetic_tables():
+    """生成财报类的密集表格：每个单元格一个文本框，另外生成行、列、表头组件，坐标为全文档累计y"""
+    random.seed(0)
+    boxes, rows, clmns, headers = [], [], [], []
+    row_h = 12
+    for pn in range(args.pages):
+        for t in range(args.tables_per_page):
+            top0 = pn * PAGE_HEIGHT + 40 + t * (args.rows * row_h + 40)
+            layoutno = f"table-{t}"
+            for r in range(args.rows):
+                top = top0 + r * row_h
+                row = {"x0": 40, "x1": 555, "top": top, "bottom": top + row_h, "layoutno": layoutno, "pn": pn}
+                (headers if r == 0 else rows).append(row)
+                for c in range(args.cols):
+                    x0 = 40 + c * 515 / args.cols + random.uniform(0, 5)
+                    boxes.append({"x0": x0, "x1": x0 + random.uniform(20, 515 / args.cols - 5),
+                                  "top": top + 2, "bottom": top + row_h - 2, "text": "1,234.56",
+                                  "layout_type": "table", "layoutno": layoutno, "page_number": pn + 1})
+            for c in range(args.cols):
+                x0 = 40 + c * 515 / args.cols
+                clmns.append({"x0": x0, "x1": x0 + 515 / args.cols, "top": top0,
+                              "bottom": top0 + args.rows * row_h, "layoutno": layoutno, "pn": pn})
+    return boxes, rows, clmns, headers
+
+
+def pdf_tables(pdf_path):
+    import fitz
+    boxes, rows = [], []
+    for pn, page in enumerate(fitz.open(pdf_path)):
+        offset = pn * page.rect.height
+        for block in page.get_text("dict")["blocks"]:
+            for line in block.get("lines", []):
+                x0, top, x1, bottom = line["bbox"]
+                rows.append({"x0": x0, "x1": x1, "top": top + offset, "bottom": bottom + offset, "layoutno": "table-0"})
+                for span in line["spans"]:
+                    x0, top, x1, bottom = span["bbox"]
+                    boxes.append({"x0": x0, "x1": x1, "top": top + offset, "bottom": bottom + offset,
+                                  "text": span["text"], "layout_type": "table", "layoutno": "table-0",
+                                  "page_number": pn + 1})
+    return boxes, rows, deepcopy(rows), rows[::10]
+
+
+def tag(boxes, rows, clmns, headers, use_index):
+    rows_index = BoxIndex.build(rows) if use_index else None
+    headers_index = BoxIndex.build(headers) if use_index else None
+    clmns_index = BoxIndex.build(clmns) if use_index else None
+    res = []
+    for b in boxes:
+        res.append((Recognizer.find_overlapped_with_threashold(b, rows, thr=0.3, index=rows_index),
+                    Recognizer.find_overlapped_with_threashold(b, headers, thr=0.3, index=headers_index),
+                    Recognizer.find_horizontally_tightest_fit(b, clmns, index=clmns_index)))
+    return res
+
+
+def cleanup(boxes, rows, use_index):
+    min_boxes = BoxIndex.MIN_BOXES
+    if not use_index:
+        BoxIndex.MIN_BOXES = float("inf")
+    try:
+        # 重叠的行组件两两之间没有分数，需要按文本框面积取舍
+        layouts = Recognizer.sort_Y_firstly(deepcopy(rows) + deepcopy(rows), 0)
+        return Recognizer.layouts_cleanup(boxes, layouts, 5, 0.5)
+    finally:
+        BoxIndex.MIN_BOXES = min_boxes
+
+
+def timed(func, *func_args):
+    start = time.perf_counter()
+    res = func(*func_args)
+    return res, time.perf_counter() - start
+
+
+def main():
+    boxes, rows, clmns, headers = pdf_tables(args.pdf) if args.pdf else synthetic_tables()
+    print(f"boxes: {len(boxes)}, rows: {len(rows)}, columns: {len(clmns)}, headers: {len(headers)}")
+
+    linear, linear_cost = timed(tag, boxes, rows, clmns, headers, False)
+    indexed, indexed_cost = timed(tag, boxes, rows, clmns, headers, True)
+    print(f"tag table boxes: linear {linear_cost:.3f}s, index {indexed_cost:.3f}s, "
+          f"speedup {linear_cost / max(indexed_cost, 1e-9):.1f}x, identical: {linear == indexed}")
+
+    linear, linear_cost = timed(cleanup, boxes, rows, False)
+    indexed, indexed_cost = timed(cleanup, boxes, rows, True)
+    print(f"layouts_cleanup: linear {linear_cost:.3f}s, index {indexed_cost:.3f}s, "
+          f"speedup {linear_cost / max(indexed_cost, 1e-9):.1f}x, identical: {linear == indexed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+import argparse
+import logging
+import numpy as np
+
+# 线程数需要在导入model_config之前通过环境变量设置
+parser = argparse.ArgumentParser(description="版面检测模型batch推理的吞吐测试（CPU）")
+parser.add_argument('--pdf', type=str, default=None, help='用于测试的pdf文件，不指定时使用随机生成的页面')
+parser.add_argument('--pages', type=int, default=32, help='测试页数')
+parser.add_argument('--zoomin', type=int, default=3, help='页面渲染倍数，与解析服务一致')
+parser.add_argument('--batch_sizes', type=str, default='1,4,8,16', help='逗号分隔的batch size')
+parser.add_argument('--intra_op_threads', type=int, default=0, help='onnxruntime算子内线程数，0为默认值')
+parser.add_argument('--inter_op_threads', type=int, default=0, help='onnxruntime算子间线程数，0为默认值')
+parser.add_argument('--repeat', type=int, default=2, help='每个batch size重复次数，取最快的一次')
+args = parser.parse_args()
+os.environ["PDF_LAYOUT_INTRA_OP_THREADS"] = str(args.intra_op_threads)
+os.environ["PDF_LAYOUT_INTER_OP_THREADS"] = str(args.inter_op_threads)
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from PIL import Image
+from qanything_kernel.dependent_server.pdf_parser_server.pdf_to_markdown.core.vision import LayoutRecognizer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def load_pages(pdf_path, pages, zoomin):
+    if pdf_path is None:
+        # A4页面大小，随机灰度块模拟文字和图片
+        rng = np.random.default_rng(0)
+        w, h = int(595 * zoomin), int(842 * zoomin)
+        images = []
+        for _ in range(pages):
+            arr = np.full((h, w, 3), 255, dtype=np.uint8)
+            for _ in range(40):
+                x, y = rng.integers(0, w - 400), rng.integers(0, h - 60)
+                arr[y:y + rng.integers(10, 60), x:x + rng.integers(100, 400)] = rng.integers(0, 200)
+            images.append(Image.fromarray(arr))
+        return images
+    import fitz
+    pdf = fitz.open(pdf_path)
+    mat = fitz.Matrix(zoomin, zoomin)
+    images = []
+    for i in range(pages):
+        pix = pdf[i % len(pdf)].get_pixmap(matrix=mat)
+        images.append(Image.frombytes("RGB", [pix.width, pix.height], pix.samples))
+    return images
+
+
+def same_layouts(a, b, atol=1e-3):
+    if len(a) != len(b):
+        return False
+    for page_a, page_b in zip(a, b):
+        if len(page_a) != len(page_b):
+            return False
+        for la, lb in zip(page_a, page_b):
+            if la["type"] != lb["type"] or not np.allclose(la["bbox"], lb["bbox"], atol=atol):
+                return False
+    return True
+
+
+def main():
+    images = load_pages(args.pdf, args.pages, args.zoomin)
+    layouter = LayoutRecognizer("layout", torch.device("cpu"))
+    logger.info(f"batch inference supported: {layouter.batch_inference}, "
+                f"intra_op_threads: {args.intra_op_threads}, inter_op_threads: {args.inter_op_threads}")
+    # 预热，排除首次推理的初始化开销
+    layouter.detect(images[:1], thr=0.15, batch_size=1)
+
+    baseline = None
+    results = []
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        costs = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            layouts = layouter.detect(images, thr=0.15, batch_size=batch_size)
+            costs.append(time.perf_counter() - start)
+        if baseline is None:
+            baseline = layouts
+        cost = min(costs)
+        results.append({
+            "batch_size": batch_size,
+            "pages": len(images),
+            "seconds": round(cost, 3),
+            "pages_per_sec": round(len(images) / cost, 2),
+            "same_as_first": same_layouts(baseline, layouts),
+        })
+        logger.info(results[-1])
+
+    print("\nbatch_size\tpages/sec\tseconds\tsame_as_first")
+    for r in results:
+        print(f"{r['batch_size']}\t\t{r['pages_per_sec']}\t\t{r['seconds']}\t{r['same_as_first']}")
+
+
+if __name__ == "__main__":
+    main()
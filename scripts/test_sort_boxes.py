@@ -0,0 +1,145 @@
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from copy import deepcopy
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from qanything_kernel.dependent_server.pdf_parser_server.pdf_to_markdown.core.vision import Recognizer
+
+parser = argparse.ArgumentParser(description="校验sort_Y_firstly/sort_X_firstly/sort_C_firstly/sort_R_firstly与旧实现顺序一致")
+parser.add_argument('--pdf', type=str, default=None, help='用真实解析过程中的输入做校验，会完整解析一遍该pdf')
+parser.add_argument('--use_gpu', action="store_true", help='解析pdf时使用gpu')
+parser.add_argument('--trials', type=int, default=2000, help='随机用例数')
+args = parser.parse_args()
+
+
+# 旧实现，作为校验基准
+def legacy_sort_Y_firstly(arr, threashold):
+    arr = sorted(arr, key=lambda r: (r["top"], r["x0"]))
+    for i in range(len(arr) - 1):
+        for j in range(i, -1, -1):
+            if abs(arr[j + 1]["top"] - arr[j]["top"]) < threashold \
+                    and arr[j + 1]["x0"] < arr[j]["x0"]:
+                tmp = deepcopy(arr[j])
+                arr[j] = deepcopy(arr[j + 1])
+                arr[j + 1] = deepcopy(tmp)
+    return arr
+
+
+def legacy_sort_X_firstly(arr, threashold, copy=True):
+    arr = sorted(arr, key=lambda r: (r["x0"], r["top"]))
+    for i in range(len(arr) - 1):
+        for j in range(i, -1, -1):
+            if abs(arr[j + 1]["x0"] - arr[j]["x0"]) < threashold \
+                    and arr[j + 1]["top"] < arr[j]["top"]:
+                tmp = deepcopy(arr[j]) if copy else arr[j]
+                arr[j] = deepcopy(arr[j + 1]) if copy else arr[j + 1]
+                arr[j + 1] = deepcopy(tmp) if copy else tmp
+    return arr
+
+
+def legacy_sort_C_firstly(arr, thr=0):
+    arr = legacy_sort_X_firstly(arr, thr)
+    for i in range(len(arr) - 1):
+        for j in range(i, -1, -1):
+            if "C" not in arr[j] or "C" not in arr[j + 1]:
+                continue
+            if arr[j + 1]["C"] < arr[j]["C"] \
+                    or (arr[j + 1]["C"] == arr[j]["C"] and arr[j + 1]["top"] < arr[j]["top"]):
+                arr[j], arr[j + 1] = arr[j + 1], arr[j]
+    return arr
+
+
+def legacy_sort_R_firstly(arr, thr=0):
+    arr = legacy_sort_Y_firstly(arr, thr)
+    for i in range(len(arr) - 1):
+        for j in range(i, -1, -1):
+            if "R" not in arr[j] or "R" not in arr[j + 1]:
+                continue
+            if arr[j + 1]["R"] < arr[j]["R"] \
+                    or (arr[j + 1]["R"] == arr[j]["R"] and arr[j + 1]["x0"] < arr[j]["x0"]):
+                arr[j], arr[j + 1] = arr[j + 1], arr[j]
+    return arr
+
+
+SORTS = {
+    "sort_Y_firstly": (Recognizer.sort_Y_firstly, legacy_sort_Y_firstly),
+    "sort_X_firstly": (Recognizer.sort_X_firstly, legacy_sort_X_firstly),
+    "sort_C_firstly": (Recognizer.sort_C_firstly, legacy_sort_C_firstly),
+    "sort_R_firstly": (Recognizer.sort_R_firstly, legacy_sort_R_firstly),
+}
+
+
+def random_boxes(n):
+    """模拟一页的文本行：同一行的框top有抖动，x0有重复，部分框带R/C标记"""
+    boxes = []
+    lines = max(n // random.randint(1, 10), 1)
+    for i in range(n):
+        line = random.randrange(lines)
+        x0 = random.choice([random.uniform(0, 500), float(random.randrange(0, 500, 50))])
+        top = line * random.uniform(8, 14) + random.uniform(-4, 4)
+        box = {"x0": x0, "x1": x0 + random.uniform(5, 80), "top": top, "bottom": top + 10, "id": i}
+        if random.random() < 0.5:
+            box["R"] = random.randrange(5)
+        if random.random() < 0.5:
+            box["C"] = random.randrange(5)
+        boxes.append(box)
+    return boxes
+
+
+def same_order(name, arr, thr):
+    new_sort, legacy_sort = SORTS[name]
+    return new_sort(deepcopy(arr), thr) == legacy_sort(deepcopy(arr), thr)
+
+
+def check_random():
+    random.seed(0)
+    for trial in range(args.trials):
+        arr = random_boxes(random.randint(0, 120))
+        thr = random.choice([0, 1, 3, 5, 10, 50])
+        for name in SORTS:
+            assert same_order(name, arr, thr), f"{name} mismatch, trial {trial}, thr {thr}"
+    print(f"random: {args.trials} trials passed")
+
+
+def check_pdf(pdf_path):
+    """完整解析一遍pdf，记录解析过程中每次排序的输入，逐一与旧实现比较"""
+    import torch
+    from qanything_kernel.dependent_server.pdf_parser_server.pdf_parser_backend import PdfLoader
+
+    calls = []
+    for name, (new_sort, _) in SORTS.items():
+        def recorder(arr, thr=0, *rest, _name=name, _sort=new_sort):
+            calls.append((_name, deepcopy(arr), thr))
+            return _sort(arr, thr, *rest)
+        setattr(Recognizer, name, staticmethod(recorder))
+    try:
+        loader = PdfLoader(device=torch.device('cuda') if args.use_gpu else torch.device('cpu'))
+        start = time.perf_counter()
+        loader.load_to_markdown(pdf_path, tempfile.mkdtemp())
+        print(f"parse cost: {time.perf_counter() - start:.2f}s, sort calls: {len(calls)}")
+    finally:
+        for name, (new_sort, _) in SORTS.items():
+            setattr(Recognizer, name, staticmethod(new_sort))
+
+    new_cost, legacy_cost = 0, 0
+    for i, (name, arr, thr) in enumerate(calls):
+        new_sort, legacy_sort = SORTS[name]
+        start = time.perf_counter()
+        new = new_sort(deepcopy(arr), thr)
+        new_cost += time.perf_counter() - start
+        start = time.perf_counter()
+        legacy = legacy_sort(deepcopy(arr), thr)
+        legacy_cost += time.perf_counter() - start
+        assert new == legacy, f"{name} mismatch on call {i}, {len(arr)} boxes, thr {thr}"
+    print(f"pdf: {len(calls)} sort calls identical, legacy {legacy_cost:.3f}s, new {new_cost:.3f}s")
+
+
+if __name__ == "__main__":
+    check_random()
+    if args.pdf:
+        check_pdf(args.pdf)